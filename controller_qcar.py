@@ -3,10 +3,20 @@ import multiprocessing
 import time
 import math
 import numpy as np
-from multiprocessing.managers import DictProxy
 from threading import Thread
-from pal.products.qcar import IS_PHYSICAL_QCAR  # Still useful to know
 import queue
+from rule_engine import Condition, FleetRuleEngine, Rule, RuleEngine
+from object_tracker import MultiObjectTracker
+from cruise_control import AdaptiveCruiseControl, select_lead
+from geofence import GeofenceIndex
+from latency import LatencyStats, command_text, make_command, stamp
+from sim_clock import SimClock, WallClock
+from shm_transport import CRUISE_SPEED, CommandMailbox, PoseView
+from environment_config import (
+    TRAFFIC_LIGHTS_CONFIG,
+    STOP_SIGNS_CONFIG,
+    YIELD_SIGNS_CONFIG,
+)
 
 MAP_SCALER_X = 0.03935
 MAP_SCALER_Y = -0.03607  # Note: Y-axis is inverted
@@ -40,13 +50,159 @@ LEAD_CAR_CRAWL_SPEED_THRESHOLD = 5.0
 ACC_CYCLE_DURATION = 0.5
 MAX_SPEED_PXS = 150.0
 PEDESTRIAN_CLEAR_TIMEOUT_S = 2.5
+QCAR_CLEAR_TIMEOUT_S = 1.0
+YIELD_SIGN_WAIT_TIME_S = 3.0
+LIGHT_CLEAR_TIMEOUT_S = 3.0
+# The object tracker only serves the moving-pedestrian check, so only these
+# classes are fed to it.
+TRACKED_CLASSES = ("pedestrian",)
+# --- Adaptive cruise control (see cruise_control.py) ---
+# Speed commands follow the lead QCar; "GO" (the car's own v_ref) at cruise.
+ACC_CRUISE_SPEED = 0.4
+
+# --- Event-driven loop ---
+# In event-driven mode the controller blocks on perception_queue and only
+# wakes without new data to expire the nearest timer (plus a little slack so
+# the strict ">" timeout checks have passed), or after MAX_EVENT_WAIT_S.
+MAX_EVENT_WAIT_S = 1.0
+EVENT_WAKE_SLACK_S = 0.002
+LATENCY_PRINT_INTERVAL_S = 10.0
+
+# --- Stop/go rules ---
+# Each stop reason is declared once with its timeout; each rule says which
+# detection raises or clears it and which other reasons must be clear (by
+# default: all of them). Every detection of a frame is checked against every
+# rule; per condition the first matching rule in this list wins, and all
+# conditions update in the same cycle. See rule_engine.py.
+PEDESTRIAN_ZONE_X = (100, 450)
+QCAR_TOO_CLOSE_HEIGHT = 125
+STOP_SIGN_COOLDOWN_S = 10.0
+YIELD_SIGN_MIN_WIDTH = 30
+YIELD_SIGN_COOLDOWN_S = 6.0
+
+STOP_CONDITIONS = [
+    Condition(
+        "Perception_Light",
+        LIGHT_CLEAR_TIMEOUT_S,
+        "seen",
+        seen=[
+            ("red_light", RED_LIGHT_MIN_WIDTH, RED_LIGHT_MIN_HEIGHT),
+            ("green_light", RED_LIGHT_MIN_WIDTH, RED_LIGHT_MIN_HEIGHT),
+            ("yellow_light", -math.inf, -math.inf),
+        ],
+    ),
+    Condition(
+        "Pedestrian",
+        PEDESTRIAN_CLEAR_TIMEOUT_S,
+        "seen",
+        seen=[("pedestrian", -math.inf, -math.inf)],
+    ),
+    Condition("Stop_Sign", STOP_SIGN_WAIT_TIME_S, "start"),
+    Condition("Yield_Sign", YIELD_SIGN_WAIT_TIME_S, "start"),
+    Condition(
+        "QCar_Too_Close",
+        QCAR_CLEAR_TIMEOUT_S,
+        "seen",
+        seen=[("Qcar", -math.inf, -math.inf)],
+    ),
+    Condition("QCar_Too_Close_Light"),
+    Condition("V2X_Light"),
+]
+
+STOP_RULES = [
+    Rule(
+        "Perception_Light",
+        "set",
+        "red_light",
+        min_width=RED_LIGHT_MIN_WIDTH,
+        min_height=RED_LIGHT_MIN_HEIGHT,
+    ),
+    Rule(
+        "Perception_Light",
+        "clear",
+        "green_light",
+        min_width=RED_LIGHT_MIN_WIDTH,
+        min_height=RED_LIGHT_MIN_HEIGHT,
+        requires_set=["Perception_Light"],
+    ),
+    # A close QCar always stops us, whatever else is active.
+    Rule(
+        "QCar_Too_Close",
+        "set",
+        "Qcar",
+        min_height=QCAR_TOO_CLOSE_HEIGHT,
+        requires_clear=[],
+    ),
+    Rule(
+        "QCar_Too_Close",
+        "clear",
+        "Qcar",
+        max_height=QCAR_TOO_CLOSE_HEIGHT,
+        requires_set=["QCar_Too_Close"],
+        requires_clear=[
+            "Perception_Light",
+            "V2X_Light",
+            "QCar_Too_Close_Light",
+            "Yield_Sign",
+            "Pedestrian",
+        ],
+    ),
+    Rule(
+        "Stop_Sign",
+        "set",
+        "stop_sign",
+        min_width=STOP_SIGN_MIN_WIDTH,
+        cooldown_s=STOP_SIGN_COOLDOWN_S,
+    ),
+    Rule(
+        "Yield_Sign",
+        "set",
+        "yield_sign",
+        min_width=YIELD_SIGN_MIN_WIDTH,
+        cooldown_s=YIELD_SIGN_COOLDOWN_S,
+    ),
+    # A pedestrian that is small or outside the zone in front of us clears the stop.
+    Rule(
+        "Pedestrian",
+        "clear",
+        "pedestrian",
+        min_width=PEDESTRIAN_MIN_WIDTH_FOR_STOP,
+        x_range=PEDESTRIAN_ZONE_X,
+        outside=True,
+        requires_set=["Pedestrian"],
+    ),
+    Rule(
+        "Pedestrian",
+        "set",
+        "pedestrian",
+        min_width=PEDESTRIAN_MIN_WIDTH_FOR_STOP,
+        x_range=PEDESTRIAN_ZONE_X,
+    ),
+]
 
 
 # --- V2X Configuration (for Geofencing) ---
 # We still need the LOCATIONS of the lights
-# ** IMPORTANT: IDs match environment_logic.py (4 and 3) **
+# ** IMPORTANT: IDs match environment_config.py (4 and 3) **
 # This list is used to map the statuses received from the perception module
 # (which should be in the order [ID 4, ID 3]) to the correct geofence area.
+# V2X states that stop the car while it is inside the light's geofence.
+V2X_STOP_STATES = ("RED", "YELLOW")
+V2X_PRINT_INTERVAL_S = 2.0
+
+
+def build_geofence_index():
+    """Geofence zones (map frame) around every light, stop sign and yield sign."""
+    return GeofenceIndex.from_configs(
+        {
+            "light": TRAFFIC_LIGHTS_CONFIG,
+            "stop_sign": STOP_SIGNS_CONFIG,
+            "yield_sign": YIELD_SIGNS_CONFIG,
+        },
+        scale=(MAP_SCALER_X, MAP_SCALER_Y),
+        offset=(MAP_OFFSET_X, MAP_OFFSET_Y),
+        radius=geofencing_threshold,
+    )
 
 
 # --- Helper functions ---
@@ -85,306 +241,736 @@ def get_height(results):
     return results[0]["height"] if results and "width" in results[0] else 0
 
 
+def next_timer_wait(deadlines, now):
+    """Seconds until the earliest deadline (bounded to [0, MAX_EVENT_WAIT_S])."""
+    if not deadlines:
+        return MAX_EVENT_WAIT_S
+    return min(max(min(deadlines) - now, 0.0) + EVENT_WAKE_SLACK_S, MAX_EVENT_WAIT_S)
+
+
+def detection_columns(input_data):
+    """
+    All detections of one perception message as parallel arrays
+    (class names, x, y, width, height), with x/y the top-left corner.
+    Accepts both the list-of-dicts and the columnar message format.
+    """
+    detections = input_data.get("detections", [])
+    if isinstance(detections, np.ndarray):
+        names = np.asarray(input_data["class_names"], dtype=object)[detections["cls"]]
+        return (
+            list(names),
+            detections["x"].astype(float),
+            detections["y"].astype(float),
+            detections["w"].astype(float),
+            detections["h"].astype(float),
+        )
+    return (
+        [det["class"] for det in detections],
+        np.array([det.get("x", 0.0) for det in detections], dtype=float),
+        np.array([det.get("y", 0.0) for det in detections], dtype=float),
+        np.array([det.get("width", 0.0) for det in detections], dtype=float),
+        np.array([det.get("height", det.get("width", 0.0)) for det in detections], dtype=float),
+    )
+
+
+def read_pose(shared_pose):
+    """
+    Pose snapshot (x, y, th, v, ...) from a shm_transport.PoseView, or the
+    pose dict (or Manager dict proxy) itself.
+    """
+    if isinstance(shared_pose, PoseView):
+        return shared_pose.read() or {}
+    return shared_pose
+
+
+def pick_up(input_data, last_seq, latency=None):
+    """
+    Stamp and account for a new perception message.
+
+    Returns the frame's stamps and the newest seq seen so far. Upstream drop
+    counters and seq gaps (frames that never reached the controller) go to
+    `latency` if given.
+    """
+    frame_stamps = dict(input_data.get("stamps", {}))
+    if "t_capture" in input_data:
+        frame_stamps.setdefault("t_capture", input_data["t_capture"])
+    stamp(frame_stamps, "t_pickup")
+    seq = input_data.get("seq")
+    if latency is not None:
+        latency.record_stamps(frame_stamps)
+        latency.set_dropped(input_data.get("dropped", {}))
+        if seq is not None and last_seq is not None and seq > last_seq + 1:
+            latency.count_dropped("seq_gap", seq - last_seq - 1)
+    if seq is not None:
+        last_seq = seq if last_seq is None else max(last_seq, seq)
+    return frame_stamps, last_seq
+
+
+# --- Shared by StopGoController and FleetController ---
+def controller_log(verbose, message):
+    if verbose:
+        print(message)
+
+
+def stop_rules(adaptive_cruise=False):
+    """STOP_RULES; with ACC a lead QCar sets the speed instead of QCar_Too_Close."""
+    return [
+        rule
+        for rule in STOP_RULES
+        if not (adaptive_cruise and rule.condition == "QCar_Too_Close")
+    ]
+
+
+def make_cruise_control():
+    return AdaptiveCruiseControl(
+        cruise_speed=ACC_CRUISE_SPEED,
+        safe_width=SAFE_FOLLOWING_DISTANCE_WIDTH,
+        hard_brake_width=MIN_DISTANCE_FOR_HARD_BRAKE_WIDTH,
+        width_tolerance=DISTANCE_TOLERANCE_WIDTH,
+        crawl_rate=LEAD_CAR_CRAWL_SPEED_THRESHOLD,
+        max_rate=MAX_SPEED_PXS,
+        command_period_s=ACC_CYCLE_DURATION,
+        lost_timeout_s=QCAR_CLEAR_TIMEOUT_S,
+    )
+
+
+def decision_command(command, frame_stamps, speed, reasons=0, latency=None):
+    """make_command(), recording the decision stage in `latency` if given."""
+    message = make_command(command, frame_stamps, speed, reasons)
+    if latency is not None and "t_pickup" in message["stamps"]:
+        latency.record_stamps(message["stamps"], ["decision"])
+    return message
+
+
+def cruise_command(speed, frame_stamps, latency=None):
+    """Command for an ACC target speed: plain GO at cruise speed, else GO:<speed>."""
+    if speed >= ACC_CRUISE_SPEED:
+        return decision_command("GO", frame_stamps, CRUISE_SPEED, latency=latency)
+    return decision_command(f"GO:{speed:.3f}", frame_stamps, speed, latency=latency)
+
+
+class StopGoController:
+    """
+    The decision logic of main() without queues or a clock of its own.
+
+    step(now, input_data) processes one loop iteration at time `now` (one
+    perception message or None) and returns the command messages to send;
+    next_deadline() is the earliest time at which a timer (stop timeouts,
+    stale tracks, lost ACC lead) needs another step without new data. Time
+    only comes in through `now`, so the same object runs on the wall clock
+    in main() or on simulated time in simulate().
+    """
+
+    def __init__(self, shared_pose, adaptive_cruise=False, latency=None, verbose=True):
+        self.shared_pose = shared_pose
+        self.latency = latency
+        self.verbose = verbose
+
+        # --- V2X State Variables (Local) ---
+        self.geofencing_areas = build_geofence_index()
+        self.v2x_statuses = []
+        self.current_zones = []
+        self.last_v2x_print_time = 0.0
+
+        # --- Perception State Variables ---
+        # All stop reasons (including V2X_Light) live in the rule engine's state.
+        self.rules = RuleEngine(STOP_CONDITIONS, stop_rules(adaptive_cruise))
+        self.qcar_bit = self.rules.bits["QCar_Too_Close"]
+        # One track per detected object instance (not per class).
+        self.tracker = MultiObjectTracker()
+        self.pedestrian_cls = self.tracker.class_ids(["pedestrian"])[0]
+        self.is_moving_ped = False
+
+        # --- Adaptive cruise control ---
+        self.cruise = make_cruise_control() if adaptive_cruise else None
+
+        # --- Overall Command State ---
+        self.last_command_was_stop = False
+        self.active_stop_reasons = []
+        self.last_seq = None
+
+    def step(self, current_time, input_data=None):
+        """Run one loop iteration at time current_time; returns the commands to send."""
+        commands = []
+        frame = None  # <-- FIX 1: Clear *only* perception results
+        frame_stamps = None
+        rules = self.rules
+        geofencing_areas = self.geofencing_areas
+
+        if input_data is not None:
+            frame_stamps, self.last_seq = pick_up(input_data, self.last_seq, self.latency)
+            frame = detection_columns(input_data)
+            # <-- FIX 1: *Only* update V2X status when new data arrives.
+            # It is no longer reset to [] every loop.
+            self.v2x_statuses = input_data.get("v2x_statuses", self.v2x_statuses)
+        v2x_statuses = self.v2x_statuses
+
+        # --- 2. GEOFENCING (V2X applies only inside a light's zone) ---
+        pose = read_pose(self.shared_pose)
+        self.current_zones = geofencing_areas.query(pose.get("x", 0.0), pose.get("y", 0.0))
+        light_zones = geofencing_areas.zones_of_kind(self.current_zones, "light")
+        v2x_stop = False
+        for zone in light_zones:
+            light = geofencing_areas.payloads[zone]
+            if light < len(v2x_statuses) and v2x_statuses[light] in V2X_STOP_STATES:
+                v2x_stop = True
+        rules.set_condition("V2X_Light", v2x_stop, current_time)
+
+        if light_zones and current_time - self.last_v2x_print_time > V2X_PRINT_INTERVAL_S:
+            for zone in light_zones:
+                light = geofencing_areas.payloads[zone]
+                status = v2x_statuses[light] if light < len(v2x_statuses) else "UNKNOWN"
+                controller_log(
+                    self.verbose, f"[Controller] V2X light {geofencing_areas.ids[zone]}: {status}"
+                )
+            self.last_v2x_print_time = current_time
+
+        # --- 3. PERCEPTION LOGIC (all detections of the frame at once) ---
+        self.tracker.expire(current_time, STALE_OBJECT_TIMEOUT)
+        if frame is not None and frame[0]:
+            names, det_x, det_y, det_w, det_h = frame
+            tracked = np.array([name in TRACKED_CLASSES for name in names])
+            if tracked.any():
+                self.tracker.update(
+                    current_time,
+                    self.tracker.class_ids([n for n, t in zip(names, tracked) if t]),
+                    (det_x + det_w / 2)[tracked],
+                    (det_y + det_h / 2)[tracked],
+                    det_w[tracked],
+                    det_h[tracked],
+                )
+            self.is_moving_ped = bool(
+                self.tracker.moving(self.pedestrian_cls, MOVEMENT_THRESHOLD_PX_PER_SEC).any()
+            )
+
+            # --- Perception Stop Conditions ---
+            # Size/zone thresholds are NumPy masks over the whole frame.
+            frame_cls = rules.class_ids(names)
+            rules.step(current_time, frame_cls, det_w, det_h, det_x)
+
+            if self.cruise is not None:
+                lead = select_lead(
+                    frame_cls,
+                    det_w,
+                    det_x,
+                    rules.class_id("Qcar"),
+                    CAMERA_CENTER_X,
+                    CENTER_TOLERANCE,
+                )
+                if lead is not None:
+                    self.cruise.update(current_time, det_w[lead])
+
+        # --- 4. TIMEOUT LOGIC ---
+        expired = rules.expire(current_time)
+        if expired & self.qcar_bit:
+            controller_log(self.verbose, "no longer stopped for qcar - height")
+
+        # --- 5. *** FIX 2: FINAL DECISION BLOCK (with V2X Priority) *** ---
+
+        # Calculate current reasons immediately
+        current_reasons = rules.reasons()
+        should_stop = bool(current_reasons)
+        if should_stop:
+            # Update the persistent tracker while we are stopped
+            self.active_stop_reasons = current_reasons
+
+        # Now, send the command based on the final decision
+        command_sent = should_stop != self.last_command_was_stop
+        if should_stop and not self.last_command_was_stop:
+            commands.append(
+                decision_command("STOP", frame_stamps, 0.0, rules.state, self.latency)
+            )
+            self.last_command_was_stop = True
+            controller_log(
+                self.verbose, f"[Controller] STOPPING: Reasons: {self.active_stop_reasons}"
+            )
+
+        elif not should_stop and self.last_command_was_stop:
+            commands.append(
+                decision_command("GO", frame_stamps, CRUISE_SPEED, latency=self.latency)
+            )
+            self.last_command_was_stop = False
+
+            # We use active_stop_reasons here, which holds the data from the last frame
+            # where we were still stopped.
+            controller_log(
+                self.verbose,
+                f"[Controller] RESUMING: Condition(s) cleared: {self.active_stop_reasons}"
+            )
+
+            # Optional: clear the tracker after resuming
+            self.active_stop_reasons = []
+
+        if self.cruise is not None:
+            if command_sent:
+                self.cruise.invalidate()
+            if should_stop:
+                # command() drops a lost lead, but is not called while stopped;
+                # the GO that ends the stop resumes cruise speed anyway.
+                if not self.cruise.has_lead(current_time):
+                    self.cruise.reset()
+            else:
+                speed = self.cruise.command(current_time, pose.get("v", 0.0))
+                if speed is not None:
+                    commands.append(cruise_command(speed, frame_stamps, self.latency))
+        return commands
+
+    def next_deadline(self):
+        """Earliest time a timer needs a step without new data (None if no timer runs)."""
+        deadlines = []
+        if self.rules.state:
+            deadlines.append(self.rules.next_deadline())
+        track_expiry = self.tracker.next_expiry(STALE_OBJECT_TIMEOUT)
+        if track_expiry is not None:
+            deadlines.append(track_expiry)
+        if self.cruise is not None and self.cruise.lost_deadline() is not None:
+            deadlines.append(self.cruise.lost_deadline())
+        deadlines = [d for d in deadlines if math.isfinite(d)]
+        return min(deadlines) if deadlines else None
+
+
+class FleetController:
+    """
+    StopGoController for a fleet of vehicles in one process.
+
+    Per-vehicle state lives in arrays indexed by vehicle (rule states in a
+    FleetRuleEngine, STOP/GO flags, seqs), and step() runs the rules of all
+    vehicles in one vectorized pass. All vehicles share one tracker; track
+    classes are (vehicle, class name) pairs so tracks never match across
+    vehicles. Geofence/V2X checks and ACC are per vehicle.
+    """
+
+    def __init__(self, shared_poses, adaptive_cruise=False, latency=None, verbose=True):
+        self.shared_poses = list(shared_poses)
+        self.n_vehicles = n = len(self.shared_poses)
+        self.latency = latency
+        self.verbose = verbose
+
+        self.geofencing_areas = build_geofence_index()
+        self.v2x_statuses = [[] for _ in range(n)]
+        self.last_v2x_print_time = np.zeros(n)
+
+        self.rules = FleetRuleEngine(STOP_CONDITIONS, stop_rules(adaptive_cruise), n)
+        self.qcar_bit = self.rules.bits["QCar_Too_Close"]
+        self.tracker = MultiObjectTracker()
+        # Registered first, so vehicle i's pedestrian class id is i.
+        self.pedestrian_cls = self.tracker.class_ids([(i, "pedestrian") for i in range(n)])
+        self.is_moving_ped = np.zeros(n, dtype=bool)
+
+        self.cruise = [make_cruise_control() for _ in range(n)] if adaptive_cruise else None
+
+        self.last_command_was_stop = np.zeros(n, dtype=bool)
+        # State mask of the last cycle each vehicle was stopped (for the RESUMING log).
+        self.last_stop_states = np.zeros(n, dtype=np.int64)
+        self.last_seq = [None] * n
+
+    def _update_v2x(self, current_time, poses):
+        """Raise V2X_Light for every vehicle inside the zone of a stopping light."""
+        geofencing_areas = self.geofencing_areas
+        v2x_stop = np.zeros(self.n_vehicles, dtype=bool)
+        for i, pose in enumerate(poses):
+            vehicle_zones = geofencing_areas.query(pose.get("x", 0.0), pose.get("y", 0.0))
+            light_zones = geofencing_areas.zones_of_kind(vehicle_zones, "light")
+            if not light_zones:
+                continue
+            statuses = self.v2x_statuses[i]
+            lights = [geofencing_areas.payloads[zone] for zone in light_zones]
+            v2x_stop[i] = any(
+                light < len(statuses) and statuses[light] in V2X_STOP_STATES for light in lights
+            )
+            if current_time - self.last_v2x_print_time[i] > V2X_PRINT_INTERVAL_S:
+                for zone, light in zip(light_zones, lights):
+                    status = statuses[light] if light < len(statuses) else "UNKNOWN"
+                    controller_log(
+                        self.verbose,
+                        f"[Controller-{i}] V2X light {geofencing_areas.ids[zone]}: {status}",
+                    )
+                self.last_v2x_print_time[i] = current_time
+        self.rules.set_conditions("V2X_Light", v2x_stop, current_time)
+
+    def step(self, current_time, inputs):
+        """
+        Run one loop iteration for every vehicle; inputs[i] is vehicle i's
+        new perception message or None. Returns (vehicle, command message) pairs.
+        """
+        commands = []
+        rules = self.rules
+        frame_stamps = [None] * self.n_vehicles
+        vehicles, names, xs, ys, ws, hs = [], [], [], [], [], []
+        for i, input_data in enumerate(inputs):
+            if input_data is None:
+                continue
+            frame_stamps[i], self.last_seq[i] = pick_up(input_data, self.last_seq[i], self.latency)
+            self.v2x_statuses[i] = input_data.get("v2x_statuses", self.v2x_statuses[i])
+            frame_names, x, y, w, h = detection_columns(input_data)
+            vehicles.append(np.full(len(frame_names), i, dtype=np.int64))
+            names.extend(frame_names)
+            xs.append(x)
+            ys.append(y)
+            ws.append(w)
+            hs.append(h)
+
+        poses = [read_pose(shared_pose) for shared_pose in self.shared_poses]
+        self._update_v2x(current_time, poses)
+
+        # --- Perception: the detections of every vehicle in one pass ---
+        self.tracker.expire(current_time, STALE_OBJECT_TIMEOUT)
+        if names:
+            vehicle = np.concatenate(vehicles)
+            det_x, det_y, det_w, det_h = (np.concatenate(a) for a in (xs, ys, ws, hs))
+            tracked = np.array([name in TRACKED_CLASSES for name in names])
+            if tracked.any():
+                self.tracker.update(
+                    current_time,
+                    self.tracker.class_ids(
+                        [(int(v), n) for v, n, t in zip(vehicle, names, tracked) if t]
+                    ),
+                    (det_x + det_w / 2)[tracked],
+                    (det_y + det_h / 2)[tracked],
+                    det_w[tracked],
+                    det_h[tracked],
+                )
+            moving = self.tracker.moving(self.pedestrian_cls, MOVEMENT_THRESHOLD_PX_PER_SEC)
+            seen = np.zeros(self.n_vehicles, dtype=bool)
+            seen[vehicle] = True
+            self.is_moving_ped[seen] = False
+            self.is_moving_ped[self.tracker.cls[moving]] = True
+
+            frame_cls = rules.class_ids(names)
+            rules.step(current_time, vehicle, frame_cls, det_w, det_h, det_x)
+
+            if self.cruise is not None:
+                qcar_cls = rules.class_id("Qcar")
+                for i in np.unique(vehicle[frame_cls == qcar_cls]):
+                    own = vehicle == i
+                    lead = select_lead(
+                        frame_cls[own], det_w[own], det_x[own], qcar_cls,
+                        CAMERA_CENTER_X, CENTER_TOLERANCE,
+                    )
+                    if lead is not None:
+                        self.cruise[i].update(current_time, det_w[own][lead])
+
+        # --- Timeouts ---
+        expired = rules.expire(current_time)
+        for i in np.flatnonzero(expired & self.qcar_bit):
+            controller_log(self.verbose, f"[Controller-{i}] no longer stopped for qcar - height")
+
+        # --- STOP/GO decisions ---
+        should_stop = rules.states != 0
+        self.last_stop_states = np.where(should_stop, rules.states, self.last_stop_states)
+        command_sent = should_stop != self.last_command_was_stop
+        for i in np.flatnonzero(command_sent):
+            reasons = rules.reasons(int(self.last_stop_states[i]))
+            if should_stop[i]:
+                commands.append(
+                    (
+                        i,
+                        decision_command(
+                            "STOP", frame_stamps[i], 0.0, int(rules.states[i]), self.latency
+                        ),
+                    )
+                )
+                controller_log(self.verbose, f"[Controller-{i}] STOPPING: Reasons: {reasons}")
+            else:
+                commands.append(
+                    (i, decision_command("GO", frame_stamps[i], CRUISE_SPEED, latency=self.latency))
+                )
+                controller_log(
+                    self.verbose, f"[Controller-{i}] RESUMING: Condition(s) cleared: {reasons}"
+                )
+        self.last_command_was_stop = should_stop
+
+        if self.cruise is not None:
+            for i, cruise in enumerate(self.cruise):
+                if command_sent[i]:
+                    cruise.invalidate()
+                if should_stop[i]:
+                    # Drop a lead lost while stopped (see StopGoController.step).
+                    if not cruise.has_lead(current_time):
+                        cruise.reset()
+                    continue
+                speed = cruise.command(current_time, poses[i].get("v", 0.0))
+                if speed is not None:
+                    commands.append((i, cruise_command(speed, frame_stamps[i], self.latency)))
+        return commands
+
+    def next_deadline(self):
+        """Earliest time any vehicle's timer needs a step without new data (None if none runs)."""
+        deadlines = []
+        if self.rules.states.any():
+            deadlines.append(self.rules.next_deadline())
+        track_expiry = self.tracker.next_expiry(STALE_OBJECT_TIMEOUT)
+        if track_expiry is not None:
+            deadlines.append(track_expiry)
+        if self.cruise is not None:
+            deadlines.extend(
+                cruise.lost_deadline()
+                for cruise in self.cruise
+                if cruise.lost_deadline() is not None
+            )
+        deadlines = [d for d in deadlines if math.isfinite(d)]
+        return min(deadlines) if deadlines else None
+
+
 # --- MODIFIED: Main function signature (simplified) ---
 def main(
     perception_queue: multiprocessing.Queue,
     command_queue: multiprocessing.Queue,
-    shared_pose: DictProxy,
+    shared_pose,
+    event_driven=False,
+    adaptive_cruise=False,
+    latency_export_path=None,
+    clock=None,
+    stop_event=None,
 ):
-
-    # --- V2X State Variables (Local) ---
-    is_stopped_v2x_light = False
-    geofencing_areas = []
-    has_stopped_at = {}
-
-    # --- Perception State Variables ---
-    is_stopped_light = False  # For perception-based red light
-    is_stopped_pedestrian = False
-    tracked_objects = {}
-    is_moving_ped = False
-    is_stopped_yield_sign = False
-    is_stopped_for_sign = False
-    is_stopped_qcar_red_light = False
-    stop_sign_start_time = 0
-    yield_sign_sign_start_time = 0
-    last_green_light_seen_time = 0
-    red_light_start_time = 0
-    is_stopped_qcar = False
-    last_stop_qcar = 0
-    last_pedestrian_seen_time = 0
-    last_stop_seen_time = 0
-    last_yield_sign_seen_time = 0
-    last_red_light_seen_time = 0
-    last_qcar_seen_time = 0
-    last_light_seen_time = 0
-
-    # --- Overall Command State ---
-    last_command_was_stop = False
-
-    # --- NEW: Timer for printing V2X status ---
-    last_v2x_print_time = 0.0
+    """
+    Stop/go decision loop, until stop_event (a multiprocessing.Event) is
+    set or the process is interrupted.
+
+    By default the queue is polled at 20 Hz. With event_driven=True the loop
+    blocks on perception_queue, reacts to each frame as soon as it arrives
+    and otherwise only wakes to expire the nearest timeout.
+
+    With adaptive_cruise=True a lead QCar no longer triggers a full stop:
+    continuous "GO:<speed>" commands keep a safe gap to it instead, braking
+    to zero on a short time-to-collision.
+
+    Commands are latency.make_command() dicts carrying the seq and stamps
+    of the frame that caused them. command_queue may also be the name of
+    a shm_transport.CommandMailbox (created by the control loop), which
+    takes the same messages but never blocks or loses the latest one.
+    Per-stage latency histograms are printed every LATENCY_PRINT_INTERVAL_S
+    and on exit, and written as JSON to latency_export_path if given.
+
+    shared_pose is a shm_transport.PoseView (or a pose dict); each cycle
+    reads one consistent snapshot of it.
+
+    All decision timing reads `clock` (default: sim_clock.WallClock); the
+    logic itself is StopGoController. See simulate() for running it on
+    recorded or synthetic detections faster than real time.
+    """
+    clock = clock or WallClock()
+    if isinstance(command_queue, str):
+        command_queue = CommandMailbox.attach(command_queue, timeout=10.0)
+
+    # --- Latency measurement (monotonic clock, like perception's stamps) ---
+    latency = LatencyStats("controller")
+    last_latency_print = time.monotonic()
+    next_wait_s = 0.0
+
+    controller = StopGoController(shared_pose, adaptive_cruise, latency)
 
     try:
         # --- Main Control Loop (Continuous) ---
-        while True:
-            current_time = time.time()
-
+        while stop_event is None or not stop_event.is_set():
             # --- 1. GET BUNDLED DATA from Perception Module ---
-            results = []  # <-- FIX 1: Clear *only* perception results
-
-            if not perception_queue.empty():
+            input_data = None
+            if event_driven:
+                try:
+                    input_data = perception_queue.get(timeout=next_wait_s)
+                except queue.Empty:
+                    pass
+            elif not perception_queue.empty():
                 input_data = perception_queue.get()
-                results = input_data.get("detections", [])
-                # <-- FIX 1: *Only* update V2X status when new data arrives.
-                # It is no longer reset to [] every loop.
-
-            # --- 3. PERCEPTION LOGIC (uses 'results' from queue) ---
-            stale_keys = []
-            for key, data in tracked_objects.items():
-                if current_time - data["time"] > STALE_OBJECT_TIMEOUT:
-                    stale_keys.append(key)
-            for key in stale_keys:
-                del tracked_objects[key]
-
-            if any_detected_objects(results):
-                for i, det in enumerate(results):
-                    # Check for QCar with your specific priority height (e.g., > 70 or > 100)
-                    if det["class"] == "Qcar" and det.get("height", 0) > 125:
-                        # Move this detection to the top of the list (Index 0)
-                        results.insert(0, results.pop(i))
-                        break
-                cls = get_cls(results)
-                width = get_width(results)
-                height = get_height(results)
-                position = get_position(results)
-                x = get_x(results)
-                is_moving_ped = False
-
-                # Update timestamps
-                if cls == "Qcar":
-                    last_qcar_seen_time = current_time
-                # print(height)
-                # print("Qcar width is: ", width)
-                # print("Qcar height is: ", height)
-                # print(
-                #     "These many seconds have passed since we saw a red light: ",
-                #     current_time - last_red_light_seen_time,
-                # )
-                if (cls == "red_light" or cls == "green_light") and (
-                    width > RED_LIGHT_MIN_WIDTH and height > RED_LIGHT_MIN_HEIGHT
-                ):
-                    last_light_seen_time = current_time
-                if cls == "pedestrian":
-                    last_pedestrian_seen_time = current_time
-                if cls == "stop_sign":
-                    last_stop_seen_time = current_time
-                if cls == "yield_sign":
-                    last_yield_sign_seen_time = current_time
-                if cls == "red_light":
-                    last_red_light_seen_time = current_time
-                if cls == "green_light":
-                    last_green_light_seen_time = current_time
-
-                if cls == "yellow_light":
-                    last_light_seen_time = current_time
-
-                # print("last light seen time was: ", last_light_seen_time)
-                # print("current time is: ", current_time)
-                if position and cls in tracked_objects:
-                    last_pos = tracked_objects[cls]["position"]
-                    last_time = tracked_objects[cls]["time"]
-                    delta_time = current_time - last_time
-                    if delta_time > 0:
-                        distance = math.hypot(
-                            position[0] - last_pos[0], position[1] - last_pos[1]
-                        )
-                        speed_px_per_sec = distance / delta_time
-                        if cls == "pedestrian" and (
-                            speed_px_per_sec > MOVEMENT_THRESHOLD_PX_PER_SEC
-                        ):
-                            is_moving_ped = True
-                if position:
-                    tracked_objects[cls] = {
-                        "position": position,
-                        "time": current_time,
-                    }
-
-                # --- Perception Stop Conditions ---
-                if (
-                    cls == "red_light"
-                    and width > RED_LIGHT_MIN_WIDTH
-                    and height > RED_LIGHT_MIN_HEIGHT
-                    and not is_stopped_for_sign
-                    and not is_stopped_light
-                    and not is_stopped_qcar
-                    and not is_stopped_qcar_red_light
-                    and not is_stopped_yield_sign
-                    and not is_stopped_v2x_light
-                    and not is_stopped_pedestrian
-                ):
-                    is_stopped_light = True
-                    red_light_start_time = current_time
-
-                elif (
-                    cls == "green_light"
-                    and width > RED_LIGHT_MIN_WIDTH
-                    and height > RED_LIGHT_MIN_HEIGHT
-                    and not is_stopped_for_sign
-                    and is_stopped_light
-                    and not is_stopped_v2x_light
-                    and not is_stopped_qcar
-                    and not is_stopped_qcar_red_light
-                    and not is_stopped_yield_sign
-                    and not is_stopped_pedestrian
-                ):
-                    is_stopped_light = False
-
-                elif cls == "Qcar" and height > 125:  # Simplified QCar following
-                    is_stopped_qcar = True
-                    last_stop_qcar = current_time
-                    # print("stopped because qcar too close - height")
-
-                elif (
-                    cls == "Qcar"
-                    and is_stopped_qcar
-                    and not is_stopped_light
-                    and not is_stopped_v2x_light
-                    and not is_stopped_qcar_red_light
-                    and not is_stopped_yield_sign
-                    and not is_stopped_pedestrian
-                    and height <= 125
-                ):
-                    is_stopped_qcar = False
-                    # print("Resumed because qcar far enough - height")
-
-                elif (
-                    cls == "stop_sign"
-                    and not is_stopped_for_sign  # Only trigger once
-                    and width > STOP_SIGN_MIN_WIDTH
-                    and current_time - stop_sign_start_time > 10  # Cooldown
-                    and not is_stopped_light
-                    and not is_stopped_v2x_light
-                    and not is_stopped_qcar
-                    and not is_stopped_qcar_red_light
-                    and not is_stopped_yield_sign
-                    and not is_stopped_pedestrian
-                ):
-                    is_stopped_for_sign = True
-                    stop_sign_start_time = current_time
-
-                elif (
-                    cls == "yield_sign"
-                    and not is_stopped_yield_sign  # Only trigger once
-                    and not is_stopped_light
-                    and not is_stopped_v2x_light
-                    and not is_stopped_qcar
-                    and not is_stopped_qcar_red_light
-                    and not is_stopped_for_sign
-                    and not is_stopped_pedestrian
-                    and width > 30
-                    and current_time - yield_sign_sign_start_time > 6
-                ):
-                    is_stopped_yield_sign = True
-                    yield_sign_sign_start_time = current_time
-
-                elif (
-                    cls == "pedestrian"
-                    and (not 100 < x < 450 or width < PEDESTRIAN_MIN_WIDTH_FOR_STOP)
-                    and is_stopped_pedestrian
-                    and not is_stopped_yield_sign  # Only trigger once
-                    and not is_stopped_light
-                    and not is_stopped_v2x_light
-                    and not is_stopped_qcar
-                    and not is_stopped_qcar_red_light
-                    and not is_stopped_for_sign
-                ):
-                    is_stopped_pedestrian = False
-                elif (
-                    cls == "pedestrian"
-                    and width > PEDESTRIAN_MIN_WIDTH_FOR_STOP
-                    and 100 < x < 450
-                    and not is_stopped_yield_sign  # Only trigger once
-                    and not is_stopped_light
-                    and not is_stopped_v2x_light
-                    and not is_stopped_qcar
-                    and not is_stopped_qcar_red_light
-                    and not is_stopped_for_sign
-                    and not is_stopped_pedestrian
-                ):
-                    is_stopped_pedestrian = True
-
-            # --- 4. TIMEOUT LOGIC ---
-            if is_stopped_pedestrian and (
-                current_time - last_pedestrian_seen_time > PEDESTRIAN_CLEAR_TIMEOUT_S
-            ):
-                is_stopped_pedestrian = False
-
-            if is_stopped_qcar and (current_time - last_qcar_seen_time > 1):
-                is_stopped_qcar = False
-                print("no longer stopped for qcar - height")
-
-            if is_stopped_for_sign and (
-                current_time - stop_sign_start_time > STOP_SIGN_WAIT_TIME_S
-            ):
-                is_stopped_for_sign = False
-
-            if is_stopped_yield_sign and (
-                current_time - yield_sign_sign_start_time > 3
-            ):
-                is_stopped_yield_sign = False
-            if is_stopped_light and (current_time - last_light_seen_time > 3):
-                is_stopped_light = False
-
-            # --- 5. *** FIX 2: FINAL DECISION BLOCK (with V2X Priority) *** ---
-
-            should_stop = False
-
-            # Priority 1: V2X Rules (as you requested)
-
-            all_perception_conditions = {
-                "Perception_Light": is_stopped_light,
-                "Pedestrian": is_stopped_pedestrian,
-                "Stop_Sign": is_stopped_for_sign,
-                "Yield_Sign": is_stopped_yield_sign,
-                "QCar_Too_Close": is_stopped_qcar,
-                "QCar_Too_Close_Light": is_stopped_qcar_red_light,
-                "V2X_Light": is_stopped_v2x_light,
-            }
-
-            # Calculate current reasons immediately
-            current_reasons = [k for k, v in all_perception_conditions.items() if v]
-
-            if current_reasons:
-                should_stop = True
-                # Update the persistent tracker while we are stopped
-                active_stop_reasons = current_reasons
-            else:
-                should_stop = False
-
-            # Now, send the command based on the final decision
-            if should_stop and not last_command_was_stop:
-                command_queue.put("STOP")
-                last_command_was_stop = True
-                print(f"[Controller] STOPPING: Reasons: {active_stop_reasons}")
-
-            elif not should_stop and last_command_was_stop:
-                command_queue.put("GO")
-                last_command_was_stop = False
-
-                # We use active_stop_reasons here, which holds the data from the last frame
-                # where we were still stopped.
-                print(
-                    f"[Controller] RESUMING: Condition(s) cleared: {active_stop_reasons}"
-                )
 
-                # Optional: clear the tracker after resuming
-                active_stop_reasons = []
+            for message in controller.step(clock.now(), input_data):
+                if command_queue.full():
+                    latency.count_dropped("command_queue_blocked")
+                command_queue.put(message)
+
+            if time.monotonic() - last_latency_print > LATENCY_PRINT_INTERVAL_S:
+                latency.print("[Controller]")
+                last_latency_print = time.monotonic()
 
             # --- 6. LOOP DELAY ---
-            time.sleep(0.05)  # Poll V2X and perception at 20Hz
+            if event_driven:
+                # Wait for the next frame, but no longer than the nearest timer.
+                deadline = controller.next_deadline()
+                next_wait_s = next_timer_wait(
+                    [] if deadline is None else [deadline], clock.now()
+                )
+            else:
+                clock.sleep(0.05)  # Poll V2X and perception at 20Hz
 
     except KeyboardInterrupt:
         print("[Controller] Shutdown requested.")
     finally:
         # --- REMOVED: QLabs Cleanup ---
+        mode = "event-driven" if event_driven else "20 Hz polling"
+        latency.print(f"[Controller] ({mode})")
+        if latency_export_path is not None:
+            latency.export(latency_export_path)
+            print(f"[Controller] Latency histograms written to '{latency_export_path}'.")
         print("[Controller] Process terminated.")
+
+
+def fleet_main(
+    perception_queues,
+    command_queues,
+    shared_poses,
+    adaptive_cruise=False,
+    latency_export_path=None,
+    clock=None,
+    stop_event=None,
+):
+    """
+    Stop/go decision loop for a fleet in one process (FleetController),
+    until stop_event is set.
+
+    Vehicle i reads perception_queues[i], sends to command_queues[i] (a
+    Queue, CommandMailbox or mailbox name) and is located by
+    shared_poses[i]. All queues are polled at 20 Hz, taking at most one
+    message per vehicle per cycle like main().
+    """
+    clock = clock or WallClock()
+    command_queues = [
+        CommandMailbox.attach(q, timeout=10.0) if isinstance(q, str) else q
+        for q in command_queues
+    ]
+    latency = LatencyStats("fleet_controller")
+    last_latency_print = time.monotonic()
+    controller = FleetController(shared_poses, adaptive_cruise, latency)
+    print(f"[Controller] Fleet mode for {controller.n_vehicles} vehicles.")
+
+    try:
+        while stop_event is None or not stop_event.is_set():
+            inputs = []
+            for perception_queue in perception_queues:
+                try:
+                    inputs.append(perception_queue.get_nowait())
+                except queue.Empty:
+                    inputs.append(None)
+
+            for vehicle, message in controller.step(clock.now(), inputs):
+                command_queue = command_queues[vehicle]
+                if command_queue.full():
+                    latency.count_dropped("command_queue_blocked")
+                command_queue.put(message)
+
+            if time.monotonic() - last_latency_print > LATENCY_PRINT_INTERVAL_S:
+                latency.print("[Controller]")
+                last_latency_print = time.monotonic()
+            clock.sleep(0.05)
+
+    except KeyboardInterrupt:
+        print("[Controller] Shutdown requested.")
+    finally:
+        latency.print("[Controller] (fleet)")
+        if latency_export_path is not None:
+            latency.export(latency_export_path)
+            print(f"[Controller] Latency histograms written to '{latency_export_path}'.")
+
+
+# --- Simulated-time driver ---
+def simulate(
+    stream,
+    shared_pose=None,
+    adaptive_cruise=False,
+    poll_period_s=None,
+    end_time=None,
+    verbose=False,
+):
+    """
+    Run the decision logic on a stream of (t, input_data) messages in
+    simulated time, as fast as it can compute.
+
+    Messages carry their own timestamps (e.g. a recording's t_capture) and
+    must be in time order. By default the controller steps like the
+    event-driven loop: at every message and whenever a timer is due in
+    between (plus EVENT_WAKE_SLACK_S). With poll_period_s it steps like the
+    polling loop instead, seeing only the newest message of each period.
+    shared_pose may be a dict or a callable t -> dict (e.g. a simulated car).
+
+    Returns the decisions as a list of (t, command string) tuples.
+    """
+    clock = SimClock()
+    pose = shared_pose if callable(shared_pose) else (lambda t, p=shared_pose or {}: p)
+    controller = StopGoController(pose(clock.now()), adaptive_cruise, verbose=verbose)
+    decisions = []
+
+    def step(t, input_data):
+        clock.advance_to(t)
+        controller.shared_pose = pose(clock.now())
+        for message in controller.step(clock.now(), input_data):
+            decisions.append((clock.now(), command_text(message)))
+
+    def run_timers_until(t):
+        while True:
+            deadline = controller.next_deadline()
+            if deadline is None or deadline + EVENT_WAKE_SLACK_S >= t:
+                return
+            step(deadline + EVENT_WAKE_SLACK_S, None)
+
+    if poll_period_s is None:
+        for t, input_data in stream:
+            run_timers_until(t)
+            step(t, input_data)
+        if end_time is not None:
+            run_timers_until(end_time)
+            step(end_time, None)
+        return decisions
+
+    # Poll k is at t0 + k * poll_period_s, computed from the count rather
+    # than accumulated, so the grid does not drift against message times.
+    t0 = None
+    k = 0
+    latest = None
+    for t, input_data in stream:
+        if t0 is None:
+            clock.advance_to(t)
+            t0 = t
+        while t0 + k * poll_period_s < t:
+            step(t0 + k * poll_period_s, latest)
+            latest = None
+            k += 1
+        latest = input_data
+    if t0 is not None:
+        end = t0 + k * poll_period_s if end_time is None else end_time
+        while t0 + k * poll_period_s <= end:
+            step(t0 + k * poll_period_s, latest)
+            latest = None
+            k += 1
+    return decisions
+
+
+def simulate_fleet(stream, n_vehicles, shared_poses=None, poll_period_s=0.05, verbose=False):
+    """
+    Run FleetController on a stream of (t, vehicle, input_data) messages in
+    simulated time, polling like fleet_main(): every poll_period_s each
+    vehicle's newest message since the last cycle is processed.
+    shared_poses is a list of pose dicts (default: all at the origin).
+
+    Returns the decisions as a list of (t, vehicle, command string) tuples.
+    """
+    clock = SimClock()
+    shared_poses = shared_poses or [{} for _ in range(n_vehicles)]
+    controller = FleetController(shared_poses, verbose=verbose)
+    decisions = []
+    latest = [None] * n_vehicles
+
+    def step(t):
+        clock.advance_to(t)
+        for vehicle, message in controller.step(clock.now(), latest):
+            decisions.append((clock.now(), vehicle, command_text(message)))
+        latest[:] = [None] * n_vehicles
+
+    # Poll k is at t0 + k * poll_period_s (see simulate()).
+    t0 = None
+    k = 0
+    for t, vehicle, input_data in stream:
+        if t0 is None:
+            t0 = t
+        while t0 + k * poll_period_s < t:
+            step(t0 + k * poll_period_s)
+            k += 1
+        latest[vehicle] = input_data
+    if t0 is not None:
+        step(t0 + k * poll_period_s)
+        # Keep polling until the running timers have expired.
+        while True:
+            deadline = controller.next_deadline()
+            if deadline is None:
+                break
+            k += max(math.ceil((deadline - (t0 + k * poll_period_s)) / poll_period_s), 1)
+            step(t0 + k * poll_period_s)
+    return decisions
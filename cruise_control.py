@@ -0,0 +1,147 @@
+# cruise_control.py
+# Adaptive cruise control behind a lead QCar, from the camera alone.
+#
+# The lead car's bounding-box width w is tracked over time with an alpha-beta
+# filter. With a pinhole camera, range is inversely proportional to w, and
+# time-to-collision follows directly from the scale change: TTC = w / (dw/dt),
+# without knowing the range calibration. The speed command follows the lead
+# car at a safe gap and brakes to zero on a short TTC or a very close lead.
+import math
+import numpy as np
+
+# Gap at which the lead car's box is safe_width pixels wide (calibrate on the track).
+ACC_SAFE_GAP_M = 1.0
+ACC_GAP_GAIN = 0.5  # (m/s) per metre of gap error
+ACC_MIN_TTC_S = 1.5
+ACC_SPEED_STEP = 0.02  # do not resend commands that differ by less (m/s)
+# alpha-beta filter on the box width
+ACC_WIDTH_ALPHA = 0.5
+ACC_WIDTH_BETA = 0.2
+
+
+def select_lead(cls, width, x, lead_cls, center_x, center_tolerance):
+    """
+    Index of the lead vehicle in a frame (the widest box of class lead_cls
+    whose center is within center_tolerance of center_x), or None.
+    """
+    center = x + width / 2
+    candidates = (cls == lead_cls) & (np.abs(center - center_x) < center_tolerance)
+    if not candidates.any():
+        return None
+    return int(np.argmax(np.where(candidates, width, -np.inf)))
+
+
+class AdaptiveCruiseControl:
+    """
+    Continuous speed command for following a lead vehicle.
+
+    Widths and width rates are in pixels and pixels/second. update() feeds a
+    lead-car width measurement; command() returns a new speed to send (m/s),
+    or None when nothing new needs sending. Commands are rate limited to one
+    per command_period_s, except braking to zero which is sent at once.
+    """
+
+    def __init__(
+        self,
+        cruise_speed,
+        safe_width,
+        hard_brake_width,
+        width_tolerance,
+        crawl_rate,
+        max_rate,
+        command_period_s,
+        lost_timeout_s,
+    ):
+        self.cruise_speed = cruise_speed
+        self.safe_width = safe_width
+        self.hard_brake_width = hard_brake_width
+        self.width_tolerance = width_tolerance
+        self.crawl_rate = crawl_rate
+        self.max_rate = max_rate
+        self.command_period_s = command_period_s
+        self.lost_timeout_s = lost_timeout_s
+        self.reset()
+
+    def reset(self):
+        self.width = None
+        self.width_rate = 0.0
+        self.t_width = None
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the last command (another command was sent), so the next one goes out at once."""
+        self.last_sent = None
+        self.t_sent = -math.inf
+
+    # --- Estimation ---
+    def update(self, now, width):
+        """Feed the lead car's box width measured at time `now`."""
+        if self.width is None:
+            self.width = float(width)
+            self.width_rate = 0.0
+            self.t_width = now
+            return
+        dt = now - self.t_width
+        if dt <= 0:
+            return
+        predicted = self.width + self.width_rate * dt
+        residual = width - predicted
+        self.width = predicted + ACC_WIDTH_ALPHA * residual
+        rate = self.width_rate + ACC_WIDTH_BETA * residual / dt
+        # Box jitter between frames can look like absurd closing speeds.
+        self.width_rate = float(np.clip(rate, -self.max_rate, self.max_rate))
+        self.t_width = now
+
+    def has_lead(self, now):
+        return self.width is not None and now - self.t_width <= self.lost_timeout_s
+
+    def lost_deadline(self):
+        """Time at which the current lead is dropped (None without a lead)."""
+        return None if self.width is None else self.t_width + self.lost_timeout_s
+
+    def range_m(self):
+        return ACC_SAFE_GAP_M * self.safe_width / self.width
+
+    def closing_speed(self):
+        """Closing speed in m/s (positive when the gap shrinks)."""
+        if abs(self.width_rate) < self.crawl_rate:
+            return 0.0
+        return self.range_m() * self.width_rate / self.width
+
+    def ttc(self):
+        """Time-to-collision in seconds (inf when not closing)."""
+        if self.width_rate < self.crawl_rate:
+            return math.inf
+        return self.width / self.width_rate
+
+    # --- Control ---
+    def target_speed(self, ego_speed):
+        if self.width >= self.hard_brake_width or self.ttc() < ACC_MIN_TTC_S:
+            return 0.0
+        lead_speed = max(ego_speed - self.closing_speed(), 0.0)
+        gap_error = self.range_m() - ACC_SAFE_GAP_M
+        if abs(self.width - self.safe_width) <= self.width_tolerance:
+            gap_error = 0.0
+        return float(np.clip(lead_speed + ACC_GAP_GAIN * gap_error, 0.0, self.cruise_speed))
+
+    def command(self, now, ego_speed):
+        """
+        Speed to send now, or None. Returns cruise_speed once after the lead
+        has been lost, then nothing until a new lead appears.
+        """
+        if not self.has_lead(now):
+            if self.width is not None:
+                self.reset()
+                self.last_sent = self.cruise_speed
+                self.t_sent = now
+                return self.cruise_speed
+            return None
+        speed = self.target_speed(ego_speed)
+        braking = speed == 0.0 and self.last_sent != 0.0
+        if not braking and now - self.t_sent < self.command_period_s:
+            return None
+        if self.last_sent is not None and abs(speed - self.last_sent) < ACC_SPEED_STEP:
+            return None
+        self.last_sent = speed
+        self.t_sent = now
+        return speed
@@ -0,0 +1,19 @@
+# detections.py
+# Columnar detection format shared by perception, the frame log and the
+# controller. Kept free of torch/ultralytics/QLabs imports so tools that only
+# handle recorded detections load without the inference stack.
+import numpy as np
+
+# One record per box. x/y are the top-left corner, like the dict output;
+# t_capture is the time.monotonic() stamp of the camera frame.
+DETECTION_DTYPE = np.dtype(
+    [
+        ("cls", np.int16),
+        ("x", np.float32),
+        ("y", np.float32),
+        ("w", np.float32),
+        ("h", np.float32),
+        ("conf", np.float32),
+        ("t_capture", np.float64),
+    ]
+)
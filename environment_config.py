@@ -0,0 +1,22 @@
+# environment_config.py
+# Where the traffic lights, stop signs and yield signs of the scene are, in
+# QLabs world coordinates. Plain data: the controller builds its geofence
+# zones from it without importing any QLabs modules. (environment_logic.py
+# spawns the node-following map from its own coordinates.)
+
+TRAFFIC_LIGHTS_CONFIG = [
+    {"id": 4, "location": [23.667, 9.893, 0.005], "rotation": [0, 0, 0]},
+    {"id": 3, "location": [-21.122, 9.341, 0.005], "rotation": [0, 0, 180]},
+]
+STOP_SIGNS_CONFIG = [
+    {"id": 100, "location": [-6.238, 6.47, 0.2], "rotation": [0, 0, 180]},
+    {"id": 101, "location": [-2.067, 16.986, 0.215], "rotation": [0, 0, 90]},
+    {"id": 102, "location": [7.989, 13.371, 0.215], "rotation": [0, 0, 360]},
+    {"id": 103, "location": [4.733, 2.166, 0.215], "rotation": [0, 0, 270]},
+    # {"id": 104, "location": [16.412, -13.551, 0.2], "rotation": [0, 0, 180]},
+]
+YIELD_SIGNS_CONFIG = [
+    {"id": 200, "location": [25.007, 32.494, 0.2], "rotation": [0, 0, -90]},
+    {"id": 201, "location": [5.25, 39.477, 0.215], "rotation": [0, 0, 180]},
+    {"id": 202, "location": [11.136, 28.326, 0.215], "rotation": [0, 0, 225]},
+]
@@ -0,0 +1,462 @@
+# frame_log.py
+# Record-and-replay of perception input/output without a live QLabs instance.
+#
+# A log is one memory-mapped file: a small header (magic, record count, JSON
+# metadata with frame shape and class names) followed by fixed-size records
+# holding the camera frame, its capture timestamp, the V2X statuses and the
+# detections in detections.DETECTION_DTYPE form.
+#
+#   python frame_log.py info run.qlog
+#   python frame_log.py bench run.qlog --backend onnx            # replay through run_perception
+#   python frame_log.py bench run.qlog --controller-only         # replay detections into controller_qcar
+#   python frame_log.py simulate run.qlog --repeat 100           # controller decisions in simulated time
+#   python frame_log.py export-frames run.qlog frames/ --every 10 # e.g. INT8 calibration frames
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import multiprocessing as mp
+import cv2
+import numpy as np
+
+from detections import DETECTION_DTYPE
+from shm_transport import MAX_V2X_LIGHTS, PoseBuffer, decode_v2x, encode_v2x
+from latency import command_text
+
+LOG_MAGIC = b"QCARLOG1"
+LOG_HEADER_BYTES = 4096
+LOG_CAPACITY_FRAMES = 3000
+MAX_LOG_DETECTIONS = 64
+
+
+def record_dtype(frame_shape):
+    return np.dtype(
+        [
+            ("t_capture", np.float64),
+            ("frame", np.uint8, tuple(frame_shape)),
+            ("v2x", np.int8, (MAX_V2X_LIGHTS,)),
+            ("n_detections", np.int16),
+            ("detections", DETECTION_DTYPE, (MAX_LOG_DETECTIONS,)),
+        ]
+    )
+
+
+class FrameLogWriter:
+    """Appends records to a preallocated memory-mapped log (up to `capacity` frames)."""
+
+    def __init__(self, path, frame_shape, class_names=(), capacity=LOG_CAPACITY_FRAMES):
+        self.path = path
+        self.capacity = capacity
+        self.dtype = record_dtype(frame_shape)
+        metadata = json.dumps(
+            {"frame_shape": list(frame_shape), "class_names": list(class_names)}
+        ).encode()
+        if 24 + len(metadata) > LOG_HEADER_BYTES:
+            raise ValueError("Log metadata does not fit in the header")
+
+        with open(path, "wb") as f:
+            f.write(LOG_MAGIC)
+            f.write(np.int64(0).tobytes())
+            f.write(np.int64(len(metadata)).tobytes())
+            f.write(metadata)
+            f.truncate(LOG_HEADER_BYTES + capacity * self.dtype.itemsize)
+        self._count = np.memmap(path, dtype=np.int64, mode="r+", offset=8, shape=(1,))
+        self.records = np.memmap(
+            path, dtype=self.dtype, mode="r+", offset=LOG_HEADER_BYTES, shape=(capacity,)
+        )
+        self.n_records = 0
+        self.truncated = 0
+
+    def append(self, t_capture, frame, v2x_statuses=(), detections=None):
+        """Store one frame; returns False once the log is full."""
+        if self.n_records >= self.capacity:
+            self.truncated += 1
+            return False
+        record = self.records[self.n_records]
+        record["t_capture"] = t_capture
+        record["frame"] = frame
+        encode_v2x(v2x_statuses, record["v2x"])
+        n = 0
+        if detections is not None:
+            n = min(len(detections), MAX_LOG_DETECTIONS)
+            record["detections"][:n] = detections[:n]
+        record["n_detections"] = n
+        self.n_records += 1
+        # The count is published last so a reader never sees a half-written record.
+        self._count[0] = self.n_records
+        return True
+
+    def close(self):
+        self.records.flush()
+        self._count.flush()
+        self.records = self._count = None
+
+
+class FrameLogReader:
+    """Read-only view of a log written by FrameLogWriter."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(8) != LOG_MAGIC:
+                raise ValueError(f"'{path}' is not a frame log")
+            n_records = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+            meta_len = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+            metadata = json.loads(f.read(meta_len))
+        self.frame_shape = tuple(metadata["frame_shape"])
+        self.class_names = tuple(metadata["class_names"])
+        self.dtype = record_dtype(self.frame_shape)
+        self.records = np.memmap(
+            path, dtype=self.dtype, mode="r", offset=LOG_HEADER_BYTES, shape=(n_records,)
+        )
+
+    def __len__(self):
+        return len(self.records)
+
+    def frame(self, i):
+        return self.records[i]["frame"]
+
+    def t_capture(self, i):
+        return float(self.records[i]["t_capture"])
+
+    def v2x_statuses(self, i):
+        return decode_v2x(self.records[i]["v2x"])
+
+    def detections(self, i):
+        record = self.records[i]
+        return np.array(record["detections"][: record["n_detections"]])
+
+    def output_data(self, i, columnar=False, t_capture=None):
+        """The perception_queue message that perception produced for record i."""
+        detections = self.detections(i)
+        if t_capture is None:
+            t_capture = self.t_capture(i)
+        detections["t_capture"] = t_capture
+        if columnar:
+            return {
+                "detections": detections,
+                "class_names": self.class_names,
+                "v2x_statuses": self.v2x_statuses(i),
+                "t_capture": t_capture,
+            }
+        return {
+            "detections": [
+                {
+                    "class": self.class_names[det["cls"]],
+                    "width": float(det["w"]),
+                    "height": float(det["h"]),
+                    "x": float(det["x"]),
+                    "y": float(det["y"]),
+                }
+                for det in detections
+            ],
+            "v2x_statuses": self.v2x_statuses(i),
+            "t_capture": t_capture,
+        }
+
+
+class _Pacer:
+    """Spaces replayed records like the original capture times (or not at all)."""
+
+    def __init__(self, reader, realtime):
+        self.reader = reader
+        self.realtime = realtime
+        self._t0_wall = None
+        self._t0_log = None
+
+    def wait(self, i):
+        if not self.realtime:
+            return
+        if self._t0_wall is None:
+            self._t0_wall = time.monotonic()
+            self._t0_log = self.reader.t_capture(i)
+            return
+        delay = (self.reader.t_capture(i) - self._t0_log) - (time.monotonic() - self._t0_wall)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ReplayCamera:
+    """
+    Drop-in for QLabsQCar2 in run_perception(camera_source=...).
+
+    get_image() returns the logged frames in order, at the original rate
+    (realtime=True) or as fast as they are asked for. statuses() returns the
+    V2X statuses logged with the last frame, so it also stands in for the
+    V2XPoller. After the last frame `finished` is set and get_image()
+    returns (False, None).
+    """
+
+    def __init__(self, reader, realtime=True, loop=False):
+        self.reader = reader
+        self.loop = loop
+        self.finished = False
+        self._pacer = _Pacer(reader, realtime)
+        self._index = 0
+        self._v2x_statuses = []
+
+    def __repr__(self):
+        return f"ReplayCamera('{self.reader.path}', {len(self.reader)} frames)"
+
+    def possess(self):
+        pass
+
+    def get_image(self, camera=None):
+        if self._index >= len(self.reader):
+            if not self.loop or len(self.reader) == 0:
+                self.finished = True
+                return False, None
+            self._index = 0
+            self._pacer = _Pacer(self.reader, self._pacer.realtime)
+        i = self._index
+        self._pacer.wait(i)
+        self._v2x_statuses = self.reader.v2x_statuses(i)
+        self._index += 1
+        return True, np.array(self.reader.frame(i))
+
+    def statuses(self):
+        return list(self._v2x_statuses)
+
+
+def replay_to_queue(reader, perception_queue, realtime=True, columnar=False, stop=None):
+    """
+    Feed the logged detections straight into perception_queue, skipping
+    inference. Messages are stamped with the replay time. Returns
+    (frames_sent, frames_dropped_because_queue_full).
+    """
+    pacer = _Pacer(reader, realtime)
+    sent = dropped = 0
+    for i in range(len(reader)):
+        if stop is not None and stop.is_set():
+            break
+        pacer.wait(i)
+        output_data = reader.output_data(i, columnar, t_capture=time.monotonic())
+        output_data["seq"] = i + 1
+        if perception_queue.full():
+            dropped += 1
+            continue
+        perception_queue.put(output_data)
+        sent += 1
+    return sent, dropped
+
+
+def _latency_summary(latencies_s):
+    if not latencies_s:
+        return "no samples"
+    ms = 1000.0 * np.array(latencies_s)
+    return f"p50 {np.percentile(ms, 50):.1f} ms, p99 {np.percentile(ms, 99):.1f} ms, max {ms.max():.1f} ms"
+
+
+def _drain_commands(command_queue, commands, stop):
+    while not stop.is_set():
+        try:
+            commands.append((time.monotonic(), command_queue.get(timeout=0.1)))
+        except queue.Empty:
+            pass
+
+
+def benchmark_replay(
+    log_path,
+    backend=None,
+    realtime=False,
+    columnar=False,
+    controller_only=False,
+    event_driven=False,
+):
+    """
+    Offline throughput/latency benchmark of the perception-to-command path.
+
+    Replays the log through run_perception (or, with controller_only, feeds
+    the logged detections directly) into a controller_qcar.main process and
+    reports perception throughput, capture-to-output latency, and the
+    commands the controller issued. backend defaults to
+    perception_module.INFERENCE_BACKEND; perception_module (torch, QLabs)
+    is only imported when frames are replayed through inference.
+    """
+    import controller_qcar
+
+    reader = FrameLogReader(log_path)
+    print(f"[Replay] {len(reader)} frames from '{log_path}'")
+
+    tap_queue = queue.Queue(maxsize=1)
+    perception_queue = mp.Queue(maxsize=1)
+    command_queue = mp.Queue(maxsize=1)
+    # The car stands still at the origin.
+    poses = PoseBuffer.create(f"replay{os.getpid()}_poses")
+    controller_stop = mp.Event()
+    controller_proc = mp.Process(
+        target=controller_qcar.main,
+        args=(perception_queue, command_queue, poses.view(0)),
+        kwargs={"event_driven": event_driven, "stop_event": controller_stop},
+    )
+    controller_proc.start()
+
+    stop = threading.Event()
+    commands = []
+    drain_thread = threading.Thread(
+        target=_drain_commands, args=(command_queue, commands, stop)
+    )
+    drain_thread.start()
+
+    t_start = time.monotonic()
+    if controller_only:
+        source_thread = threading.Thread(
+            target=replay_to_queue, args=(reader, tap_queue, realtime, columnar, stop)
+        )
+        camera = None
+    else:
+        import perception_module
+
+        if backend is None:
+            backend = perception_module.INFERENCE_BACKEND
+        camera = ReplayCamera(reader, realtime=realtime)
+        source_thread = threading.Thread(
+            target=perception_module.run_perception,
+            args=(tap_queue, 0),
+            kwargs={
+                "columnar": columnar,
+                "headless": True,
+                "backend": backend,
+                "camera_source": camera,
+            },
+        )
+    source_thread.start()
+
+    # Tap between perception and the controller: measure, then forward.
+    latencies = []
+    outputs = forwarded = 0
+    while source_thread.is_alive() or not tap_queue.empty():
+        try:
+            output_data = tap_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        outputs += 1
+        latencies.append(time.monotonic() - output_data["t_capture"])
+        if not perception_queue.full():
+            perception_queue.put(output_data)
+            forwarded += 1
+    elapsed = time.monotonic() - t_start
+
+    # Give the controller a moment to act on the last frame.
+    time.sleep(0.5)
+    stop.set()
+    drain_thread.join()
+    # A clean stop lets the controller print its own latency summary on the way out.
+    controller_stop.set()
+    controller_proc.join(timeout=2.0)
+    if controller_proc.is_alive():
+        controller_proc.terminate()
+        controller_proc.join()
+    poses.close()
+
+    print(f"[Replay] {outputs} perception outputs in {elapsed:.2f} s ({outputs / elapsed:.1f} fps)")
+    print(f"[Replay] capture -> perception output latency: {_latency_summary(latencies)}")
+    print(f"[Replay] {forwarded} forwarded to controller, {outputs - forwarded} dropped at perception_queue")
+    print(f"[Replay] {len(commands)} commands: {[command_text(command) for _, command in commands]}")
+    return {
+        "outputs": outputs,
+        "elapsed_s": elapsed,
+        "latencies_s": latencies,
+        "commands": commands,
+    }
+
+
+def log_stream(reader, columnar=False):
+    """(t_capture, perception message) for every logged frame, in log order."""
+    for i in range(len(reader)):
+        output_data = reader.output_data(i, columnar)
+        output_data["seq"] = i + 1
+        yield reader.t_capture(i), output_data
+
+
+def simulate_log(log_path, columnar=False, adaptive_cruise=False, repeat=1):
+    """
+    Run the logged detections through controller_qcar.simulate() in simulated
+    time (repeat times back to back) and print the decisions and speed-up.
+    """
+    import controller_qcar
+
+    reader = FrameLogReader(log_path)
+    duration = reader.t_capture(len(reader) - 1) - reader.t_capture(0) if len(reader) else 0.0
+
+    def stream():
+        for r in range(repeat):
+            offset = r * (duration + 1.0)
+            for t, output_data in log_stream(reader, columnar):
+                yield t + offset, output_data
+
+    t0 = time.perf_counter()
+    decisions = controller_qcar.simulate(stream(), adaptive_cruise=adaptive_cruise)
+    elapsed = time.perf_counter() - t0
+    simulated = repeat * duration
+    print(
+        f"[Replay] {repeat * len(reader)} frames / {simulated:.1f} s simulated in "
+        f"{elapsed:.2f} s ({simulated / max(elapsed, 1e-9):.0f}x real time)"
+    )
+    t_start = reader.t_capture(0) if len(reader) else 0.0
+    for t, command in decisions:
+        print(f"[Replay] {t - t_start:9.3f} s  {command}")
+    return decisions
+
+
+def export_frames(log_path, out_dir, every=1):
+    """Write every n-th logged frame as PNG (e.g. for INT8 calibration)."""
+    reader = FrameLogReader(log_path)
+    os.makedirs(out_dir, exist_ok=True)
+    written = 0
+    for i in range(0, len(reader), every):
+        cv2.imwrite(os.path.join(out_dir, f"frame_{i:06d}.png"), reader.frame(i))
+        written += 1
+    print(f"[Replay] Wrote {written} frames to '{out_dir}'")
+
+
+if __name__ == "__main__":
+    mp.set_start_method("spawn", force=True)
+    parser = argparse.ArgumentParser(description="Perception frame log tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    info_parser = sub.add_parser("info")
+    info_parser.add_argument("log")
+
+    bench_parser = sub.add_parser("bench")
+    bench_parser.add_argument("log")
+    bench_parser.add_argument("--backend", help="default: perception_module.INFERENCE_BACKEND")
+    bench_parser.add_argument("--realtime", action="store_true")
+    bench_parser.add_argument("--columnar", action="store_true")
+    bench_parser.add_argument("--controller-only", action="store_true")
+    bench_parser.add_argument("--event-driven", action="store_true")
+
+    sim_parser = sub.add_parser("simulate", help="controller decisions in simulated time")
+    sim_parser.add_argument("log")
+    sim_parser.add_argument("--columnar", action="store_true")
+    sim_parser.add_argument("--acc", action="store_true")
+    sim_parser.add_argument("--repeat", type=int, default=1)
+
+    export_parser = sub.add_parser("export-frames")
+    export_parser.add_argument("log")
+    export_parser.add_argument("out_dir")
+    export_parser.add_argument("--every", type=int, default=1)
+
+    args = parser.parse_args()
+    if args.command == "info":
+        reader = FrameLogReader(args.log)
+        duration = reader.t_capture(len(reader) - 1) - reader.t_capture(0) if len(reader) else 0.0
+        print(
+            f"{len(reader)} frames {reader.frame_shape}, {duration:.1f} s, "
+            f"classes {list(reader.class_names)}"
+        )
+    elif args.command == "bench":
+        benchmark_replay(
+            args.log,
+            args.backend,
+            args.realtime,
+            args.columnar,
+            args.controller_only,
+            args.event_driven,
+        )
+    elif args.command == "simulate":
+        simulate_log(args.log, args.columnar, args.acc, args.repeat)
+    else:
+        export_frames(args.log, args.out_dir, args.every)
@@ -0,0 +1,98 @@
+# geofence.py
+# Circular geofence zones (traffic lights, stop signs, yield signs) in the
+# QCar map frame, with a uniform-grid spatial index.
+#
+# Zones are bucketed into square cells at least as large as the biggest zone
+# radius, so a query only has to look at the 3x3 cells around the car: the
+# cost per controller cycle does not grow with the number of zones.
+import math
+import numpy as np
+
+
+def world_to_map(points, scale, offset):
+    """QLabs world (x, y) -> QCar map frame: map = world * scale + offset, per axis."""
+    points = np.asarray(points, dtype=float)[..., :2]
+    return points * np.asarray(scale, dtype=float) + np.asarray(offset, dtype=float)
+
+
+class GeofenceIndex:
+    """
+    Static set of circular zones with O(1) point queries.
+
+    Every zone has a kind ("light", "stop_sign", ...), an id and an optional
+    integer payload (e.g. the light's index in the V2X status list).
+    """
+
+    def __init__(self, centers, radii, kinds, ids, payloads=None, cell_size=None):
+        self.centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+        self.radii = np.broadcast_to(np.asarray(radii, dtype=float), len(self.centers)).copy()
+        self.kinds = list(kinds)
+        self.ids = list(ids)
+        self.payloads = (
+            np.full(len(self.centers), -1, dtype=np.int64)
+            if payloads is None
+            else np.asarray(payloads, dtype=np.int64)
+        )
+        if not len(self.kinds) == len(self.ids) == len(self.centers) == len(self.payloads):
+            raise ValueError("Zone centers, kinds, ids and payloads must have the same length")
+
+        if cell_size is None:
+            cell_size = float(self.radii.max()) if len(self.radii) else 1.0
+        if len(self.radii) and cell_size < self.radii.max():
+            raise ValueError("cell_size must be at least the largest zone radius")
+        self.cell_size = cell_size
+
+        self.cells = {}
+        for i, cell in enumerate(map(tuple, np.floor(self.centers / cell_size).astype(np.int64))):
+            self.cells.setdefault(cell, []).append(i)
+        self.cells = {cell: np.array(zones) for cell, zones in self.cells.items()}
+        # The car often reports the same pose for many cycles (stopped, or
+        # between pose updates): remember the last query.
+        self._last_query = None
+        self._last_zones = None
+
+    def __len__(self):
+        return len(self.centers)
+
+    @classmethod
+    def from_configs(cls, configs_by_kind, scale, offset, radius):
+        """
+        Build from environment_config-style configs ({"id", "location"} dicts),
+        given as {kind: [config, ...]}. Light zones get their position in the
+        config list as payload, which is the order of perception's V2X statuses.
+        """
+        centers, kinds, ids, payloads = [], [], [], []
+        for kind, configs in configs_by_kind.items():
+            for i, config in enumerate(configs):
+                centers.append(world_to_map(config["location"], scale, offset))
+                kinds.append(kind)
+                ids.append(config["id"])
+                payloads.append(i)
+        return cls(np.reshape(centers, (-1, 2)), radius, kinds, ids, payloads)
+
+    def query(self, x, y):
+        """Indices of all zones containing the point (x, y) (do not modify the result)."""
+        if self._last_query == (x, y):
+            return self._last_zones
+        self._last_query = (x, y)
+        self._last_zones = self._query(x, y)
+        return self._last_zones
+
+    def _query(self, x, y):
+        cx = math.floor(x / self.cell_size)
+        cy = math.floor(y / self.cell_size)
+        candidates = [
+            self.cells[cell]
+            for cell in (
+                (cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+            )
+            if cell in self.cells
+        ]
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.concatenate(candidates)
+        d = np.hypot(self.centers[candidates, 0] - x, self.centers[candidates, 1] - y)
+        return candidates[d <= self.radii[candidates]]
+
+    def zones_of_kind(self, zones, kind):
+        return [i for i in zones if self.kinds[i] == kind]
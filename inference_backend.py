@@ -0,0 +1,316 @@
+# inference_backend.py
+# CPU runtimes for model/best.pt: export once to ONNX Runtime or OpenVINO
+# (optionally INT8-quantized on recorded camera frames), load the model for a
+# given backend, and compare accuracy/latency against the PyTorch path.
+#
+#   python inference_backend.py export --backend onnx --int8 --frames recorded_frames/
+#   python inference_backend.py export --backend openvino --int8 --frames recorded_frames/
+#   python inference_backend.py compare --frames recorded_frames/ --backends torch onnx onnx-int8
+#   python inference_backend.py batch --frames recorded_frames/ --batch-sizes 1 2 4 8
+import argparse
+import glob
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+import torch
+from ultralytics import YOLO
+
+MODEL_PATH = "model/best.pt"
+IMAGE_SIZE = 640
+BACKENDS = ("torch", "onnx", "onnx-int8", "openvino", "openvino-int8")
+CALIBRATION_MAX_FRAMES = 300
+MATCH_IOU_THRESHOLD = 0.5
+
+
+def backend_model_path(backend, model_path=MODEL_PATH):
+    """Where the exported model for `backend` lives (next to model_path)."""
+    stem, _ = os.path.splitext(model_path)
+    if backend == "torch":
+        return model_path
+    if backend == "onnx":
+        return stem + ".onnx"
+    if backend == "onnx-int8":
+        return stem + "_int8.onnx"
+    if backend == "openvino":
+        return stem + "_openvino_model"
+    if backend == "openvino-int8":
+        return stem + "_int8_openvino_model"
+    raise ValueError(f"Unknown inference backend '{backend}', expected one of {BACKENDS}")
+
+
+def load_model(backend="torch", model_path=MODEL_PATH):
+    """
+    Load the detector for `backend` and return (model, device).
+
+    Every backend is wrapped in an ultralytics YOLO object, so
+    model(image, device=device, ...) returns the same Results type and the
+    detection output downstream does not change.
+    """
+    if backend == "torch":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        return YOLO(model_path).to(device), device
+
+    path = backend_model_path(backend, model_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"No exported model at '{path}'. Run: python inference_backend.py "
+            f"export --backend {backend.replace('-int8', '')}"
+            + (" --int8 --frames <dir>" if backend.endswith("-int8") else "")
+        )
+    return YOLO(path, task="detect"), "cpu"
+
+
+def list_frames(frames_dir):
+    """Recorded frames (png/jpg) in a directory, sorted by name."""
+    paths = []
+    for pattern in ("*.png", "*.jpg", "*.jpeg"):
+        paths.extend(glob.glob(os.path.join(frames_dir, pattern)))
+    return sorted(paths)
+
+
+def letterbox(image, size=IMAGE_SIZE):
+    """Resize keeping aspect ratio and pad to size x size, like YOLO preprocessing."""
+    h, w = image.shape[:2]
+    scale = min(size / h, size / w)
+    new_w, new_h = int(round(w * scale)), int(round(h * scale))
+    resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    out = np.full((size, size, 3), 114, dtype=np.uint8)
+    top = (size - new_h) // 2
+    left = (size - new_w) // 2
+    out[top : top + new_h, left : left + new_w] = resized
+    return out
+
+
+class FrameCalibrationReader:
+    """onnxruntime CalibrationDataReader feeding recorded frames as network input."""
+
+    def __init__(self, frame_paths, input_name, size=IMAGE_SIZE):
+        self.frame_paths = iter(frame_paths)
+        self.input_name = input_name
+        self.size = size
+
+    def get_next(self):
+        path = next(self.frame_paths, None)
+        if path is None:
+            return None
+        image = letterbox(cv2.imread(path), self.size)
+        blob = image[:, :, ::-1].transpose(2, 0, 1)[np.newaxis].astype(np.float32) / 255.0
+        return {self.input_name: np.ascontiguousarray(blob)}
+
+
+def _write_calibration_yaml(frames_dir, names, yaml_dir):
+    """
+    Minimal dataset yaml so ultralytics' OpenVINO INT8 export calibrates on
+    our frames. Written to yaml_dir, never into the frames directory.
+    """
+    yaml_path = os.path.join(yaml_dir, "calibration.yaml")
+    with open(yaml_path, "w") as f:
+        f.write(f"path: {os.path.abspath(frames_dir)}\n")
+        f.write("train: .\n")
+        f.write("val: .\n")
+        f.write("names:\n")
+        for class_id, name in names.items():
+            f.write(f"  {class_id}: {name}\n")
+    return yaml_path
+
+
+def export_model(backend, int8=False, frames_dir=None, model_path=MODEL_PATH):
+    """
+    Export model_path once to `backend` ("onnx" or "openvino").
+
+    With int8=True the exported model is statically quantized, calibrated on
+    the recorded frames in frames_dir. Returns the path of the exported model.
+    """
+    if int8 and not frames_dir:
+        raise ValueError("INT8 quantization needs recorded frames for calibration")
+    model = YOLO(model_path)
+
+    if backend == "onnx":
+        # dynamic=True keeps the batch axis free for BatchedInferenceServer.
+        onnx_path = model.export(format="onnx", imgsz=IMAGE_SIZE, dynamic=True)
+        if not int8:
+            return onnx_path
+
+        import onnxruntime
+        from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+        input_name = onnxruntime.InferenceSession(
+            onnx_path, providers=["CPUExecutionProvider"]
+        ).get_inputs()[0].name
+        frame_paths = list_frames(frames_dir)[:CALIBRATION_MAX_FRAMES]
+        int8_path = backend_model_path("onnx-int8", model_path)
+        quantize_static(
+            onnx_path,
+            int8_path,
+            FrameCalibrationReader(frame_paths, input_name),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+        print(f"[Backend] INT8 ONNX model calibrated on {len(frame_paths)} frames.")
+        return int8_path
+
+    if backend == "openvino":
+        if not int8:
+            return model.export(format="openvino", imgsz=IMAGE_SIZE, dynamic=True)
+        with tempfile.TemporaryDirectory() as yaml_dir:
+            data = _write_calibration_yaml(frames_dir, model.names, yaml_dir)
+            return model.export(
+                format="openvino", imgsz=IMAGE_SIZE, dynamic=True, int8=True, data=data
+            )
+
+    raise ValueError(f"Cannot export to '{backend}', expected 'onnx' or 'openvino'")
+
+
+def _box_iou(a, b):
+    """Pairwise IoU between (N, 4) and (M, 4) xyxy boxes."""
+    tl = np.maximum(a[:, None, :2], b[None, :, :2])
+    br = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(br - tl, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def match_detections(ref_boxes, ref_cls, boxes, cls, iou_threshold=MATCH_IOU_THRESHOLD):
+    """Greedy same-class matching; returns (matched_count, IoUs of the matches)."""
+    if len(ref_boxes) == 0 or len(boxes) == 0:
+        return 0, []
+    iou = _box_iou(ref_boxes, boxes)
+    iou[ref_cls[:, None] != cls[None, :]] = 0.0
+    ious = []
+    while True:
+        i, j = np.unravel_index(np.argmax(iou), iou.shape)
+        if iou[i, j] < iou_threshold:
+            break
+        ious.append(float(iou[i, j]))
+        iou[i, :] = 0.0
+        iou[:, j] = 0.0
+    return len(ious), ious
+
+
+def compare_backends(frames_dir, backends=("torch", "onnx"), conf=0.4, warmup=5):
+    """
+    Run every backend over the recorded frames and report latency and
+    agreement with the PyTorch detections (precision/recall/mean IoU).
+    """
+    images = [cv2.imread(p) for p in list_frames(frames_dir)]
+    if not images:
+        raise ValueError(f"No frames found in '{frames_dir}'")
+
+    outputs = {}
+    report = {}
+    devices = {}
+    for backend in ("torch",) + tuple(b for b in backends if b != "torch"):
+        model, device = load_model(backend)
+        devices[backend] = device
+        for image in images[:warmup]:
+            model(image, device=device, conf=conf, verbose=False)
+
+        latencies = []
+        outputs[backend] = []
+        for image in images:
+            t0 = time.perf_counter()
+            results = model(image, device=device, conf=conf, verbose=False)[0]
+            latencies.append(time.perf_counter() - t0)
+            outputs[backend].append(
+                (results.boxes.xyxy.cpu().numpy(), results.boxes.cls.cpu().numpy())
+            )
+
+        latencies_ms = 1000.0 * np.array(latencies)
+        report[backend] = {
+            "p50_ms": float(np.percentile(latencies_ms, 50)),
+            "p99_ms": float(np.percentile(latencies_ms, 99)),
+            "fps": float(1000.0 / latencies_ms.mean()),
+        }
+
+    for backend in report:
+        n_ref = n_out = n_match = 0
+        all_ious = []
+        for (ref_boxes, ref_cls), (boxes, cls) in zip(outputs["torch"], outputs[backend]):
+            matched, ious = match_detections(ref_boxes, ref_cls, boxes, cls)
+            n_ref += len(ref_boxes)
+            n_out += len(boxes)
+            n_match += matched
+            all_ious.extend(ious)
+        report[backend]["precision"] = n_match / n_out if n_out else 1.0
+        report[backend]["recall"] = n_match / n_ref if n_ref else 1.0
+        report[backend]["mean_iou"] = float(np.mean(all_ious)) if all_ious else 0.0
+
+    print(f"[Backend] {len(images)} frames, reference = torch on '{devices['torch']}'")
+    print(f"{'backend':<15}{'p50 ms':>9}{'p99 ms':>9}{'fps':>8}{'prec':>7}{'recall':>8}{'mIoU':>7}")
+    for backend, r in report.items():
+        print(
+            f"{backend:<15}{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['fps']:>8.1f}"
+            f"{r['precision']:>7.3f}{r['recall']:>8.3f}{r['mean_iou']:>7.3f}"
+        )
+    return report
+
+
+def benchmark_batching(frames_dir, backend="torch", batch_sizes=(1, 2, 4, 8), conf=0.4, warmup=2):
+    """
+    Total frames per second of one model call per frame (unbatched, as in
+    run_perception) vs. one call per batch of frames (as in
+    perception_module.BatchedInferenceServer), for each batch size.
+    """
+    images = [cv2.imread(p) for p in list_frames(frames_dir)]
+    if not images:
+        raise ValueError(f"No frames found in '{frames_dir}'")
+    model, device = load_model(backend)
+    for image in images[:warmup]:
+        model(image, device=device, conf=conf, verbose=False)
+
+    t0 = time.perf_counter()
+    for image in images:
+        model(image, device=device, conf=conf, verbose=False)
+    unbatched_fps = len(images) / (time.perf_counter() - t0)
+
+    report = {1: unbatched_fps}
+    print(f"[Backend] {len(images)} frames, {backend} on '{device}'")
+    print(f"[Backend] unbatched:   {unbatched_fps:6.1f} fps")
+    for batch_size in batch_sizes:
+        if batch_size < 2:
+            continue
+        batches = [images[i : i + batch_size] for i in range(0, len(images), batch_size)]
+        model(batches[0], device=device, conf=conf, verbose=False)
+        t0 = time.perf_counter()
+        for batch in batches:
+            model(batch, device=device, conf=conf, verbose=False)
+        fps = len(images) / (time.perf_counter() - t0)
+        report[batch_size] = fps
+        print(
+            f"[Backend] batch of {batch_size:>2}: {fps:6.1f} fps "
+            f"({fps / unbatched_fps:.2f}x unbatched)"
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU inference backends for model/best.pt")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = sub.add_parser("export", help="export model/best.pt to a CPU runtime")
+    export_parser.add_argument("--backend", choices=("onnx", "openvino"), required=True)
+    export_parser.add_argument("--int8", action="store_true")
+    export_parser.add_argument("--frames", help="directory of recorded frames for INT8 calibration")
+    export_parser.add_argument("--model", default=MODEL_PATH)
+
+    compare_parser = sub.add_parser("compare", help="accuracy vs latency against PyTorch")
+    compare_parser.add_argument("--frames", required=True)
+    compare_parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=["torch", "onnx"])
+
+    batch_parser = sub.add_parser("batch", help="batched vs. unbatched throughput")
+    batch_parser.add_argument("--frames", required=True)
+    batch_parser.add_argument("--backend", choices=BACKENDS, default="torch")
+    batch_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+
+    args = parser.parse_args()
+    if args.command == "export":
+        path = export_model(args.backend, args.int8, args.frames, args.model)
+        print(f"[Backend] ✅ Exported to '{path}'")
+    elif args.command == "batch":
+        benchmark_batching(args.frames, args.backend, args.batch_sizes)
+    else:
+        compare_backends(args.frames, args.backends)
@@ -0,0 +1,176 @@
+# latency.py
+# End-to-end latency accounting from camera capture to actuator command.
+#
+# Every frame gets a sequence number and a dict of monotonic timestamps
+# ("stamps") at capture. Each stage adds its own stamp, the stamps travel with
+# the perception output into the controller and with the resulting command
+# into the control loop, and any process holding a message can turn them
+# into per-stage latencies (STAGE_BOUNDS) recorded in fixed-size log-scale
+# histograms. time.monotonic() is system-wide, so stamps compare across
+# processes.
+import json
+import math
+import time
+import numpy as np
+
+# Stage name -> (start stamp, end stamp), in pipeline order.
+STAGE_BOUNDS = {
+    "capture": ("t_grab", "t_capture"),  # camera get_image call
+    "frame_wait": ("t_capture", "t_infer_start"),  # capture -> inference buffer
+    "inference": ("t_infer_start", "t_inferred"),
+    "postprocess": ("t_inferred", "t_published"),  # lane, output build, recording
+    "queue_wait": ("t_published", "t_pickup"),  # perception_queue -> controller
+    "decision": ("t_pickup", "t_decided"),  # controller logic until the command is put
+    "command_wait": ("t_decided", "t_dequeued"),  # command mailbox -> control loop
+    "apply": ("t_dequeued", "t_applied"),  # until qcar.write() returned
+    "end_to_end": ("t_capture", "t_applied"),
+}
+
+# Histogram bins: LATENCY_BINS_PER_DECADE log-spaced bins per decade from
+# LATENCY_MIN_S, plus one underflow and one overflow bin.
+LATENCY_MIN_S = 1e-5
+LATENCY_DECADES = 7
+LATENCY_BINS_PER_DECADE = 20
+
+
+class LatencyHistogram:
+    """Fixed log-scale histogram; record() is O(1) and memory does not grow."""
+
+    def __init__(self):
+        n = LATENCY_DECADES * LATENCY_BINS_PER_DECADE
+        self.edges = LATENCY_MIN_S * 10.0 ** (np.arange(n + 1) / LATENCY_BINS_PER_DECADE)
+        self.counts = np.zeros(n + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        seconds = max(seconds, 0.0)
+        if seconds < LATENCY_MIN_S:
+            i = 0
+        else:
+            i = int(math.log10(seconds / LATENCY_MIN_S) * LATENCY_BINS_PER_DECADE) + 1
+            i = min(i, len(self.counts) - 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Upper edge of the bin holding the p-th percentile (never above the max)."""
+        if not self.count:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), p / 100.0 * self.count))
+        if i == 0:
+            return min(LATENCY_MIN_S, self.max)
+        if i > len(self.edges) - 1:
+            return self.max
+        return min(float(self.edges[i]), self.max)
+
+    def summary(self):
+        return {
+            "n": self.count,
+            "p50_ms": 1000.0 * self.percentile(50),
+            "p99_ms": 1000.0 * self.percentile(99),
+            "max_ms": 1000.0 * self.max,
+            "mean_ms": 1000.0 * self.total / self.count if self.count else 0.0,
+        }
+
+
+class LatencyStats:
+    """Per-stage latency histograms plus dropped-frame counters for one process."""
+
+    def __init__(self, name):
+        self.name = name
+        self.histograms = {}
+        self.dropped = {}
+
+    def record(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def record_stamps(self, stamps, stages=None):
+        """Record every stage (of `stages`, default all) whose two stamps are present."""
+        for stage in stages or STAGE_BOUNDS:
+            start, end = STAGE_BOUNDS[stage]
+            if start in stamps and end in stamps:
+                self.record(stage, stamps[end] - stamps[start])
+
+    def count_dropped(self, queue_name, n=1):
+        self.dropped[queue_name] = self.dropped.get(queue_name, 0) + n
+
+    def set_dropped(self, counts):
+        """Take over cumulative drop counters reported by an upstream process."""
+        self.dropped.update(counts)
+
+    def summary(self):
+        order = list(STAGE_BOUNDS) + sorted(set(self.histograms) - set(STAGE_BOUNDS))
+        return {
+            "stages": {
+                stage: self.histograms[stage].summary()
+                for stage in order
+                if stage in self.histograms
+            },
+            "dropped": dict(self.dropped),
+        }
+
+    def format(self):
+        lines = []
+        for stage, s in self.summary()["stages"].items():
+            lines.append(
+                f"{stage:<13} n={s['n']:<6} p50 {s['p50_ms']:7.2f} ms  "
+                f"p99 {s['p99_ms']:7.2f} ms  max {s['max_ms']:7.2f} ms"
+            )
+        lines.append(f"dropped: {self.dropped}")
+        return lines
+
+    def print(self, tag):
+        for line in self.format():
+            print(f"{tag} {line}")
+
+    def export(self, path):
+        """Write the summary and the raw histogram bins as JSON."""
+        data = self.summary()
+        data["name"] = self.name
+        data["bin_edges_ms"] = (1000.0 * LatencyHistogram().edges).tolist()
+        data["histograms"] = {
+            stage: histogram.counts.tolist() for stage, histogram in self.histograms.items()
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+
+
+# --- Stamped messages ---
+def new_stamps(seq, t_grab, t_capture):
+    return {"seq": seq, "t_grab": t_grab, "t_capture": t_capture}
+
+
+def stamp(stamps, key):
+    stamps[key] = time.monotonic()
+    return stamps
+
+
+def make_command(command, stamps=None, speed=None, reasons=0):
+    """
+    A command for vehicle_control.controlLoop: the command string, its target
+    speed and stop-reason bitmask (the fields shm_transport.CommandMailbox
+    carries) plus the seq/stamps of the frame that caused it (stamps are
+    copied and get t_decided).
+    """
+    stamps = dict(stamps or {})
+    stamp(stamps, "t_decided")
+    return {
+        "command": command,
+        "speed": speed,
+        "reasons": reasons,
+        "seq": stamps.get("seq"),
+        "t_capture": stamps.get("t_capture"),
+        "stamps": stamps,
+    }
+
+
+def command_text(command):
+    """The command string of a command message (plain strings are accepted too)."""
+    return command["command"] if isinstance(command, dict) else command
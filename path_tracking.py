@@ -0,0 +1,324 @@
+# path_tracking.py
+# Path geometry and map matching for the steering controller.
+#
+# PathTable preprocesses the waypoint path once into per-segment tables
+# (start point, unit vector, length, cumulative arc length, tangent heading,
+# curvature), so SteeringController.update only looks up one row and does
+# scalar math on it at 100 Hz, without allocating arrays.
+#
+# PathMatcher finds which segment the car is on. The normal per-tick search
+# projects the car onto a sliding window of segments around the last match
+# in one vectorized step, so its cost does not depend on the route length.
+# When the car is far from every segment in the window (after a stop, a GPS
+# jump or drift) the whole path is searched through a uniform grid of
+# segments, ring by ring outward from the car, so even routes with tens of
+# thousands of waypoints stay cheap to re-localize on.
+import math
+import time
+import numpy as np
+
+# Segments searched per tick behind / ahead of the last match.
+PATH_WINDOW_BEHIND = 10
+PATH_WINDOW_AHEAD = 100
+# Re-localize on the whole path when the window's best match is farther (m).
+PATH_RELOCATE_DISTANCE = 0.25
+PATH_GRID_CELL_SIZE = 0.25
+MAX_STEERING_ANGLE = np.pi / 6
+
+
+def wrap_angle(angle):
+    """Wrap a scalar angle to [-pi, pi)."""
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+def project_onto_segments(p, starts, directions, lengths):
+    """
+    Closest points on segments to p.
+
+    Returns (distance, s) per segment, s being the position of the closest
+    point along the segment (0 to its length).
+    """
+    rel = p[None, :] - starts
+    s = np.clip(np.einsum("ij,ij->i", rel, directions), 0.0, lengths)
+    closest = starts + directions * s[:, None]
+    return np.hypot(closest[:, 0] - p[0], closest[:, 1] - p[1]), s
+
+
+class PathTable:
+    """
+    Per-segment geometry of a (2, N) waypoint path, computed once.
+
+    Segment i runs from waypoint i to waypoint i + 1; on a cyclic path the
+    last segment wraps around to waypoint 0 (the path's last waypoint is
+    taken to repeat the first, as in SteeringController). Arrays hold one
+    entry per segment: starts and directions (unit vectors) as (n, 2),
+    lengths, arc_length (distance along the path to the segment start),
+    headings and curvature (heading change per metre into the segment).
+    Zero-length segments take the direction of the segment before them.
+    `rows` has the values the steering law needs per segment as a tuple of
+    Python floats, (x0, y0, ux, uy, length, heading), for scalar lookups.
+    """
+
+    def __init__(self, waypoints, cyclic=True):
+        points = np.asarray(waypoints, dtype=float)[:2].T
+        n = len(points) - 1
+        ends = np.roll(points[:n], -1, axis=0) if cyclic else points[1:]
+        self.starts = np.ascontiguousarray(points[:n])
+        vectors = ends - self.starts
+        self.lengths = np.hypot(vectors[:, 0], vectors[:, 1])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            directions = np.nan_to_num(vectors / self.lengths[:, None])
+        nonzero = np.maximum.accumulate(np.where(self.lengths > 0, np.arange(n), 0))
+        self.directions = np.ascontiguousarray(directions[nonzero])
+        self.headings = np.arctan2(self.directions[:, 1], self.directions[:, 0])
+        self.arc_length = np.concatenate([[0.0], np.cumsum(self.lengths)[:-1]])
+        turn = np.mod(np.diff(self.headings, prepend=self.headings[-1]) + np.pi, 2 * np.pi) - np.pi
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.curvature = np.nan_to_num(
+                turn / ((self.lengths + np.roll(self.lengths, 1)) / 2), posinf=0.0, neginf=0.0
+            )
+        if not cyclic and n:
+            self.curvature[0] = 0.0
+        self.n_segments = n
+        self.cyclic = cyclic
+        self.rows = list(
+            zip(
+                self.starts[:, 0].tolist(),
+                self.starts[:, 1].tolist(),
+                self.directions[:, 0].tolist(),
+                self.directions[:, 1].tolist(),
+                self.lengths.tolist(),
+                self.headings.tolist(),
+            )
+        )
+
+    def __len__(self):
+        return self.n_segments
+
+    def distance_to(self, p):
+        """Distance from p to the nearest point of the path."""
+        d, _ = project_onto_segments(
+            np.asarray(p, dtype=float)[:2], self.starts, self.directions, self.lengths
+        )
+        return float(d.min())
+
+
+class PathMatcher(PathTable):
+    """Nearest-segment search on a PathTable."""
+
+    def __init__(
+        self,
+        waypoints,
+        cyclic=True,
+        behind=PATH_WINDOW_BEHIND,
+        ahead=PATH_WINDOW_AHEAD,
+        relocate_distance=PATH_RELOCATE_DISTANCE,
+        cell_size=PATH_GRID_CELL_SIZE,
+    ):
+        super().__init__(waypoints, cyclic)
+        n = self.n_segments
+        self.window = np.arange(-behind, ahead + 1)
+        self.relocate_distance = relocate_distance
+        self.relocations = 0
+
+        # --- Grid of segment midpoints (cells at least one segment long) ---
+        self.cell_size = max(cell_size, float(self.lengths.max()) if n else cell_size)
+        self._half_length = float(self.lengths.max()) / 2 if n else 0.0
+        midpoints = self.starts + self.directions * (self.lengths / 2)[:, None]
+        cells = np.floor(midpoints / self.cell_size).astype(np.int64)
+        self.cells = {}
+        for i, cell in enumerate(map(tuple, cells)):
+            self.cells.setdefault(cell, []).append(i)
+        self.cells = {cell: np.array(segments) for cell, segments in self.cells.items()}
+        self._cell_min = cells.min(axis=0) if n else np.zeros(2, dtype=np.int64)
+        self._cell_max = cells.max(axis=0) if n else np.zeros(2, dtype=np.int64)
+
+    def window_indices(self, index):
+        indices = index + self.window
+        if self.cyclic:
+            return np.mod(indices, self.n_segments)
+        return np.unique(np.clip(indices, 0, self.n_segments - 1))
+
+    def _nearest(self, p, segments, heading=None):
+        """(segment, distance) of the nearest of `segments`, optionally facing `heading`."""
+        d, _ = project_onto_segments(
+            p, self.starts[segments], self.directions[segments], self.lengths[segments]
+        )
+        if heading is not None:
+            d = np.where(np.cos(self.headings[segments] - heading) > 0, d, np.inf)
+        i = int(np.argmin(d))
+        return int(segments[i]), float(d[i])
+
+    def _ring(self, cx, cy, k):
+        if k == 0:
+            cells = [(cx, cy)]
+        else:
+            cells = [(cx + dx, cy + dy) for dx in range(-k, k + 1) for dy in (-k, k)]
+            cells += [(cx + dx, cy + dy) for dx in (-k, k) for dy in range(-k + 1, k)]
+        return [self.cells[cell] for cell in cells if cell in self.cells]
+
+    def search(self, p, heading=None):
+        """
+        Nearest segment on the whole path (facing `heading` if given and
+        any segment does). Returns (segment, distance).
+        """
+        p = np.asarray(p, dtype=float)
+        cx = math.floor(p[0] / self.cell_size)
+        cy = math.floor(p[1] / self.cell_size)
+        k_max = int(
+            max(
+                abs(cx - self._cell_min[0]), abs(cx - self._cell_max[0]),
+                abs(cy - self._cell_min[1]), abs(cy - self._cell_max[1]),
+            )
+        )
+        best, best_d = None, math.inf
+        for k in range(k_max + 1):
+            # Nothing in ring k or beyond can be closer than this.
+            if (k - 1) * self.cell_size - self._half_length > best_d:
+                break
+            ring = self._ring(cx, cy, k)
+            if not ring:
+                continue
+            segment, d = self._nearest(p, np.concatenate(ring), heading)
+            if d < best_d:
+                best, best_d = segment, d
+        if best is None:
+            if heading is not None:
+                return self.search(p)
+            return 0, math.inf
+        return best, best_d
+
+    def match(self, p, index, heading=None):
+        """
+        Segment the car at p is on, searching the window around `index`
+        first and the whole path if that match is off by more than
+        relocate_distance. Returns (segment, distance).
+        """
+        p = np.asarray(p, dtype=float)
+        segment, d = self._nearest(p, self.window_indices(index))
+        if d > self.relocate_distance:
+            segment, d = self.search(p, heading)
+            self.relocations += 1
+        return segment, d
+
+
+# --- Stanley steering ---
+class SteeringController:
+    """
+    Stanley path-tracking law on a precomputed PathTable.
+
+    wpi is the current segment. By default it advances by one segment
+    whenever the car has passed the end of the current one; with
+    map_matching=True it is re-found every tick by a PathMatcher.
+    """
+
+    def __init__(self, waypoints, k=1, cyclic=True, map_matching=False):
+        self.maxSteeringAngle = MAX_STEERING_ANGLE
+        self.wp = waypoints
+        self.N = len(waypoints[0, :])
+        self.wpi = 0
+        self.k = k
+        self.cyclic = cyclic
+        self.p_ref = (0, 0)
+        self.th_ref = 0
+        self.map_matching = map_matching
+        self.path = PathMatcher(waypoints, cyclic) if map_matching else PathTable(waypoints, cyclic)
+
+    def update(self, p, th, speed):
+        px = float(p[0])
+        py = float(p[1])
+        if self.map_matching:
+            self.wpi, _ = self.path.match(p, self.wpi, th)
+        x0, y0, ux, uy, length, tangent = self.path.rows[self.wpi % self.path.n_segments]
+        s = (px - x0) * ux + (py - y0) * uy
+        if not self.map_matching and abs(s) >= length:
+            if self.cyclic or self.wpi < self.N - 2:
+                self.wpi += 1
+        ep_x = x0 + ux * s
+        ep_y = y0 + uy * s
+        ct_x = ep_x - px
+        ct_y = ep_y - py
+        ect = math.hypot(ct_x, ct_y)
+        if wrap_angle(math.atan2(ct_y, ct_x) - tangent) < 0:
+            ect = -ect
+        psi = wrap_angle(tangent - th)
+        self.p_ref = (ep_x, ep_y)
+        self.th_ref = tangent
+        delta = wrap_angle(psi + math.atan2(self.k * ect, speed))
+        return min(max(delta, -self.maxSteeringAngle), self.maxSteeringAngle)
+
+    def update_from_lane(self, offset, heading_err, speed):
+        """Stanley law on camera lane geometry (perception_module.LaneMeasurement)."""
+        # offset > 0 means the lane centre is to the right, i.e. a negative
+        # cross-track error in the map convention.
+        delta = wrap_angle(heading_err + math.atan2(-self.k * offset, speed))
+        return min(max(delta, -self.maxSteeringAngle), self.maxSteeringAngle)
+
+
+# --- Microbenchmark ---
+class _ReferenceSteeringController:
+    """The per-tick update before the path tables, for bench() comparisons."""
+
+    def __init__(self, waypoints, k=1):
+        self.wp = waypoints
+        self.N = len(waypoints[0, :])
+        self.wpi = 0
+        self.k = k
+
+    def update(self, p, th, speed):
+        wrap_to_pi = lambda a: np.mod(a + np.pi, 2 * np.pi) - np.pi
+        wp_1 = self.wp[:, np.mod(self.wpi, self.N - 1)]
+        wp_2 = self.wp[:, np.mod(self.wpi + 1, self.N - 1)]
+        v = wp_2 - wp_1
+        v_mag = np.linalg.norm(v)
+        v_uv = v / v_mag
+        tangent = np.arctan2(v_uv[1], v_uv[0])
+        s = np.dot(p - wp_1, v_uv)
+        if abs(s) >= v_mag:
+            self.wpi += 1
+        ep = wp_1 + v_uv * s
+        ct = ep - p
+        dir = wrap_to_pi(np.arctan2(ct[1], ct[0]) - tangent)
+        ect = np.linalg.norm(ct) * np.sign(dir)
+        psi = wrap_to_pi(tangent - th)
+        return np.clip(
+            wrap_to_pi(psi + np.arctan2(self.k * ect, speed)),
+            -MAX_STEERING_ANGLE,
+            MAX_STEERING_ANGLE,
+        )
+
+
+def bench(n_waypoints=20000, n_ticks=20000):
+    """
+    Per-tick cost of SteeringController.update on a synthetic loop
+    (waypoints 1 cm apart, car driving along it with a small offset).
+    """
+    t = np.linspace(0, 2 * np.pi, n_waypoints)
+    radius = n_waypoints * 0.01 / (2 * np.pi)
+    waypoints = np.vstack([radius * np.cos(t), radius * np.sin(t)])
+    index = np.arange(n_ticks) % (n_waypoints - 1)
+    poses = waypoints[:, index].T + 0.02
+    headings = t[index] + np.pi / 2
+
+    def run(controller):
+        deltas = np.empty(n_ticks)
+        t0 = time.perf_counter()
+        for i in range(n_ticks):
+            deltas[i] = controller.update(poses[i], headings[i], 0.4)
+        return (time.perf_counter() - t0) / n_ticks, deltas
+
+    t_build = time.perf_counter()
+    table = SteeringController(waypoints)
+    t_build = time.perf_counter() - t_build
+    before, reference = run(_ReferenceSteeringController(waypoints))
+    after, deltas = run(table)
+    matched, _ = run(SteeringController(waypoints, map_matching=True))
+    print(f"[Path] {n_waypoints} waypoints, {n_ticks} ticks (tables built in {1000 * t_build:.1f} ms)")
+    print(f"[Path] before (per-tick NumPy):  {1e6 * before:6.2f} us/tick")
+    print(f"[Path] after (path tables):      {1e6 * after:6.2f} us/tick ({before / after:.1f}x)")
+    print(f"[Path] with map matching:        {1e6 * matched:6.2f} us/tick")
+    print(f"[Path] max steering difference:  {np.abs(deltas - reference).max():.2e} rad")
+
+
+if __name__ == "__main__":
+    bench()
@@ -2,19 +2,78 @@
 import cv2
 import torch
 import sys
+import math
 import time
+import threading
+from collections import namedtuple
 import numpy as np
-from ultralytics import YOLO
+from ultralytics.engine.results import Results
 from qvl.qlabs import QuanserInteractiveLabs
 from qvl.qcar2 import QLabsQCar2
 from pal.products.qcar import IS_PHYSICAL_QCAR
 from hal.utilities.image_processing import ImageProcessing
+from inference_backend import load_model
+from shm_transport import FrameRing
+from detections import DETECTION_DTYPE  # columnar output format
+from latency import new_stamps, stamp
 
 # --- NEW: Import for V2X ---
 from qvl.traffic_light import QLabsTrafficLight
 
 KILL_THREAD = False
 
+MODEL_PATH = "model/best.pt"
+DETECTION_CONF = 0.4
+# "torch" (PyTorch, CUDA when available) or an exported CPU runtime:
+# "onnx", "onnx-int8", "openvino", "openvino-int8". See inference_backend.py.
+INFERENCE_BACKEND = "torch"
+
+# --- Batched inference configuration ---
+# Frames from several cars are grouped into one forward pass. A batch is sent
+# as soon as it is full or MAX_BATCH_WAIT_S has passed since its first frame.
+MAX_BATCH_SIZE = 4
+MAX_BATCH_WAIT_S = 0.01
+
+# --- Adaptive inference scheduling ---
+# A full YOLO pass runs when the downsampled frame differs from the one at
+# the last full pass by more than MOTION_THRESHOLD (mean abs gray level), or
+# at least every MAX_FULL_INTERVAL_S. That interval is kept below the
+# controller's shortest seen-timeout (1 s for QCars) so new objects are never
+# missed for longer than a stale timeout. In between, only the region around
+# the previous detections is inferred, or nothing if there were none.
+MOTION_DOWNSAMPLE = (80, 60)
+MOTION_THRESHOLD = 8.0
+MAX_FULL_INTERVAL_S = 0.5
+ROI_MARGIN_PX = 48
+
+# --- Lane detection ---
+# Rows of the camera frame searched for lane paint, and the HSV ranges of the
+# yellow centre line and the white edge line (both need V >= 200).
+LANE_CROP_ROWS = (150, 820)
+LANE_YELLOW_LOW = np.array([0, 0, 200], dtype=np.uint8)
+LANE_YELLOW_HIGH = np.array([45, 255, 255], dtype=np.uint8)
+LANE_WHITE_LOW = np.array([0, 0, 200], dtype=np.uint8)
+LANE_WHITE_HIGH = np.array([180, 50, 255], dtype=np.uint8)
+LANE_MIN_PIXELS = 200
+LANE_WIDTH_M = 0.3
+# Nominal gap between the two lines at the bottom row, used for the pixel
+# scale and lane centre when only one line is visible.
+LANE_WIDTH_PX = 300
+
+# Small numeric message sent to the control side. offset_m > 0 means the lane
+# centre is to the right of the car; heading_err_rad > 0 means the lane turns
+# left (image-plane approximation, no perspective correction).
+LaneMeasurement = namedtuple(
+    "LaneMeasurement", ["t_capture", "offset_m", "heading_err_rad", "valid"]
+)
+
+# --- Shared-memory frame transport ---
+# Frames older than this when an inference process gets to them are skipped.
+MAX_FRAME_AGE_S = 0.25
+# An inference process gives up if the capture process has not created the
+# ring after this long (it stops waiting at once when stop_event is set).
+FRAME_RING_ATTACH_TIMEOUT_S = 30.0
+
 # --- NEW: V2X Configuration ---
 # These are the lights spawned by environment_logic.py
 TRAFFIC_LIGHTS_CONFIG = [
@@ -23,124 +82,1188 @@ TRAFFIC_LIGHTS_CONFIG = [
 ]
 # We will populate this list of handles
 traffic_light_handles = []
+# V2X lights are polled by a V2XPoller on its own QLabs connection at this
+# rate; cached states older than V2X_MAX_AGE_S are reported as UNKNOWN.
+V2X_POLL_RATE_HZ = 5.0
+V2X_MAX_AGE_S = 1.0
+V2X_STATUS_MAP = {0: "NONE", 1: "RED", 2: "YELLOW", 3: "GREEN"}
 
 
 # --- NEW: V2X Helper Function ---
 def get_traffic_lights_status():
     global traffic_light_handles
     try:
-        status_map = {0: "NONE", 1: "RED", 2: "YELLOW", 3: "GREEN"}
         statuses = []
         for light in traffic_light_handles:
             status, color_code = light.get_color()
-            status_str = status_map.get(color_code, "UNKNOWN")
+            status_str = V2X_STATUS_MAP.get(color_code, "UNKNOWN")
             statuses.append(status_str)
         return statuses
     except Exception as e:
         # Don't print an error every loop, just return UNKNOWN
         return ["UNKNOWN"] * len(traffic_light_handles)
+
+
+class V2XPoller:
+    """
+    Background poller for traffic light states.
+
+    Runs on its own thread and QLabs connection, reads every light once per
+    period (rate_hz) and keeps a timestamped cache. statuses() returns the
+    cached states without touching QLabs, so perception never blocks on
+    light.get_color() round trips no matter how many lights there are.
+    """
+
+    def __init__(self, light_ids=None, rate_hz=V2X_POLL_RATE_HZ, handles=None):
+        if light_ids is None:
+            light_ids = [config["id"] for config in TRAFFIC_LIGHTS_CONFIG]
+        self.light_ids = list(light_ids)
+        self.period_s = 1.0 / rate_hz
+        self.handles = handles
+        n_lights = len(handles) if handles is not None else len(self.light_ids)
+        self._statuses = ["UNKNOWN"] * n_lights
+        self._times = [0.0] * n_lights
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._qlabs = None
+        self.sweeps = 0
+
+    def start(self):
+        if self.handles is None:
+            self._qlabs = QuanserInteractiveLabs()
+            self._qlabs.open("localhost")
+            self.handles = []
+            for light_id in self.light_ids:
+                light = QLabsTrafficLight(self._qlabs)
+                # We don't spawn, just get a handle to the existing light
+                light.actorNumber = light_id
+                self.handles.append(light)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._qlabs:
+            self._qlabs.close()
+
+    def _run(self):
+        next_sweep = time.monotonic()
+        while not self._stop.is_set() and not KILL_THREAD:
+            for i, light in enumerate(self.handles):
+                try:
+                    _, color_code = light.get_color()
+                    status = V2X_STATUS_MAP.get(color_code, "UNKNOWN")
+                except Exception:
+                    status = "UNKNOWN"
+                t = time.monotonic()
+                with self._lock:
+                    self._statuses[i] = status
+                    self._times[i] = t
+            self.sweeps += 1
+
+            next_sweep += self.period_s
+            delay = next_sweep - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                # Overran the period (too many lights for the rate): don't
+                # try to catch up, just start the next sweep now.
+                next_sweep = time.monotonic()
+
+    def snapshot(self):
+        """(statuses, monotonic read times) of every light, as cached."""
+        with self._lock:
+            return list(self._statuses), list(self._times)
+
+    def statuses(self, max_age_s=V2X_MAX_AGE_S):
+        """Cached statuses; entries older than max_age_s are reported as UNKNOWN."""
+        statuses, times = self.snapshot()
+        now = time.monotonic()
+        return [
+            status if now - t <= max_age_s else "UNKNOWN"
+            for status, t in zip(statuses, times)
+        ]
+
+
+class _SimulatedTrafficLight:
+    """Stand-in light whose get_color() costs a fixed round trip, for benchmarking."""
+
+    def __init__(self, round_trip_s):
+        self.round_trip_s = round_trip_s
+
+    def get_color(self):
+        time.sleep(self.round_trip_s)
+        return True, 1
+
+
+def benchmark_v2x_polling(
+    light_counts=(2, 10, 50), round_trip_s=0.002, frame_work_s=0.03, duration_s=3.0
+):
+    """
+    Perception frame rate with per-frame blocking V2X reads vs. the cached
+    V2XPoller, for several light counts. Light round trips and per-frame
+    inference time are simulated with sleeps of round_trip_s / frame_work_s.
+    """
+    report = {}
+    for n_lights in light_counts:
+        lights = [_SimulatedTrafficLight(round_trip_s) for _ in range(n_lights)]
+
+        frames = 0
+        t_end = time.monotonic() + duration_s
+        while time.monotonic() < t_end:
+            time.sleep(frame_work_s)
+            [light.get_color() for light in lights]
+            frames += 1
+        inline_fps = frames / duration_s
+
+        poller = V2XPoller(handles=lights).start()
+        frames = 0
+        t_end = time.monotonic() + duration_s
+        while time.monotonic() < t_end:
+            time.sleep(frame_work_s)
+            poller.statuses()
+            frames += 1
+        poller.stop()
+        cached_fps = frames / duration_s
+
+        report[n_lights] = (inline_fps, cached_fps)
+        print(
+            f"[V2X] {n_lights:>3} lights: {inline_fps:6.1f} fps blocking -> "
+            f"{cached_fps:6.1f} fps cached ({cached_fps / inline_fps:.2f}x)"
+        )
+    return report
+
+
+def results_to_detections(results, names):
+    """Convert one YOLO result into the list of detection dicts sent to the controller."""
+    detections = []
+    for box in results.boxes:
+        class_id = int(box.cls)
+        class_name = names[class_id]
+        x_center, y_center, width, height = box.xywh[0]
+        x_top_left = x_center.item() - (width.item() / 2)
+        y_top_left = y_center.item() - (height.item() / 2)
+
+        detection_data = {
+            "class": class_name,
+            "width": width.item(),
+            "height": height.item(),
+            "x": x_top_left,
+            "y": y_top_left,
+        }
+        detections.append(detection_data)
+    return detections
+
+
+def results_to_detection_array(results, t_capture):
+    """
+    Convert one YOLO result into a DETECTION_DTYPE structured array.
+
+    Built straight from the box tensors without a per-box loop; the array is
+    a single contiguous buffer, so it is cheap to pickle onto a queue.
+    """
+    boxes = results.boxes
+    detections = np.empty(len(boxes), dtype=DETECTION_DTYPE)
+    if len(detections):
+        xywh = boxes.xywh.cpu().numpy()
+        detections["cls"] = boxes.cls.cpu().numpy()
+        detections["x"] = xywh[:, 0] - xywh[:, 2] / 2
+        detections["y"] = xywh[:, 1] - xywh[:, 3] / 2
+        detections["w"] = xywh[:, 2]
+        detections["h"] = xywh[:, 3]
+        detections["conf"] = boxes.conf.cpu().numpy()
+    detections["t_capture"] = t_capture
+    return detections
+
+
+def class_names_tuple(names):
+    """model.names ({id: name}) as a tuple indexable by class id."""
+    return tuple(names[i] for i in range(len(names)))
+
+
+def build_output(results, names, v2x_statuses, t_capture, columnar=False):
+    """Bundle one frame's detections and V2X statuses for the perception queue."""
+    if columnar:
+        return {
+            "detections": results_to_detection_array(results, t_capture),
+            "class_names": class_names_tuple(names),
+            "v2x_statuses": v2x_statuses,
+            "t_capture": t_capture,
+        }
+    return {
+        "detections": results_to_detections(results, names),
+        "v2x_statuses": v2x_statuses,
+        "t_capture": t_capture,
+    }
+
+
+def publish_output(perception_queue, output_data, stamps, dropped):
+    """
+    Attach the frame's seq/stamps and the cumulative drop counters to an
+    output and put it on perception_queue. A full queue drops the output
+    (counted in dropped["perception_queue"]) instead of blocking.
+    """
+    if perception_queue.full():
+        dropped["perception_queue"] = dropped.get("perception_queue", 0) + 1
+        return False
+    output_data["seq"] = stamps.get("seq")
+    output_data["stamps"] = stamp(stamps, "t_published")
+    output_data["dropped"] = dict(dropped)
+    perception_queue.put(output_data)
+    return True
+
+
 def process_lane_image(image):
-    croppedRGB = image[150:820, :, :]
+    croppedRGB = image[LANE_CROP_ROWS[0] : LANE_CROP_ROWS[1], :, :]
     hsvBuf = cv2.cvtColor(croppedRGB, cv2.COLOR_BGR2HSV)
     yellow_bin = ImageProcessing.binary_thresholding(
-        hsvBuf, np.array([0, 0, 200]), np.array([45, 255, 255])
+        hsvBuf, LANE_YELLOW_LOW, LANE_YELLOW_HIGH
     )
 
     white_bin = ImageProcessing.binary_thresholding(
-        hsvBuf, np.array([0, 0, 200]), np.array([180, 50, 255])
+        hsvBuf, LANE_WHITE_LOW, LANE_WHITE_HIGH
     )
 
     return cv2.bitwise_or(yellow_bin, white_bin)
 
-def run_perception(perception_queue, actor_id, enable_lane=False):
+
+class LaneDetector:
+    """
+    Lane geometry from camera frames, without per-frame image allocations.
+
+    The HSV conversion and both thresholds write into buffers allocated once
+    for the frame size and are OR-ed in place. A line x = xc + slope * (y - yc)
+    is fitted to the lane pixels in each image half straight from the mask's
+    image moments, and update() returns a LaneMeasurement with the lateral
+    offset and heading error of the lane centre.
+    """
+
+    def __init__(self, frame_shape):
+        height, width = frame_shape[:2]
+        self.row_start = LANE_CROP_ROWS[0]
+        self.row_end = min(LANE_CROP_ROWS[1], height)
+        crop_shape = (self.row_end - self.row_start, width)
+        self.hsv = np.empty(crop_shape + (3,), dtype=np.uint8)
+        self.yellow = np.empty(crop_shape, dtype=np.uint8)
+        self.mask = np.empty(crop_shape, dtype=np.uint8)
+        self.center_x = width // 2
+
+    def threshold(self, image):
+        """Binary lane mask of the cropped frame (a view of self.mask)."""
+        cv2.cvtColor(image[self.row_start : self.row_end], cv2.COLOR_BGR2HSV, dst=self.hsv)
+        cv2.inRange(self.hsv, LANE_YELLOW_LOW, LANE_YELLOW_HIGH, dst=self.yellow)
+        cv2.inRange(self.hsv, LANE_WHITE_LOW, LANE_WHITE_HIGH, dst=self.mask)
+        cv2.bitwise_or(self.yellow, self.mask, dst=self.mask)
+        return self.mask
+
+    @staticmethod
+    def _fit_line(half_mask, x_offset):
+        """(xc, yc, slope) of the least-squares line x(y) through the mask pixels, or None."""
+        m = cv2.moments(half_mask, binaryImage=True)
+        if m["m00"] < LANE_MIN_PIXELS:
+            return None
+        slope = m["mu11"] / m["mu02"] if m["mu02"] > 0 else 0.0
+        return m["m10"] / m["m00"] + x_offset, m["m01"] / m["m00"], slope
+
+    def update(self, image, t_capture):
+        mask = self.threshold(image)
+        left = self._fit_line(mask[:, : self.center_x], 0)
+        right = self._fit_line(mask[:, self.center_x :], self.center_x)
+        if left is None and right is None:
+            return LaneMeasurement(t_capture, 0.0, 0.0, False)
+
+        # Evaluate the lines at the bottom row, closest to the car.
+        y_ref = mask.shape[0] - 1
+        meters_per_px = LANE_WIDTH_M / LANE_WIDTH_PX
+        if left is not None and right is not None:
+            x_left = left[0] + left[2] * (y_ref - left[1])
+            x_right = right[0] + right[2] * (y_ref - right[1])
+            lane_center = 0.5 * (x_left + x_right)
+            slope = 0.5 * (left[2] + right[2])
+            if x_right - x_left > 1:
+                meters_per_px = LANE_WIDTH_M / (x_right - x_left)
+        elif left is not None:
+            lane_center = left[0] + left[2] * (y_ref - left[1]) + LANE_WIDTH_PX / 2
+            slope = left[2]
+        else:
+            lane_center = right[0] + right[2] * (y_ref - right[1]) - LANE_WIDTH_PX / 2
+            slope = right[2]
+
+        offset_m = (lane_center - self.center_x) * meters_per_px
+        return LaneMeasurement(t_capture, offset_m, math.atan(slope), True)
+
+
+class LatestFrameBuffer:
+    """
+    Single-slot buffer joining two pipeline stages.
+
+    put() never blocks: a newer item overwrites one the consumer has not taken
+    yet, so the consumer always works on the freshest frame. Overwritten items
+    are counted in `dropped`.
+    """
+
+    def __init__(self):
+        self._item = None
+        self._has_item = False
+        self._cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if self._has_item:
+                self.dropped += 1
+            self._item = item
+            self._has_item = True
+            self._cond.notify()
+
+    def get(self, timeout=0.1):
+        """Return the newest item, or None if nothing arrived within timeout."""
+        with self._cond:
+            if not self._has_item:
+                self._cond.wait(timeout)
+                if not self._has_item:
+                    return None
+            item = self._item
+            self._item = None
+            self._has_item = False
+            return item
+
+
+class StageCounter:
+    """Throughput counter for one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy_s = 0.0
+        self.t_start = time.monotonic()
+
+    def record(self, busy_s):
+        self.count += 1
+        self.busy_s += busy_s
+
+    def snapshot(self):
+        elapsed = max(time.monotonic() - self.t_start, 1e-6)
+        return {
+            "frames": self.count,
+            "fps": self.count / elapsed,
+            "avg_ms": 1000.0 * self.busy_s / self.count if self.count else 0.0,
+            # Fraction of wall time spent working; the stage closest to 1.0
+            # is the bottleneck.
+            "busy": self.busy_s / elapsed,
+        }
+
+
+# Default display rate of the out-of-band visualization subscriber.
+VIS_RATE_HZ = 10.0
+
+
+class VisualizationSubscriber:
+    """
+    Out-of-band display of a car's detections.
+
+    The detection loop hands frames to offer(), which never blocks and keeps
+    at most rate_hz frames per second. Drawing (results.plot(), the lane
+    mask) and cv2.imshow/waitKey run on the subscriber's own thread, so a
+    slow window never delays detection. Pressing "q" sets `stop`.
+    """
+
+    def __init__(self, actor_id, rate_hz=VIS_RATE_HZ, enable_lane=False, stop=None):
+        self.actor_id = actor_id
+        self.period_s = 1.0 / rate_hz
+        self.enable_lane = enable_lane
+        self.stop = stop if stop is not None else threading.Event()
+        self.buffer = LatestFrameBuffer()
+        self._last_offer = 0.0
+        self._thread = threading.Thread(target=self._run)
+
+    def start(self):
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def offer(self, image, results):
+        """Hand over a frame for display; returns False if it was skipped by the rate limit."""
+        now = time.monotonic()
+        if now - self._last_offer < self.period_s:
+            return False
+        self._last_offer = now
+        self.buffer.put((image, results))
+        return True
+
+    def _run(self):
+        try:
+            while not KILL_THREAD and not self.stop.is_set():
+                item = self.buffer.get()
+                if item is None:
+                    continue
+                image, results = item
+                if self.enable_lane:
+                    binaryImage = process_lane_image(image)
+                    cv2.imshow("Combined Lane Detection", binaryImage)
+                window_name = f"YOLO Detection - Car {self.actor_id}"
+                cv2.imshow(window_name, results.plot())
+                if cv2.waitKey(1) & 0xFF == ord("q"):
+                    self.stop.set()
+        except Exception as e:
+            print(
+                f"[Perception-{self.actor_id}] Visualization error: {e}",
+                file=sys.stderr,
+            )
+        finally:
+            cv2.destroyAllWindows()
+
+
+# Per-car pipeline counters, keyed by actor id. Filled in by run_perception.
+STAGE_STATS = {}
+STAGE_STATS_PRINT_INTERVAL_S = 5.0
+
+
+class AdaptiveInferenceScheduler:
+    """
+    Chooses per frame between a full YOLO pass, a region-of-interest pass
+    around the previous detections, or no pass at all (see the
+    MOTION_THRESHOLD comment). Always returns a YOLO Results object in
+    full-frame coordinates, so downstream code is unchanged.
+    """
+
+    def __init__(
+        self,
+        model,
+        device,
+        conf=DETECTION_CONF,
+        motion_threshold=MOTION_THRESHOLD,
+        max_full_interval_s=MAX_FULL_INTERVAL_S,
+        roi_margin_px=ROI_MARGIN_PX,
+    ):
+        self.model = model
+        self.device = device
+        self.conf = conf
+        self.motion_threshold = motion_threshold
+        self.max_full_interval_s = max_full_interval_s
+        self.roi_margin_px = roi_margin_px
+        self._reference = None
+        self._last_full_time = -float("inf")
+        self._last_boxes = None
+        self.counts = {"frames": 0, "full": 0, "roi": 0, "skipped": 0}
+
+    def motion_score(self, image):
+        """Mean abs difference to the last fully inferred frame, plus the downsampled frame."""
+        small = cv2.cvtColor(
+            cv2.resize(image, MOTION_DOWNSAMPLE, interpolation=cv2.INTER_AREA),
+            cv2.COLOR_BGR2GRAY,
+        )
+        if self._reference is None:
+            return float("inf"), small
+        return float(cv2.absdiff(small, self._reference).mean()), small
+
+    def infer(self, image):
+        self.counts["frames"] += 1
+        now = time.monotonic()
+        score, small = self.motion_score(image)
+
+        if (
+            score > self.motion_threshold
+            or now - self._last_full_time > self.max_full_interval_s
+        ):
+            results = self.model(
+                image, device=self.device, conf=self.conf, verbose=False
+            )[0]
+            self._reference = small
+            self._last_full_time = now
+            self.counts["full"] += 1
+        elif self._last_boxes is not None and len(self._last_boxes):
+            results = self._infer_roi(image)
+            self.counts["roi"] += 1
+        else:
+            results = Results(
+                image, path=None, names=self.model.names, boxes=torch.zeros((0, 6))
+            )
+            self.counts["skipped"] += 1
+
+        self._last_boxes = results.boxes.data
+        return results
+
+    def _infer_roi(self, image):
+        """Run the model on the bounding region of the previous detections."""
+        h, w = image.shape[:2]
+        xyxy = self._last_boxes[:, :4]
+        x0 = max(int(xyxy[:, 0].min()) - self.roi_margin_px, 0)
+        y0 = max(int(xyxy[:, 1].min()) - self.roi_margin_px, 0)
+        x1 = min(int(xyxy[:, 2].max()) + self.roi_margin_px, w)
+        y1 = min(int(xyxy[:, 3].max()) + self.roi_margin_px, h)
+
+        crop_results = self.model(
+            image[y0:y1, x0:x1], device=self.device, conf=self.conf, verbose=False
+        )[0]
+        data = crop_results.boxes.data.clone()
+        data[:, [0, 2]] += x0
+        data[:, [1, 3]] += y0
+        return Results(image, path=None, names=self.model.names, boxes=data)
+
+    def report(self):
+        """How many inference calls the scheduler saved compared to a full pass per frame."""
+        frames = self.counts["frames"]
+        return {
+            **self.counts,
+            "full_passes_saved": frames - self.counts["full"],
+            "calls_saved": self.counts["skipped"],
+            "saved_fraction": (frames - self.counts["full"]) / frames if frames else 0.0,
+        }
+
+
+def get_stage_stats(actor_id):
+    """Snapshot of the per-stage throughput counters for one car."""
+    stats = STAGE_STATS.get(actor_id)
+    if stats is None:
+        return {}
+    snapshot = {name: counter.snapshot() for name, counter in stats["stages"].items()}
+    snapshot["dropped"] = {
+        name: buffer.dropped for name, buffer in stats["buffers"].items()
+    }
+    if stats.get("scheduler") is not None:
+        snapshot["scheduler"] = stats["scheduler"].report()
+    return snapshot
+
+
+def print_stage_stats(actor_id):
+    stats = get_stage_stats(actor_id)
+    if not stats:
+        return
+    dropped = stats.pop("dropped")
+    scheduler = stats.pop("scheduler", None)
+    parts = [
+        f"{name}: {s['fps']:.1f} fps, {s['avg_ms']:.1f} ms, {100 * s['busy']:.0f}% busy"
+        for name, s in stats.items()
+    ]
+    print(f"[Perception-{actor_id}] " + " | ".join(parts) + f" | dropped {dropped}")
+    if scheduler is not None:
+        print(
+            f"[Perception-{actor_id}] Adaptive: {scheduler['frames']} frames, "
+            f"{scheduler['full']} full / {scheduler['roi']} ROI / "
+            f"{scheduler['skipped']} skipped -> {scheduler['full_passes_saved']} full "
+            f"passes saved ({100 * scheduler['saved_fraction']:.0f}%), "
+            f"{scheduler['calls_saved']} calls saved"
+        )
+
+
+def _capture_stage(car, camera, frame_buffer, counter, stop, v2x_poller=None):
+    """
+    Fetch camera frames and attach the latest cached V2X statuses.
+
+    `car` is a QLabsQCar2 or anything with the same get_image(), such as
+    frame_log.ReplayCamera; a source that sets `finished` stops the pipeline.
+    """
+    try:
+        seq = 0
+        while not KILL_THREAD and not stop.is_set():
+            t0 = time.perf_counter()
+            t_grab = time.monotonic()
+            ok, image = car.get_image(camera)
+            t_capture = time.monotonic()
+            if not ok:
+                if getattr(car, "finished", False):
+                    stop.set()
+                    break
+                time.sleep(0.01)
+                continue
+            seq += 1
+            v2x_statuses = []
+            if v2x_poller is not None:
+                v2x_statuses = v2x_poller.statuses()
+            frame_buffer.put((image, v2x_statuses, new_stamps(seq, t_grab, t_capture)))
+            counter.record(time.perf_counter() - t0)
+    except Exception as e:
+        print(f"[Perception] Capture stage error: {e}", file=sys.stderr)
+        stop.set()
+
+
+def _inference_stage(infer, frame_buffer, result_buffer, counter, stop):
+    """Run infer(image) -> YOLO Results on the newest captured frame."""
+    try:
+        while not KILL_THREAD and not stop.is_set():
+            item = frame_buffer.get()
+            if item is None:
+                continue
+            image, v2x_statuses, stamps = item
+            t0 = time.perf_counter()
+            stamp(stamps, "t_infer_start")
+            results = infer(image)
+            stamp(stamps, "t_inferred")
+            result_buffer.put((image, results, v2x_statuses, stamps))
+            counter.record(time.perf_counter() - t0)
+    except Exception as e:
+        print(f"[Perception] Inference stage error: {e}", file=sys.stderr)
+        stop.set()
+
+
+def run_perception(
+    perception_queue,
+    actor_id,
+    enable_lane=False,
+    columnar=False,
+    headless=False,
+    vis_rate_hz=VIS_RATE_HZ,
+    backend=INFERENCE_BACKEND,
+    adaptive=False,
+    lane_queue=None,
+    camera_source=None,
+    record_path=None,
+):
     """
     This function handles the perception pipeline AND V2X data gathering.
     It sends results to a queue.
+
+    The work is split into three stages running at the same time: capture
+    (camera + V2X), inference, and post-processing (publishing and display,
+    run on this thread). Stages are joined by LatestFrameBuffers, so the
+    camera is already fetching the next frame while the current one is being
+    inferred and stale frames are dropped instead of queued.
+
+    With columnar=True the detections are sent as one DETECTION_DTYPE array
+    per frame (plus the model's class names) instead of a list of dicts.
+
+    Display is handled by a VisualizationSubscriber at vis_rate_hz. With
+    headless=True nothing is drawn at all (including the lane debug window).
+
+    `backend` picks the inference runtime; all of them produce the same
+    detection output. adaptive=True runs inference through an
+    AdaptiveInferenceScheduler (frame skipping / ROI passes).
+
+    With enable_lane=True a LaneDetector runs on every frame and its
+    LaneMeasurement is put on lane_queue (if given) for the steering loop.
+
+    camera_source replaces the QLabs camera and V2X poller (e.g. a
+    frame_log.ReplayCamera; no QLabs connection is opened). With record_path
+    every frame, its V2X statuses and detections are written to a
+    frame_log.FrameLogWriter log.
     """
     print(f"[Perception-{actor_id}] Starting thread...")
-    MODEL_PATH = "model/best.pt"
     CAMERA_TO_USE = QLabsQCar2.CAMERA_CSI_FRONT
 
     qlabs = None
+    stop = threading.Event()
+    stage_threads = []
+    visualizer = None
+    lane_detector = None
+    v2x_poller = None
+    v2x_source = None
+    log_writer = None
     try:
-        qlabs = QuanserInteractiveLabs()
-        qlabs.open("localhost")
-        print(f"[Perception-{actor_id}] ✅ Connection successful!")
+        if camera_source is None:
+            qlabs = QuanserInteractiveLabs()
+            qlabs.open("localhost")
+            print(f"[Perception-{actor_id}] ✅ Connection successful!")
         print("Is Cuda available?", torch.cuda.is_available())
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model = YOLO(MODEL_PATH).to(device)
-        print(f"[Perception-{actor_id}] ✅ Model loaded on '{device}'!")
+        model, device = load_model(backend, MODEL_PATH)
+        print(f"[Perception-{actor_id}] ✅ {backend} model loaded on '{device}'!")
 
-        car = QLabsQCar2(qlabs)
-        car.actorNumber = actor_id
-        car.possess()
-        print(f"[Perception-{actor_id}] ✅ Attached to QCar #{actor_id}.")
+        if camera_source is None:
+            car = QLabsQCar2(qlabs)
+            car.actorNumber = actor_id
+            car.possess()
+            print(f"[Perception-{actor_id}] ✅ Attached to QCar #{actor_id}.")
+        else:
+            car = camera_source
+            v2x_source = camera_source
+            print(f"[Perception-{actor_id}] ✅ Reading frames from {camera_source}.")
 
         # --- NEW: V2X Setup ---
-        global traffic_light_handles
-        if not IS_PHYSICAL_QCAR:
-            for config in TRAFFIC_LIGHTS_CONFIG:
-                light = QLabsTrafficLight(qlabs)
-                # We don't spawn, just get a handle to the existing light
-                light.actorNumber = config["id"]
-                traffic_light_handles.append(light)
+        if camera_source is None and not IS_PHYSICAL_QCAR:
+            v2x_poller = V2XPoller().start()
+            v2x_source = v2x_poller
             print(
-                f"[Perception-{actor_id}] ✅ Attached to {len(traffic_light_handles)} traffic lights."
+                f"[Perception-{actor_id}] ✅ Polling {len(v2x_poller.handles)} traffic lights "
+                f"at {1 / v2x_poller.period_s:.0f} Hz."
             )
         # --- END NEW ---
 
-        # Main Detection Loop
-        while not KILL_THREAD:
-            ok, image = car.get_image(CAMERA_TO_USE)
-            if ok:
-                if enable_lane:
-                    binaryImage = process_lane_image(image)
-                    cv2.imshow("Combined Lane Detection", binaryImage)
-                results = model(image, device=device, conf=0.4, verbose=False)[0]
-
-                # --- NEW: Bundle perception AND v2x data ---
-                detections = []
-                for box in results.boxes:
-                    class_id = int(box.cls)
-                    class_name = model.names[class_id]
-                    x_center, y_center, width, height = box.xywh[0]
-                    x_top_left = x_center.item() - (width.item() / 2)
-                    y_top_left = y_center.item() - (height.item() / 2)
-
-                    detection_data = {
-                        "class": class_name,
-                        "width": width.item(),
-                        "height": height.item(),
-                        "x": x_top_left,
-                        "y": y_top_left,
-                    }
-                    detections.append(detection_data)
-
-                # --- NEW: Get V2X Statuses ---
-                v2x_statuses = []
-                if not IS_PHYSICAL_QCAR:
-                    v2x_statuses = get_traffic_lights_status()
-
-                # --- NEW: Send bundled data dictionary ---
-                output_data = {"detections": detections, "v2x_statuses": v2x_statuses}
-
-                if not perception_queue.full():
-                    perception_queue.put(output_data)
-                # --- END NEW ---
-
-                # Optional: still show the annotated image
-                annotated_image = results.plot()
-                window_name = f"YOLO Detection - Car {actor_id}"
-                cv2.imshow(window_name, annotated_image)
-                if cv2.waitKey(1) & 0xFF == ord("q"):
-                    break
-            else:
-                time.sleep(0.01)
+        # --- Pipeline setup ---
+        scheduler = None
+        if adaptive:
+            scheduler = AdaptiveInferenceScheduler(model, device)
+            infer = scheduler.infer
+        else:
+
+            def infer(image):
+                return model(image, device=device, conf=DETECTION_CONF, verbose=False)[0]
+
+        frame_buffer = LatestFrameBuffer()
+        result_buffer = LatestFrameBuffer()
+        counters = {
+            "capture": StageCounter("capture"),
+            "inference": StageCounter("inference"),
+            "postprocess": StageCounter("postprocess"),
+        }
+        STAGE_STATS[actor_id] = {
+            "stages": counters,
+            "buffers": {"frame": frame_buffer, "result": result_buffer},
+            "scheduler": scheduler,
+        }
+        stage_threads = [
+            threading.Thread(
+                target=_capture_stage,
+                args=(
+                    car,
+                    CAMERA_TO_USE,
+                    frame_buffer,
+                    counters["capture"],
+                    stop,
+                    v2x_source,
+                ),
+            ),
+            threading.Thread(
+                target=_inference_stage,
+                args=(
+                    infer,
+                    frame_buffer,
+                    result_buffer,
+                    counters["inference"],
+                    stop,
+                ),
+            ),
+        ]
+        for stage_thread in stage_threads:
+            stage_thread.start()
+
+        if not headless:
+            visualizer = VisualizationSubscriber(
+                actor_id, rate_hz=vis_rate_hz, enable_lane=enable_lane, stop=stop
+            )
+            visualizer.start()
+
+        # Main Detection Loop (post-process stage)
+        last_stats_print = time.monotonic()
+        dropped = {}
+        while not KILL_THREAD and not stop.is_set():
+            item = result_buffer.get()
+            if item is None:
+                continue
+            image, results, v2x_statuses, stamps = item
+            t_capture = stamps["t_capture"]
+            t0 = time.perf_counter()
+
+            if enable_lane:
+                if lane_detector is None:
+                    lane_detector = LaneDetector(image.shape)
+                lane = lane_detector.update(image, t_capture)
+                if lane_queue is not None:
+                    if lane_queue.full():
+                        dropped["lane_queue"] = dropped.get("lane_queue", 0) + 1
+                    else:
+                        lane_queue.put(lane)
+
+            # --- NEW: Bundle perception AND v2x data ---
+            output_data = build_output(
+                results, model.names, v2x_statuses, t_capture, columnar
+            )
+
+            dropped["frame_buffer"] = frame_buffer.dropped
+            dropped["result_buffer"] = result_buffer.dropped
+            publish_output(perception_queue, output_data, stamps, dropped)
+            # --- END NEW ---
+
+            if record_path is not None:
+                if log_writer is None:
+                    from frame_log import FrameLogWriter
+
+                    log_writer = FrameLogWriter(
+                        record_path, image.shape, class_names_tuple(model.names)
+                    )
+                    print(f"[Perception-{actor_id}] ✅ Recording to '{record_path}'.")
+                log_writer.append(
+                    t_capture,
+                    image,
+                    v2x_statuses,
+                    results_to_detection_array(results, t_capture),
+                )
+
+            # Optional: still show the annotated image (drawn off this thread)
+            if visualizer is not None:
+                visualizer.offer(image, results)
+            counters["postprocess"].record(time.perf_counter() - t0)
+
+            if time.monotonic() - last_stats_print > STAGE_STATS_PRINT_INTERVAL_S:
+                print_stage_stats(actor_id)
+                last_stats_print = time.monotonic()
 
     except Exception as e:
         print(f"[Perception-{actor_id}] An error occurred: {e}", file=sys.stderr)
     finally:
         print(f"[Perception-{actor_id}] Stopping thread.")
+        stop.set()
+        for stage_thread in stage_threads:
+            stage_thread.join()
+        if visualizer is not None:
+            visualizer.join()
+        if v2x_poller is not None:
+            v2x_poller.stop()
+        if log_writer is not None:
+            print(
+                f"[Perception-{actor_id}] Recorded {log_writer.n_records} frames "
+                f"({log_writer.truncated} past log capacity)."
+            )
+            log_writer.close()
+        print_stage_stats(actor_id)
+        if qlabs:
+            qlabs.close()
+
+
+class BatchedInferenceServer:
+    """
+    One shared YOLO model serving several cars.
+
+    Each car submits its latest camera frame; the server groups pending frames
+    into a single batched forward pass (up to max_batch_size frames, waiting
+    at most max_wait_s for a batch to fill) and puts each car's detections on
+    that car's perception queue. Only the newest frame of a car is kept, so a
+    slow batch never builds up a backlog of stale frames.
+    """
+
+    def __init__(
+        self,
+        model_path=MODEL_PATH,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_s=MAX_BATCH_WAIT_S,
+        conf=DETECTION_CONF,
+        columnar=False,
+        backend=INFERENCE_BACKEND,
+    ):
+        self.model, self.device = load_model(backend, model_path)
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+        self.conf = conf
+        self.columnar = columnar
+        self.perception_queues = {}
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.frames_processed = 0
+        self.batches_processed = 0
+        self.dropped = {}
+        self.seqs = {}
+        self.error = None  # exception that ended run(), if any
+
+    def register(self, actor_id, perception_queue):
+        self.perception_queues[actor_id] = perception_queue
+        self.dropped[actor_id] = {"pending": 0, "perception_queue": 0}
+        self.seqs[actor_id] = 0
+
+    def submit(self, actor_id, image, v2x_statuses=None, t_capture=None, t_grab=None):
+        """Queue a frame for the next batch, replacing any unprocessed one from the same car."""
+        if t_capture is None:
+            t_capture = time.monotonic()
+        with self.cond:
+            self.seqs[actor_id] += 1
+            stamps = new_stamps(
+                self.seqs[actor_id], t_capture if t_grab is None else t_grab, t_capture
+            )
+            if actor_id in self.pending:
+                self.dropped[actor_id]["pending"] += 1
+            self.pending[actor_id] = (image, v2x_statuses or [], stamps)
+            self.cond.notify()
+
+    def _collect_batch(self, stop):
+        with self.cond:
+            while not self.pending:
+                if KILL_THREAD or stop.is_set():
+                    return []
+                self.cond.wait(0.1)
+
+            # A batch can never hold more than one frame per car.
+            target = min(self.max_batch_size, len(self.perception_queues))
+            deadline = time.monotonic() + self.max_wait_s
+            while len(self.pending) < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            actor_ids = list(self.pending)[: self.max_batch_size]
+            return [(actor_id, self.pending.pop(actor_id)) for actor_id in actor_ids]
+
+    def run(self, stop):
+        """
+        Serve batches until stop is set. An exception ends the loop, is kept
+        in self.error and sets stop, so the capture side stops too.
+        """
+        try:
+            while not KILL_THREAD and not stop.is_set():
+                batch = self._collect_batch(stop)
+                if not batch:
+                    continue
+
+                images = [image for _, (image, _, _) in batch]
+                t_infer_start = time.monotonic()
+                batch_results = self.model(
+                    images, device=self.device, conf=self.conf, verbose=False
+                )
+                t_inferred = time.monotonic()
+
+                for (actor_id, (_, v2x_statuses, stamps)), results in zip(
+                    batch, batch_results
+                ):
+                    stamps["t_infer_start"] = t_infer_start
+                    stamps["t_inferred"] = t_inferred
+                    output_data = build_output(
+                        results,
+                        self.model.names,
+                        v2x_statuses,
+                        stamps["t_capture"],
+                        self.columnar,
+                    )
+                    publish_output(
+                        self.perception_queues[actor_id],
+                        output_data,
+                        stamps,
+                        self.dropped[actor_id],
+                    )
+
+                self.frames_processed += len(batch)
+                self.batches_processed += 1
+        except Exception as e:
+            self.error = e
+            stop.set()
+
+
+def run_batched_perception(
+    perception_queues,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_s=MAX_BATCH_WAIT_S,
+    columnar=False,
+    backend=INFERENCE_BACKEND,
+):
+    """
+    Perception for several cars sharing one model.
+
+    perception_queues maps each QCar actor id to the queue its controller
+    reads from. Frames are captured round-robin from every car and inferred
+    in batches by a BatchedInferenceServer.
+    """
+    print(f"[Perception-Batch] Starting for cars {list(perception_queues)}...")
+    CAMERA_TO_USE = QLabsQCar2.CAMERA_CSI_FRONT
+
+    qlabs = None
+    server_thread = None
+    v2x_poller = None
+    stop = threading.Event()  # shared by the capture loop and the server thread
+    try:
+        qlabs = QuanserInteractiveLabs()
+        qlabs.open("localhost")
+        print("[Perception-Batch] ✅ Connection successful!")
+
+        server = BatchedInferenceServer(
+            max_batch_size=max_batch_size,
+            max_wait_s=max_wait_s,
+            columnar=columnar,
+            backend=backend,
+        )
+        print(f"[Perception-Batch] ✅ Model loaded on '{server.device}'!")
+
+        cars = {}
+        for actor_id, perception_queue in perception_queues.items():
+            car = QLabsQCar2(qlabs)
+            car.actorNumber = actor_id
+            cars[actor_id] = car
+            server.register(actor_id, perception_queue)
+        print(f"[Perception-Batch] ✅ Attached to {len(cars)} QCars.")
+
+        if not IS_PHYSICAL_QCAR:
+            v2x_poller = V2XPoller().start()
+
+        t_start = time.monotonic()
+        server_thread = threading.Thread(target=server.run, args=(stop,))
+        server_thread.start()
+
+        while not KILL_THREAD and not stop.is_set():
+            # One V2X snapshot is shared by every car captured in this round.
+            v2x_statuses = []
+            if v2x_poller is not None:
+                v2x_statuses = v2x_poller.statuses()
+
+            any_ok = False
+            for actor_id, car in cars.items():
+                # Each car is possessed before its capture, as in run_perception,
+                # so the frame comes from that car and not the active view.
+                car.possess()
+                t_grab = time.monotonic()
+                ok, image = car.get_image(CAMERA_TO_USE)
+                if ok:
+                    any_ok = True
+                    server.submit(actor_id, image, v2x_statuses, time.monotonic(), t_grab)
+            if not any_ok:
+                time.sleep(0.01)
+        if server.error is not None:
+            raise server.error
+
+    except Exception as e:
+        print(f"[Perception-Batch] An error occurred: {e}", file=sys.stderr)
+    finally:
+        print("[Perception-Batch] Stopping.")
+        stop.set()
+        if v2x_poller is not None:
+            v2x_poller.stop()
+        if server_thread is not None:
+            server_thread.join()
+            elapsed = time.monotonic() - t_start
+            avg_batch = server.frames_processed / max(server.batches_processed, 1)
+            print(
+                f"[Perception-Batch] {server.frames_processed} frames in "
+                f"{server.batches_processed} batches (avg {avg_batch:.2f}/batch, "
+                f"{server.frames_processed / max(elapsed, 1e-6):.1f} fps total)"
+            )
         if qlabs:
             qlabs.close()
-        cv2.destroyAllWindows()
+
+
+def frame_ring_name(actor_id):
+    return f"qcar{actor_id}_frames"
+
+
+def attach_frame_ring(actor_id, stop_event, timeout=FRAME_RING_ATTACH_TIMEOUT_S):
+    """
+    Wait for the car's FrameRing to appear. Returns None if stop_event is set
+    first (e.g. capture failed before its first frame); raises
+    FileNotFoundError after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while not stop_event.is_set():
+        try:
+            return FrameRing.attach(frame_ring_name(actor_id), timeout=0.1)
+        except FileNotFoundError:
+            if time.monotonic() > deadline:
+                raise
+    return None
+
+
+def run_capture_process(actor_id, stop_event):
+    """
+    Capture-only process: writes camera frames (and V2X statuses) of one car
+    into a shared-memory FrameRing named frame_ring_name(actor_id). The ring
+    is created from the first frame's shape.
+    """
+    print(f"[Capture-{actor_id}] Starting process...")
+    CAMERA_TO_USE = QLabsQCar2.CAMERA_CSI_FRONT
+
+    qlabs = None
+    ring = None
+    v2x_poller = None
+    try:
+        qlabs = QuanserInteractiveLabs()
+        qlabs.open("localhost")
+        car = QLabsQCar2(qlabs)
+        car.actorNumber = actor_id
+        car.possess()
+        if not IS_PHYSICAL_QCAR:
+            v2x_poller = V2XPoller().start()
+        print(f"[Capture-{actor_id}] ✅ Attached to QCar #{actor_id}.")
+
+        while not stop_event.is_set():
+            ok, image = car.get_image(CAMERA_TO_USE)
+            t_capture = time.monotonic()
+            if not ok:
+                time.sleep(0.01)
+                continue
+            if ring is None:
+                ring = FrameRing.create(frame_ring_name(actor_id), image.shape)
+                print(f"[Capture-{actor_id}] ✅ Frame ring {image.shape} x {ring.n_slots} created.")
+            v2x_statuses = []
+            if v2x_poller is not None:
+                v2x_statuses = v2x_poller.statuses()
+            ring.write(image, t_capture, v2x_statuses)
+
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"[Capture-{actor_id}] An error occurred: {e}", file=sys.stderr)
+    finally:
+        print(f"[Capture-{actor_id}] Stopping process.")
+        stop_event.set()
+        if v2x_poller is not None:
+            v2x_poller.stop()
+        if ring is not None:
+            ring.close()
+        if qlabs:
+            qlabs.close()
+
+
+def run_inference_process(
+    actor_id,
+    perception_queue,
+    stop_event,
+    reader_index=0,
+    n_readers=1,
+    columnar=False,
+    backend=INFERENCE_BACKEND,
+    max_frame_age_s=MAX_FRAME_AGE_S,
+):
+    """
+    Inference process reading frames in place from the car's FrameRing.
+
+    With n_readers processes, reader i infers frames whose sequence number
+    is i modulo n_readers, so inference scales across cores without copying
+    frames. Results from frames that were overwritten while being inferred
+    (torn) or that are older than max_frame_age_s (stale) are discarded.
+    """
+    tag = f"[Inference-{actor_id}.{reader_index}]"
+    print(f"{tag} Starting process...")
+    ring = None
+    processed = stale = 0
+    dropped = {}
+    try:
+        model, device = load_model(backend, MODEL_PATH)
+        print(f"{tag} ✅ {backend} model loaded on '{device}'!")
+        ring = attach_frame_ring(actor_id, stop_event)
+        if ring is None:
+            return
+
+        last_seq = 0
+        while not stop_event.is_set():
+            seq = ring.next_seq_for(last_seq, reader_index, n_readers)
+            if seq is None:
+                time.sleep(0.001)
+                continue
+            last_seq = seq
+
+            # view() counts frames it cannot deliver in ring.missed / ring.torn.
+            item = ring.view(seq)
+            if item is None:
+                continue
+            image, t_capture, v2x_statuses, lock = item
+            if time.monotonic() - t_capture > max_frame_age_s:
+                stale += 1
+                continue
+
+            stamps = {"seq": seq, "t_capture": t_capture}
+            stamp(stamps, "t_infer_start")
+            results = model(image, device=device, conf=DETECTION_CONF, verbose=False)[0]
+            stamp(stamps, "t_inferred")
+            if not ring.is_intact(seq, lock):
+                ring.torn += 1
+                continue
+
+            output_data = build_output(
+                results, model.names, v2x_statuses, t_capture, columnar
+            )
+            dropped["ring_missed"] = ring.missed
+            dropped["ring_torn"] = ring.torn
+            dropped["stale"] = stale
+            publish_output(perception_queue, output_data, stamps, dropped)
+            processed += 1
+
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"{tag} An error occurred: {e}", file=sys.stderr)
+    finally:
+        if ring is not None:
+            print(
+                f"{tag} {processed} frames inferred, {ring.missed} missed, "
+                f"{ring.torn} torn, {stale} stale."
+            )
+            ring.close()
+        print(f"{tag} Stopping process.")
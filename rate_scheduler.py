@@ -0,0 +1,108 @@
+# rate_scheduler.py
+# Fixed-rate loop timing on time.perf_counter, with live statistics.
+#
+# Tick k is due at t_start + k * period. wait() sleeps until the next due
+# tick (coarse sleep, then a short spin for the last SCHEDULER_SPIN_S), so
+# the rate does not drift with how long each iteration took. A tick whose
+# work ran past the next deadline is an overrun; the catch-up policy decides
+# whether the ticks missed meanwhile are skipped (the default: the schedule
+# jumps to the next future deadline) or run back to back to catch up.
+# perf_counter rather than time.monotonic: on Windows monotonic ticks in
+# ~15.6 ms steps, too coarse to spin on at 100+ Hz.
+import time
+from latency import LatencyStats
+
+# Busy-wait this long before a deadline instead of sleeping (sleep overshoots).
+SCHEDULER_SPIN_S = 0.0002
+# With catch_up="burst", run at most this many late ticks back to back.
+SCHEDULER_MAX_BURST = 5
+
+
+class RateScheduler:
+    """
+    Deadline-driven fixed-rate scheduler.
+
+    Call wait() at the top of every iteration (returns the time since the
+    previous tick, i.e. the loop's dt) and done() when the iteration's work
+    is finished. Per-tick period, start jitter (lateness against the
+    deadline) and compute time go into log-scale histograms; overruns and
+    skipped ticks are counted.
+    """
+
+    def __init__(
+        self,
+        rate_hz,
+        catch_up="skip",
+        spin_s=SCHEDULER_SPIN_S,
+        clock=time.perf_counter,
+        sleep=time.sleep,
+    ):
+        if catch_up not in ("skip", "burst"):
+            raise ValueError(f"catch_up must be 'skip' or 'burst', got '{catch_up}'")
+        self.period = 1.0 / rate_hz
+        self.catch_up = catch_up
+        self.spin_s = spin_s
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = LatencyStats("rate_scheduler")
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.t_start = None
+        self.deadline = None
+        self.t_tick = None
+        self.t_work = None
+
+    def wait(self):
+        """Block until the next tick is due; returns the seconds since the previous tick."""
+        now = self.clock()
+        if self.deadline is None:
+            self.t_start = self.deadline = now
+        else:
+            self.deadline += self.period
+            if now > self.deadline + self.period:
+                # At least one whole tick was missed.
+                late_ticks = int((now - self.deadline) / self.period)
+                if self.catch_up == "skip" or late_ticks > SCHEDULER_MAX_BURST:
+                    self.skipped += late_ticks
+                    self.deadline += late_ticks * self.period
+            remaining = self.deadline - now
+            if remaining > self.spin_s:
+                self.sleep(remaining - self.spin_s)
+            while self.clock() < self.deadline:
+                pass
+            now = self.clock()
+
+        dt = 0.0 if self.t_tick is None else now - self.t_tick
+        if self.t_tick is not None:
+            self.stats.record("period", dt)
+        self.stats.record("jitter", now - self.deadline)
+        self.t_tick = now
+        self.t_work = time.perf_counter()
+        self.ticks += 1
+        return dt
+
+    def done(self):
+        """Mark the end of the current tick's work."""
+        # Compute time is wall time even when the schedule runs on a simulated clock.
+        self.stats.record("compute", time.perf_counter() - self.t_work)
+        if self.clock() > self.deadline + self.period:
+            self.overruns += 1
+
+    def rate(self):
+        """Achieved tick rate since the first tick (Hz)."""
+        if self.ticks < 2:
+            return 0.0
+        return (self.ticks - 1) / (self.t_tick - self.t_start)
+
+    def format(self):
+        lines = [
+            f"rate {self.rate():7.2f} Hz (target {1.0 / self.period:.2f})  ticks={self.ticks}  "
+            f"overruns={self.overruns}  skipped={self.skipped}"
+        ]
+        lines += self.stats.format()[:-1]  # histograms; the drop counters do not apply
+        return lines
+
+    def print(self, tag):
+        for line in self.format():
+            print(f"{tag} {line}")
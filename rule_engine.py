@@ -0,0 +1,383 @@
+# rule_engine.py
+# Table-driven stop/go rules for controller_qcar.
+#
+# Every stop reason is a Condition (one bit of a state mask, with how it times
+# out) and every way a detection can raise or clear one is a Rule, declared
+# once with its class, size/position thresholds, cooldown and which other
+# conditions must be set or clear. RuleEngine compiles the table into NumPy
+# arrays and evaluates all rules against a frame's detections in one
+# vectorized pass, so adding rules does not add Python work per frame. It has
+# no queue or QLabs dependencies and can be driven directly in tests.
+import numpy as np
+
+INF = float("inf")
+
+
+class Condition:
+    """
+    A stop reason.
+
+    timeout_s clears the condition automatically: measured from when it was
+    set (timeout_from="start") or from the last time one of its `seen`
+    detections was observed (timeout_from="seen"). `seen` entries are
+    (class, min_width, min_height) tuples; sizes are strict lower bounds.
+    """
+
+    def __init__(self, name, timeout_s=None, timeout_from="start", seen=()):
+        if timeout_from not in ("start", "seen"):
+            raise ValueError(f"timeout_from must be 'start' or 'seen', got '{timeout_from}'")
+        self.name = name
+        self.timeout_s = INF if timeout_s is None else timeout_s
+        self.timeout_from = timeout_from
+        self.seen = tuple(seen)
+
+
+class Rule:
+    """
+    When a detection of class `cls` matches, set or clear `condition`.
+
+    A detection matches when min_width < width <= max_width,
+    min_height < height <= max_height and x_range[0] < x < x_range[1];
+    outside=True inverts that geometric test (the class must still match).
+    The rule is only armed while every condition in requires_set is set and
+    every condition in requires_clear is clear (default: all conditions
+    other than those in requires_set). cooldown_s blocks a "set" rule until
+    that long after its condition was last set.
+    """
+
+    def __init__(
+        self,
+        condition,
+        action,
+        cls,
+        min_width=-INF,
+        max_width=INF,
+        min_height=-INF,
+        max_height=INF,
+        x_range=(-INF, INF),
+        outside=False,
+        cooldown_s=0.0,
+        requires_set=(),
+        requires_clear=None,
+    ):
+        if action not in ("set", "clear"):
+            raise ValueError(f"action must be 'set' or 'clear', got '{action}'")
+        self.condition = condition
+        self.action = action
+        self.cls = cls
+        self.min_width = min_width
+        self.max_width = max_width
+        self.min_height = min_height
+        self.max_height = max_height
+        self.x_range = tuple(x_range)
+        self.outside = outside
+        self.cooldown_s = cooldown_s
+        self.requires_set = tuple(requires_set)
+        self.requires_clear = None if requires_clear is None else tuple(requires_clear)
+
+
+class RuleEngine:
+    """
+    Compiled rule table plus the state it acts on.
+
+    Conditions are bits 0..n-1 of `state` in declaration order; among the
+    rules acting on one condition, earlier declarations take priority. Classes
+    are mapped to small integer ids with class_id()/class_ids(); unknown
+    classes get -1 and match nothing.
+    """
+
+    def __init__(self, conditions, rules):
+        self.conditions = list(conditions)
+        self.rules = list(rules)
+        self.names = [c.name for c in self.conditions]
+        index = {name: i for i, name in enumerate(self.names)}
+        if len(index) != len(self.names):
+            raise ValueError("Condition names must be unique")
+        if len(self.conditions) > 62:
+            raise ValueError("At most 62 conditions fit in the state mask")
+        self.bits = {name: 1 << i for name, i in index.items()}
+        self._bit_values = np.int64(1) << np.arange(len(self.conditions), dtype=np.int64)
+        all_mask = (1 << len(self.conditions)) - 1
+
+        classes = sorted(
+            {rule.cls for rule in self.rules}
+            | {seen[0] for c in self.conditions for seen in c.seen}
+        )
+        self._class_index = {name: i for i, name in enumerate(classes)}
+        self.classes = tuple(classes)
+
+        # --- Conditions ---
+        self.timeout_s = np.array([c.timeout_s for c in self.conditions])
+        self.timeout_from_seen = np.array([c.timeout_from == "seen" for c in self.conditions])
+        seen_rows = [
+            (index[c.name], self._class_index[cls], min_w, min_h)
+            for c in self.conditions
+            for cls, min_w, min_h in c.seen
+        ]
+        self.seen_condition = np.array([r[0] for r in seen_rows], dtype=np.int64)
+        self.seen_cls = np.array([r[1] for r in seen_rows], dtype=np.int64)
+        self.seen_min_w = np.array([r[2] for r in seen_rows], dtype=float)
+        self.seen_min_h = np.array([r[3] for r in seen_rows], dtype=float)
+
+        # --- Rules ---
+        def mask_of(names):
+            mask = 0
+            for name in names:
+                mask |= self.bits[name]
+            return mask
+
+        self.rule_condition = np.array([index[r.condition] for r in self.rules], dtype=np.int64)
+        self.rule_bit = np.array([self.bits[r.condition] for r in self.rules], dtype=np.int64)
+        self.rule_sets = np.array([r.action == "set" for r in self.rules])
+        self.rule_cls = np.array([self._class_index[r.cls] for r in self.rules], dtype=np.int64)
+        self.rule_min_w = np.array([r.min_width for r in self.rules], dtype=float)
+        self.rule_max_w = np.array([r.max_width for r in self.rules], dtype=float)
+        self.rule_min_h = np.array([r.min_height for r in self.rules], dtype=float)
+        self.rule_max_h = np.array([r.max_height for r in self.rules], dtype=float)
+        self.rule_x_min = np.array([r.x_range[0] for r in self.rules], dtype=float)
+        self.rule_x_max = np.array([r.x_range[1] for r in self.rules], dtype=float)
+        self.rule_outside = np.array([r.outside for r in self.rules])
+        self.rule_cooldown = np.array([r.cooldown_s for r in self.rules], dtype=float)
+        self.rule_requires_set = np.array(
+            [mask_of(r.requires_set) for r in self.rules], dtype=np.int64
+        )
+        self.rule_requires_clear = np.array(
+            [
+                mask_of(r.requires_clear)
+                if r.requires_clear is not None
+                else all_mask & ~mask_of(r.requires_set)
+                for r in self.rules
+            ],
+            dtype=np.int64,
+        )
+
+        self.reset()
+
+    def reset(self):
+        self.state = 0
+        n = len(self.conditions)
+        self.start_time = np.full(n, -INF)
+        self.last_seen = np.full(n, -INF)
+
+    # --- Class mapping ---
+    def class_id(self, name):
+        return self._class_index.get(name, -1)
+
+    def class_ids(self, names):
+        return np.array([self._class_index.get(name, -1) for name in names], dtype=np.int64)
+
+    # --- State ---
+    def is_set(self, name):
+        return bool(self.state & self.bits[name])
+
+    def set_condition(self, name, active, now):
+        """Raise or clear a condition from outside the rule table (e.g. V2X)."""
+        bit = self.bits[name]
+        if active and not self.state & bit:
+            self.state |= bit
+            self.start_time[self.names.index(name)] = now
+        elif not active:
+            self.state &= ~bit
+
+    def reasons(self, state=None):
+        state = self.state if state is None else state
+        return [name for name in self.names if state & self.bits[name]]
+
+    def _active(self):
+        return (self.state & self._bit_values) != 0
+
+    def _timeout_ref(self):
+        return np.where(self.timeout_from_seen, self.last_seen, self.start_time)
+
+    def deadlines(self):
+        """Time at which each active condition will time out (inf if never / not active)."""
+        with np.errstate(invalid="ignore"):  # -inf + inf for conditions never set
+            return np.where(self._active(), self._timeout_ref() + self.timeout_s, INF)
+
+    def next_deadline(self):
+        return float(self.deadlines().min()) if self.conditions else INF
+
+    # --- Evaluation ---
+    def match(self, cls, width, height, x):
+        """(n_rules, n_detections) matrix of class + geometry matches."""
+        zone = (
+            (width[None, :] > self.rule_min_w[:, None])
+            & (width[None, :] <= self.rule_max_w[:, None])
+            & (height[None, :] > self.rule_min_h[:, None])
+            & (height[None, :] <= self.rule_max_h[:, None])
+            & (x[None, :] > self.rule_x_min[:, None])
+            & (x[None, :] < self.rule_x_max[:, None])
+        )
+        return (cls[None, :] == self.rule_cls[:, None]) & (zone != self.rule_outside[:, None])
+
+    def armed(self, now):
+        """Rules whose flag requirements and cooldowns allow them to fire now."""
+        flags_ok = ((self.state & self.rule_requires_set) == self.rule_requires_set) & (
+            (self.state & self.rule_requires_clear) == 0
+        )
+        cooldown_ok = ~self.rule_sets | (
+            now - self.start_time[self.rule_condition] > self.rule_cooldown
+        )
+        return flags_ok & cooldown_ok
+
+    def observe(self, now, cls, width, height):
+        """Refresh the seen times of conditions whose `seen` entries match a detection."""
+        if not len(self.seen_cls):
+            return
+        hit = (
+            (cls[None, :] == self.seen_cls[:, None])
+            & (width[None, :] > self.seen_min_w[:, None])
+            & (height[None, :] > self.seen_min_h[:, None])
+        ).any(axis=1)
+        self.last_seen[self.seen_condition[hit]] = now
+
+    def apply(self, rules, now):
+        """Apply the given rules (at most one per condition) in a single state update."""
+        sets = rules[self.rule_sets[rules]]
+        clears = rules[~self.rule_sets[rules]]
+        set_mask = int(np.bitwise_or.reduce(self.rule_bit[sets])) if len(sets) else 0
+        clear_mask = int(np.bitwise_or.reduce(self.rule_bit[clears])) if len(clears) else 0
+        self.state = (self.state & ~clear_mask) | set_mask
+        self.start_time[self.rule_condition[sets]] = now
+
+    def expire(self, now):
+        """Clear timed-out conditions; returns the mask of conditions that expired."""
+        if not self.state:
+            return 0
+        expired_bits = self._active() & (now - self._timeout_ref() > self.timeout_s)
+        expired = int(self._bit_values[expired_bits].sum())
+        self.state &= ~expired
+        return expired
+
+    def step(self, now, cls, width, height, x):
+        """
+        Process one frame's detections: refresh seen times and, for every
+        condition, fire the highest-priority rule matched by any detection.
+
+        All rules are armed against the state at the start of the frame, so
+        e.g. a red light and a stop sign seen together both stop the car in
+        this cycle. cls holds engine class ids (see class_ids); all arguments
+        are arrays of the same length (possibly empty). Returns the indices of
+        the rules that fired. Timeouts are applied separately by expire(),
+        which should run every loop iteration whether or not a frame arrived.
+        """
+        cls = np.asarray(cls, dtype=np.int64)
+        if not len(cls):
+            return np.empty(0, dtype=np.int64)
+        width = np.asarray(width, dtype=float)
+        height = np.asarray(height, dtype=float)
+        x = np.asarray(x, dtype=float)
+
+        self.observe(now, cls, width, height)
+        fired = np.flatnonzero(self.match(cls, width, height, x).any(axis=1) & self.armed(now))
+        if len(fired):
+            # Rules are in priority order: keep the first one per condition.
+            _, first = np.unique(self.rule_condition[fired], return_index=True)
+            fired = np.sort(fired[first])
+            self.apply(fired, now)
+        return fired
+
+
+class FleetRuleEngine(RuleEngine):
+    """
+    The same compiled rule table evaluated for n_vehicles at once.
+
+    `states` holds one state mask per vehicle and start/seen times are
+    (n_vehicles, n_conditions) arrays. step() takes the detections of all
+    vehicles concatenated, with a vehicle index per detection, and updates
+    every vehicle's state in one vectorized pass; the semantics per vehicle
+    are those of RuleEngine.step()/expire().
+    """
+
+    def __init__(self, conditions, rules, n_vehicles):
+        self.n_vehicles = n_vehicles
+        super().__init__(conditions, rules)
+
+    def reset(self):
+        shape = (self.n_vehicles, len(self.conditions))
+        self.states = np.zeros(self.n_vehicles, dtype=np.int64)
+        self.start_time = np.full(shape, -INF)
+        self.last_seen = np.full(shape, -INF)
+
+    # --- State ---
+    def set_conditions(self, name, active, now):
+        """Raise (active=True) or clear a condition per vehicle; active is a boolean array."""
+        bit = self.bits[name]
+        active = np.asarray(active, dtype=bool)
+        rising = active & ((self.states & bit) == 0)
+        self.start_time[rising, self.names.index(name)] = now
+        self.states = np.where(active, self.states | bit, self.states & ~bit)
+
+    def _active(self):
+        return (self.states[:, None] & self._bit_values[None, :]) != 0
+
+    def next_deadline(self):
+        return float(self.deadlines().min()) if self.conditions and self.n_vehicles else INF
+
+    # --- Evaluation ---
+    def armed(self, now):
+        """(n_rules, n_vehicles) matrix of rules allowed to fire per vehicle."""
+        states = self.states[None, :]
+        flags_ok = ((states & self.rule_requires_set[:, None]) == self.rule_requires_set[:, None]) & (
+            (states & self.rule_requires_clear[:, None]) == 0
+        )
+        cooldown_ok = ~self.rule_sets[:, None] | (
+            now - self.start_time[:, self.rule_condition].T > self.rule_cooldown[:, None]
+        )
+        return flags_ok & cooldown_ok
+
+    def observe(self, now, vehicle, cls, width, height):
+        if not len(self.seen_cls):
+            return
+        rows, dets = np.nonzero(
+            (cls[None, :] == self.seen_cls[:, None])
+            & (width[None, :] > self.seen_min_w[:, None])
+            & (height[None, :] > self.seen_min_h[:, None])
+        )
+        self.last_seen[vehicle[dets], self.seen_condition[rows]] = now
+
+    def step(self, now, vehicle, cls, width, height, x):
+        """
+        Process the detections of all vehicles (parallel arrays; vehicle[i]
+        is the index of the vehicle that saw detection i). Returns the
+        (vehicle, rule) index pairs that fired.
+        """
+        vehicle = np.asarray(vehicle, dtype=np.int64)
+        cls = np.asarray(cls, dtype=np.int64)
+        if not len(cls):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        width = np.asarray(width, dtype=float)
+        height = np.asarray(height, dtype=float)
+        x = np.asarray(x, dtype=float)
+
+        armed = self.armed(now)  # against the states at the start of the frame
+        self.observe(now, vehicle, cls, width, height)
+        rules, dets = np.nonzero(self.match(cls, width, height, x) & armed[:, vehicle])
+        if not len(rules):
+            return rules, rules
+        vehicles = vehicle[dets]
+        # Rules are in priority order: keep the first one per (vehicle, condition).
+        order = np.lexsort((rules, self.rule_condition[rules], vehicles))
+        rules, vehicles = rules[order], vehicles[order]
+        key = vehicles * len(self.conditions) + self.rule_condition[rules]
+        first = np.ones(len(key), dtype=bool)
+        first[1:] = key[1:] != key[:-1]
+        rules, vehicles = rules[first], vehicles[first]
+
+        sets = self.rule_sets[rules]
+        set_masks = np.zeros(self.n_vehicles, dtype=np.int64)
+        clear_masks = np.zeros(self.n_vehicles, dtype=np.int64)
+        np.bitwise_or.at(set_masks, vehicles[sets], self.rule_bit[rules[sets]])
+        np.bitwise_or.at(clear_masks, vehicles[~sets], self.rule_bit[rules[~sets]])
+        self.states = (self.states & ~clear_masks) | set_masks
+        self.start_time[vehicles[sets], self.rule_condition[rules[sets]]] = now
+        return vehicles, rules
+
+    def expire(self, now):
+        """Clear timed-out conditions; returns the per-vehicle masks of expired conditions."""
+        if not self.states.any():
+            return np.zeros(self.n_vehicles, dtype=np.int64)
+        expired_bits = self._active() & (now - self._timeout_ref() > self.timeout_s)
+        expired = (expired_bits * self._bit_values).sum(axis=1)
+        self.states &= ~expired
+        return expired
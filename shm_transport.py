@@ -0,0 +1,525 @@
+# shm_transport.py
+# Fixed-layout channels in multiprocessing.shared_memory, so processes can
+# exchange data without pickling through a Queue.
+#
+# FrameRing: a ring of camera frame slots. One capture process writes frames,
+# any number of inference processes read them in place. Every slot is guarded
+# by a sequence lock (odd while being written, even when complete), so a
+# reader can tell whether the frame it copied or used was overwritten under it.
+#
+# CommandMailbox: the latest drive command from the controller to the control
+# loop, as fixed numeric fields under one sequence lock.
+#
+# PoseBuffer: the latest pose of every vehicle, one sequence-locked record
+# per vehicle, read by the controllers.
+import math
+import time
+from collections import namedtuple
+import numpy as np
+from multiprocessing import shared_memory
+
+FRAME_RING_SLOTS = 4
+# Upper bound on traffic lights whose V2X state travels with each frame.
+MAX_V2X_LIGHTS = 16
+V2X_STATUS_NAMES = ("NONE", "RED", "YELLOW", "GREEN", "UNKNOWN")
+# A reader gives up on a read after this many torn attempts (writer died mid-write).
+SEQLOCK_READ_RETRIES = 1000
+
+# Header (int64): n_slots, height, width, channels, head frame sequence.
+_HEADER_FIELDS = 5
+_HEAD = 4
+_ALIGN = 64
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def encode_v2x(statuses, out):
+    """Write V2X status strings into an int8 code array (-1 = no light)."""
+    out[:] = -1
+    for i, status in enumerate(statuses[: len(out)]):
+        out[i] = (
+            V2X_STATUS_NAMES.index(status)
+            if status in V2X_STATUS_NAMES
+            else V2X_STATUS_NAMES.index("UNKNOWN")
+        )
+
+
+def decode_v2x(codes):
+    return [V2X_STATUS_NAMES[code] for code in codes if code >= 0]
+
+
+class FrameRing:
+    """
+    Ring of fixed-size frame slots in shared memory (single writer).
+
+    Frames get sequence numbers 1, 2, 3, ... and frame `seq` lives in slot
+    seq % n_slots. A reader asks next_seq_for() which frame to handle (the
+    newest one in its share), takes it in place with view(), and once done
+    with the view confirms with is_intact() that the writer did not reuse
+    the slot meanwhile; read() does the same for a copy.
+    """
+
+    def __init__(self, shm, create=False, n_slots=None, frame_shape=None):
+        self.shm = shm
+        self._owner = create
+        header = np.ndarray((_HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        if create:
+            header[:4] = (n_slots,) + tuple(frame_shape)
+            header[_HEAD] = 0
+        n_slots = int(header[0])
+        frame_shape = tuple(int(v) for v in header[1:4])
+
+        offset = _aligned(header.nbytes)
+        slot_locks = np.ndarray((n_slots,), dtype=np.uint64, buffer=shm.buf, offset=offset)
+        offset = _aligned(offset + slot_locks.nbytes)
+        slot_seqs = np.ndarray((n_slots,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset = _aligned(offset + slot_seqs.nbytes)
+        slot_times = np.ndarray((n_slots,), dtype=np.float64, buffer=shm.buf, offset=offset)
+        offset = _aligned(offset + slot_times.nbytes)
+        slot_v2x = np.ndarray(
+            (n_slots, MAX_V2X_LIGHTS), dtype=np.int8, buffer=shm.buf, offset=offset
+        )
+        offset = _aligned(offset + slot_v2x.nbytes)
+        frames = np.ndarray(
+            (n_slots,) + frame_shape, dtype=np.uint8, buffer=shm.buf, offset=offset
+        )
+        if create:
+            slot_locks[:] = 0
+            slot_seqs[:] = 0
+            slot_v2x[:] = -1
+
+        self.header = header
+        self.n_slots = n_slots
+        self.frame_shape = frame_shape
+        self.slot_locks = slot_locks
+        self.slot_seqs = slot_seqs
+        self.slot_times = slot_times
+        self.slot_v2x = slot_v2x
+        self.frames = frames
+        self._next_seq = 1
+        # Reader-side counters
+        self.torn = 0
+        self.missed = 0
+
+    @staticmethod
+    def nbytes(n_slots, frame_shape):
+        size = _aligned(8 * _HEADER_FIELDS)
+        size = _aligned(size + 8 * n_slots)
+        size = _aligned(size + 8 * n_slots)
+        size = _aligned(size + 8 * n_slots)
+        size = _aligned(size + MAX_V2X_LIGHTS * n_slots)
+        return size + n_slots * int(np.prod(frame_shape))
+
+    @classmethod
+    def create(cls, name, frame_shape, n_slots=FRAME_RING_SLOTS):
+        shm = shared_memory.SharedMemory(
+            name=name, create=True, size=cls.nbytes(n_slots, frame_shape)
+        )
+        return cls(shm, create=True, n_slots=n_slots, frame_shape=frame_shape)
+
+    @classmethod
+    def attach(cls, name, timeout=None):
+        """Attach to an existing ring, waiting up to timeout seconds for it to appear."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return cls(shared_memory.SharedMemory(name=name))
+            except FileNotFoundError:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def close(self):
+        # Drop the numpy views before closing the mapping.
+        self.header = self.slot_locks = self.slot_seqs = None
+        self.slot_times = self.slot_v2x = self.frames = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+    # --- Writer ---
+    def write(self, frame, t_capture, v2x_statuses=()):
+        """Publish one frame; returns its sequence number."""
+        seq = self._next_seq
+        slot = seq % self.n_slots
+        self.slot_locks[slot] += 1  # odd: slot is being written
+        np.copyto(self.frames[slot], frame)
+        self.slot_seqs[slot] = seq
+        self.slot_times[slot] = t_capture
+        encode_v2x(v2x_statuses, self.slot_v2x[slot])
+        self.slot_locks[slot] += 1  # even: slot is complete
+        self.header[_HEAD] = seq
+        self._next_seq += 1
+        return seq
+
+    # --- Readers ---
+    def latest_seq(self):
+        return int(self.header[_HEAD])
+
+    def view(self, seq):
+        """
+        Zero-copy access to frame `seq`.
+
+        Returns (frame_view, t_capture, v2x_statuses, lock) or None if the
+        frame is not available: overwritten or being overwritten by a newer
+        frame (counted in `missed`), changed while its metadata was read
+        (counted in `torn`), or not written yet. The view stays valid only
+        while is_intact(seq, lock) is True.
+        """
+        slot = seq % self.n_slots
+        lock = int(self.slot_locks[slot])
+        if lock & 1 or self.slot_seqs[slot] != seq:
+            if seq <= self.latest_seq():
+                self.missed += 1
+            return None
+        t_capture = float(self.slot_times[slot])
+        v2x_statuses = decode_v2x(self.slot_v2x[slot])
+        if not self.is_intact(seq, lock):
+            self.torn += 1
+            return None
+        return self.frames[slot], t_capture, v2x_statuses, lock
+
+    def is_intact(self, seq, lock):
+        slot = seq % self.n_slots
+        return int(self.slot_locks[slot]) == lock and self.slot_seqs[slot] == seq
+
+    def read(self, seq, out):
+        """Copy frame `seq` into out; returns (t_capture, v2x_statuses) or None if torn/overwritten."""
+        item = self.view(seq)
+        if item is None:
+            return None
+        frame, t_capture, v2x_statuses, lock = item
+        np.copyto(out, frame)
+        if not self.is_intact(seq, lock):
+            self.torn += 1
+            return None
+        return t_capture, v2x_statuses
+
+    def next_seq_for(self, last_seq, reader_index=0, n_readers=1):
+        """
+        Next frame this reader should handle, or None if it is not written yet.
+
+        With several readers, reader i takes frames with seq % n_readers == i.
+        A reader that fell behind jumps to the newest of its frames rather
+        than the oldest still in the ring, which is the slot the writer
+        reuses next; the frames it skips are counted in `missed`.
+        """
+        head = self.latest_seq()
+        seq = last_seq + 1
+        seq += (reader_index - seq) % n_readers
+        if seq > head:
+            return None
+        newest = head - (head - reader_index) % n_readers
+        self.missed += (newest - seq) // n_readers
+        return newest
+
+
+# --- Command mailbox ---
+# Stamps (see latency.STAGE_BOUNDS) a command carries from its frame; NaN = missing.
+COMMAND_STAMP_KEYS = (
+    "t_grab",
+    "t_capture",
+    "t_infer_start",
+    "t_inferred",
+    "t_published",
+    "t_pickup",
+    "t_decided",
+)
+# Target speed meaning "resume the control loop's configured cruise speed".
+CRUISE_SPEED = float("nan")
+
+# Integer fields (int64): command seq, stop-reason bitmask, frame seq.
+_CMD_SEQ, _CMD_REASONS, _CMD_FRAME_SEQ = range(3)
+# Float fields (float64): target speed, time posted, then COMMAND_STAMP_KEYS.
+_CMD_SPEED, _CMD_T_POSTED = range(2)
+_CMD_STAMPS = 2
+
+
+def command_mailbox_name(actor_id):
+    return f"qcar{actor_id}_commands"
+
+
+CommandRecord = namedtuple(
+    "CommandRecord", ["seq", "speed", "reasons", "frame_seq", "t_posted", "stamps"]
+)
+
+
+class CommandMailbox:
+    """
+    Latest drive command in shared memory (single writer, any readers).
+
+    A command is a target speed (0 to stop, CRUISE_SPEED for the configured
+    cruise speed), a bitmask of stop reasons, the seq of the frame that
+    caused it and that frame's stamps. Commands get sequence numbers 1, 2,
+    3, ...; one sequence lock guards the whole record, so a reader polls
+    with a couple of memory reads and never blocks the writer. Posting never
+    blocks or drops either: a newer command replaces one not read yet, and
+    the reader counts those in `superseded`.
+    """
+
+    def __init__(self, shm, create=False):
+        self.shm = shm
+        self._owner = create
+        lock = np.ndarray((1,), dtype=np.uint64, buffer=shm.buf)
+        offset = _aligned(lock.nbytes)
+        ints = np.ndarray((3,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset = _aligned(offset + ints.nbytes)
+        floats = np.ndarray(
+            (_CMD_STAMPS + len(COMMAND_STAMP_KEYS),),
+            dtype=np.float64,
+            buffer=shm.buf,
+            offset=offset,
+        )
+        if create:
+            lock[0] = 0
+            ints[:] = (0, 0, -1)
+            floats[:] = np.nan
+        self.lock = lock
+        self.ints = ints
+        self.floats = floats
+        self._next_seq = 1
+        # Reader-side counters
+        self.superseded = 0
+        self.torn = 0
+
+    @staticmethod
+    def nbytes():
+        size = _aligned(8)
+        size = _aligned(size + 8 * 3)
+        return size + 8 * (_CMD_STAMPS + len(COMMAND_STAMP_KEYS))
+
+    @classmethod
+    def create(cls, name):
+        shm = shared_memory.SharedMemory(name=name, create=True, size=cls.nbytes())
+        return cls(shm, create=True)
+
+    @classmethod
+    def attach(cls, name, timeout=None):
+        """Attach to an existing mailbox, waiting up to timeout seconds for it to appear."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return cls(shared_memory.SharedMemory(name=name))
+            except FileNotFoundError:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def close(self):
+        self.lock = self.ints = self.floats = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+    # --- Writer ---
+    def post(self, speed, reasons=0, stamps=None):
+        """Publish a command; returns its sequence number."""
+        stamps = stamps or {}
+        seq = self._next_seq
+        self.lock[0] += 1  # odd: record is being written
+        self.ints[_CMD_SEQ] = seq
+        self.ints[_CMD_REASONS] = reasons
+        self.ints[_CMD_FRAME_SEQ] = stamps.get("seq", -1)
+        self.floats[_CMD_SPEED] = speed
+        self.floats[_CMD_T_POSTED] = time.monotonic()
+        for i, key in enumerate(COMMAND_STAMP_KEYS, _CMD_STAMPS):
+            self.floats[i] = stamps.get(key, np.nan)
+        self.lock[0] += 1  # even: record is complete
+        self._next_seq += 1
+        return seq
+
+    def put(self, message):
+        """Post a latency.make_command() message (so the mailbox can stand in for a Queue)."""
+        return self.post(message["speed"], message["reasons"], message["stamps"])
+
+    def full(self):
+        return False
+
+    # --- Readers ---
+    def latest_seq(self):
+        return int(self.ints[_CMD_SEQ])
+
+    def read(self, last_seq=0):
+        """
+        The current command as a CommandRecord, or None if its seq is not
+        newer than last_seq (or the writer never finished the record).
+        """
+        for _ in range(SEQLOCK_READ_RETRIES):
+            lock = int(self.lock[0])
+            if lock & 1:
+                continue
+            if int(self.ints[_CMD_SEQ]) <= last_seq:
+                return None
+            ints = self.ints.tolist()
+            floats = self.floats.tolist()
+            if int(self.lock[0]) == lock:
+                break
+            self.torn += 1
+        else:
+            return None
+        seq = ints[_CMD_SEQ]
+        if last_seq:
+            self.superseded += seq - last_seq - 1
+        stamps = {
+            key: value
+            for key, value in zip(COMMAND_STAMP_KEYS, floats[_CMD_STAMPS:])
+            if not math.isnan(value)
+        }
+        if ints[_CMD_FRAME_SEQ] >= 0:
+            stamps["seq"] = ints[_CMD_FRAME_SEQ]
+        return CommandRecord(
+            seq, floats[_CMD_SPEED], ints[_CMD_REASONS], ints[_CMD_FRAME_SEQ],
+            floats[_CMD_T_POSTED], stamps,
+        )
+
+
+# --- Pose buffer ---
+# Float fields of a pose record (float64): x, y, th, v, timestamp, then the
+# 3x3 (x, y, th) covariance row-major; padded to a cache-line multiple.
+POSE_FIELDS = ("x", "y", "th", "v", "t")
+_POSE_COV = len(POSE_FIELDS)
+_POSE_RECORD = 16
+# Per-vehicle lock and seq (uint64/int64), padded to one cache line each.
+_POSE_LOCK_STRIDE = _ALIGN // 8
+
+
+def pose_buffer_name(fleet_id=0):
+    return f"fleet{fleet_id}_poses"
+
+
+class PoseBuffer:
+    """
+    Latest pose of each of n_vehicles in shared memory.
+
+    Each vehicle's record (x, y, th, v, timestamp, 3x3 covariance and a
+    sequence number) has its own sequence lock and a single writer, its
+    control loop, which publishes a whole pose with one store. Any number of
+    readers take consistent snapshots with a few memory reads and retry if
+    a publish overlapped them.
+    """
+
+    def __init__(self, shm, create=False, n_vehicles=None):
+        self.shm = shm
+        self._owner = create
+        header = np.ndarray((1,), dtype=np.int64, buffer=shm.buf)
+        if create:
+            header[0] = n_vehicles
+        n_vehicles = int(header[0])
+        offset = _aligned(header.nbytes)
+        locks = np.ndarray(
+            (n_vehicles, _POSE_LOCK_STRIDE), dtype=np.uint64, buffer=shm.buf, offset=offset
+        )
+        offset = _aligned(offset + locks.nbytes)
+        seqs = np.ndarray(
+            (n_vehicles, _POSE_LOCK_STRIDE), dtype=np.int64, buffer=shm.buf, offset=offset
+        )
+        offset = _aligned(offset + seqs.nbytes)
+        records = np.ndarray(
+            (n_vehicles, _POSE_RECORD), dtype=np.float64, buffer=shm.buf, offset=offset
+        )
+        if create:
+            locks[:] = 0
+            seqs[:] = 0
+            records[:] = 0.0
+        self.header = header
+        self.n_vehicles = n_vehicles
+        self.locks = locks
+        self.seqs = seqs
+        self.records = records
+        self._record = np.zeros(_POSE_RECORD)
+        # Reader-side counter
+        self.torn = 0
+
+    @staticmethod
+    def nbytes(n_vehicles):
+        size = _aligned(8)
+        size = _aligned(size + 8 * _POSE_LOCK_STRIDE * n_vehicles)
+        size = _aligned(size + 8 * _POSE_LOCK_STRIDE * n_vehicles)
+        return size + 8 * _POSE_RECORD * n_vehicles
+
+    @classmethod
+    def create(cls, name, n_vehicles=1):
+        shm = shared_memory.SharedMemory(name=name, create=True, size=cls.nbytes(n_vehicles))
+        return cls(shm, create=True, n_vehicles=n_vehicles)
+
+    @classmethod
+    def attach(cls, name, timeout=None):
+        """Attach to an existing buffer, waiting up to timeout seconds for it to appear."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return cls(shared_memory.SharedMemory(name=name))
+            except FileNotFoundError:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def close(self):
+        self.header = self.locks = self.seqs = self.records = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+    def view(self, vehicle=0):
+        return PoseView(self, vehicle)
+
+    # --- Writer ---
+    def publish(self, vehicle, x, y, th, v, cov=None, t=None):
+        """Publish vehicle's pose (cov: 3x3 covariance of x, y, th); returns its seq."""
+        record = self._record
+        record[:_POSE_COV] = (x, y, th, v, time.monotonic() if t is None else t)
+        record[_POSE_COV : _POSE_COV + 9] = np.nan if cov is None else np.ravel(cov)
+        seq = int(self.seqs[vehicle, 0]) + 1
+        self.locks[vehicle, 0] += 1  # odd: record is being written
+        self.records[vehicle] = record
+        self.seqs[vehicle, 0] = seq
+        self.locks[vehicle, 0] += 1  # even: record is complete
+        return seq
+
+    # --- Readers ---
+    def read(self, vehicle=0):
+        """
+        Consistent snapshot of vehicle's pose as a dict (x, y, th, v, t, cov,
+        seq; seq 0 = nothing published yet), or None if no consistent copy
+        could be taken (the writer stopped mid-publish).
+        """
+        for _ in range(SEQLOCK_READ_RETRIES):
+            lock = int(self.locks[vehicle, 0])
+            if lock & 1:
+                continue
+            values = self.records[vehicle].tolist()
+            seq = int(self.seqs[vehicle, 0])
+            if int(self.locks[vehicle, 0]) == lock:
+                break
+            self.torn += 1
+        else:
+            return None
+        pose = dict(zip(POSE_FIELDS, values))
+        pose["cov"] = values[_POSE_COV : _POSE_COV + 9]
+        pose["seq"] = seq
+        return pose
+
+
+class PoseView:
+    """
+    One vehicle's pose in a PoseBuffer, as passed to controllers.
+
+    read() returns a snapshot dict; pickling a view (e.g. as a Process
+    argument) re-attaches to the buffer by name in the receiving process.
+    """
+
+    def __init__(self, buffer, vehicle):
+        self.buffer = buffer
+        self.vehicle = vehicle
+
+    def read(self):
+        return self.buffer.read(self.vehicle)
+
+    def __reduce__(self):
+        return (_attach_pose_view, (self.buffer.shm.name, self.vehicle))
+
+
+def _attach_pose_view(name, vehicle):
+    return PoseBuffer.attach(name, timeout=10.0).view(vehicle)
@@ -0,0 +1,34 @@
+# sim_clock.py
+# Clocks the control code reads time from.
+#
+# WallClock is the real thing. SimClock only moves when told to (sleep() or
+# advance_to()), so timeouts measured with it elapse as fast as the code can
+# run - a drive of an hour can be replayed in seconds, deterministically.
+import time
+
+
+class WallClock:
+    """time.time() / time.sleep()."""
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class SimClock:
+    """Simulated time, advanced explicitly; sleep() returns immediately."""
+
+    def __init__(self, start=0.0):
+        self.t = float(start)
+
+    def now(self):
+        return self.t
+
+    def sleep(self, seconds):
+        self.t += max(seconds, 0.0)
+
+    def advance_to(self, t):
+        """Move time forward to t (never backwards)."""
+        self.t = max(self.t, float(t))
@@ -0,0 +1,204 @@
+# sim_plant.py
+# Headless stand-in for the QCar hardware/QLabs interfaces used by
+# vehicle_control.controlLoop: a kinematic bicycle model driven by the
+# throttle/steering commands, with motor tach, gyro and GPS outputs.
+#
+# SimQCar and SimQCarGPS have the read()/write()/readGPS() interface (and
+# context-manager use) of pal's QCar and QCarGPS, and SimQCarEKF the update()
+# / x_hat interface of hal's QCarEKF; none of them needs the Quanser SDK. The
+# plant only moves when the shared clock moves, so with a sim_clock.SimClock
+# the control loop runs in lock-step with the model as fast as it can compute.
+#
+# All poses are the rear axle's, in the map frame: the plant state, the GPS
+# fixes and the estimate. The estimator predicts heading from the gyro, so it
+# does not depend on a wheelbase that could disagree with the plant's.
+import math
+import numpy as np
+
+QCAR_WHEELBASE_M = 0.256
+# Motor: first-order lag from throttle to speed.
+QCAR_SPEED_PER_THROTTLE = 5.0  # steady-state m/s per unit throttle
+QCAR_MOTOR_TIME_CONSTANT_S = 0.15
+QCAR_MAX_STEERING = np.pi / 6
+# Sensor noise (standard deviations)
+TACH_NOISE = 0.005  # m/s
+GYRO_NOISE = 0.005  # rad/s
+GPS_POSITION_NOISE_M = 0.01
+GPS_HEADING_NOISE = 0.01  # rad
+GPS_RATE_HZ = 20.0
+# GPS outages: each fix starts one with this probability; it lasts this long.
+GPS_DROPOUT_PROBABILITY = 0.005
+GPS_DROPOUT_S = 0.5
+# Largest integration step (s); longer advances are split.
+PLANT_MAX_STEP_S = 0.01
+# Estimator process noise: standard deviation of x, y (m) and th (rad) growth
+# per square root of a second of prediction.
+EKF_PROCESS_NOISE = (0.02, 0.02, 0.02)
+
+
+class KinematicBicycle:
+    """
+    Ground-truth QCar state (x, y, th, v) in the map frame.
+
+    advance_to(t) integrates the last command up to time t; speed follows
+    the throttle with a first-order lag, heading changes at
+    v / wheelbase * tan(steering).
+    """
+
+    def __init__(self, pose, t=0.0):
+        self.x, self.y, self.th = (float(value) for value in np.ravel(pose)[:3])
+        self.v = 0.0
+        self.yaw_rate = 0.0
+        self.throttle = 0.0
+        self.steering = 0.0
+        self.t = t
+        self.distance = 0.0  # odometer (m)
+
+    def command(self, throttle, steering):
+        self.throttle = float(throttle)
+        self.steering = float(np.clip(steering, -QCAR_MAX_STEERING, QCAR_MAX_STEERING))
+
+    def advance_to(self, t):
+        while self.t < t:
+            dt = min(t - self.t, PLANT_MAX_STEP_S)
+            target = QCAR_SPEED_PER_THROTTLE * self.throttle
+            self.v += (target - self.v) * min(dt / QCAR_MOTOR_TIME_CONSTANT_S, 1.0)
+            self.yaw_rate = self.v / QCAR_WHEELBASE_M * math.tan(self.steering)
+            self.x += self.v * math.cos(self.th) * dt
+            self.y += self.v * math.sin(self.th) * dt
+            self.th = (self.th + self.yaw_rate * dt + math.pi) % (2 * math.pi) - math.pi
+            self.distance += abs(self.v) * dt
+            self.t += dt
+
+
+class SimQCar:
+    """
+    Drop-in for pal.products.qcar.QCar on a KinematicBicycle.
+
+    read() brings the plant up to clock() and samples motorTach (m/s) and
+    gyroscope (rad/s, z = yaw rate); write() sets the command.
+    """
+
+    def __init__(self, plant, clock, rng=None):
+        self.plant = plant
+        self.clock = clock
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.motorTach = 0.0
+        self.gyroscope = np.zeros(3)
+        self.accelerometer = np.array([0.0, 0.0, 9.81])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.terminate()
+
+    def read(self):
+        self.plant.advance_to(self.clock())
+        self.motorTach = self.plant.v + self.rng.normal(0.0, TACH_NOISE)
+        self.gyroscope[2] = self.plant.yaw_rate + self.rng.normal(0.0, GYRO_NOISE)
+
+    def write(self, throttle=0, steering=0, LEDs=None):
+        self.plant.command(throttle, steering)
+
+    def read_write_std(self, throttle=0, steering=0, LEDs=None):
+        self.write(throttle, steering)
+        self.read()
+
+    def terminate(self):
+        self.plant.command(0.0, 0.0)
+
+
+class SimQCarGPS:
+    """
+    Drop-in for pal.products.qcar.QCarGPS on a KinematicBicycle.
+
+    readGPS() returns True when a new fix is due (GPS_RATE_HZ) and not lost
+    in an outage, and then updates position and orientation with noise.
+    """
+
+    def __init__(self, plant, clock, rng=None):
+        self.plant = plant
+        self.clock = clock
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.position = np.zeros(3)
+        self.orientation = np.zeros(3)
+        self.next_fix = -math.inf
+        self.outage_until = -math.inf
+        self.fixes = 0
+        self.dropped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.terminate()
+
+    def readGPS(self):
+        now = self.clock()
+        if now < self.next_fix:
+            return False
+        self.next_fix = max(self.next_fix + 1.0 / GPS_RATE_HZ, now)
+        if now >= self.outage_until and self.rng.random() < GPS_DROPOUT_PROBABILITY:
+            self.outage_until = now + GPS_DROPOUT_S
+        if now < self.outage_until:
+            self.dropped += 1
+            return False
+        self.plant.advance_to(now)
+        noise = self.rng.normal(0.0, 1.0, 3)
+        self.position[0] = self.plant.x + GPS_POSITION_NOISE_M * noise[0]
+        self.position[1] = self.plant.y + GPS_POSITION_NOISE_M * noise[1]
+        self.orientation[2] = self.plant.th + GPS_HEADING_NOISE * noise[2]
+        self.fixes += 1
+        return True
+
+    def terminate(self):
+        pass
+
+
+class SimQCarEKF:
+    """
+    Drop-in for hal.content.qcar_functions.QCarEKF on the simulated plant.
+
+    update(u, dt, y_gps, y_imu) first predicts over dt with the tach speed
+    u[0] along the heading and the gyro yaw rate y_imu (without a gyro
+    reading, the steering angle u[1] through the plant's wheelbase), then
+    corrects with the GPS fix y_gps = (x, y, th) taken at the end of that
+    interval. x_hat is the (3, 1) pose estimate and P its covariance.
+    """
+
+    def __init__(self, x_0, wheelbase=QCAR_WHEELBASE_M):
+        self.x_hat = np.array(np.ravel(x_0)[:3], dtype=float).reshape(3, 1)
+        self.wheelbase = wheelbase
+        self.R = np.diag([GPS_POSITION_NOISE_M, GPS_POSITION_NOISE_M, GPS_HEADING_NOISE]) ** 2
+        self.Q = np.diag(EKF_PROCESS_NOISE) ** 2
+        self.P = self.R.copy()
+
+    def update(self, u=None, dt=None, y_gps=None, y_imu=None):
+        x, y, th = self.x_hat[:, 0]
+        if dt:
+            v = float(u[0]) if u is not None else 0.0
+            if y_imu is not None:
+                yaw_rate = float(y_imu)
+            elif u is not None:
+                yaw_rate = v / self.wheelbase * math.tan(u[1])
+            else:
+                yaw_rate = 0.0
+            F = np.array(
+                [
+                    [1.0, 0.0, -v * math.sin(th) * dt],
+                    [0.0, 1.0, v * math.cos(th) * dt],
+                    [0.0, 0.0, 1.0],
+                ]
+            )
+            x += v * math.cos(th) * dt
+            y += v * math.sin(th) * dt
+            th += yaw_rate * dt
+            self.P = F @ self.P @ F.T + self.Q * dt
+        if y_gps is not None:
+            innovation = np.asarray(y_gps, dtype=float)[:3] - (x, y, th)
+            innovation[2] = (innovation[2] + math.pi) % (2 * math.pi) - math.pi
+            K = self.P @ np.linalg.inv(self.P + self.R)
+            x, y, th = (x, y, th) + K @ innovation
+            self.P = (np.eye(3) - K) @ self.P
+        self.x_hat[:, 0] = (x, y, (th + math.pi) % (2 * math.pi) - math.pi)
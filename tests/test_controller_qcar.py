@@ -0,0 +1,135 @@
+# controller_qcar decision logic in simulated time.
+import numpy as np
+import pytest
+
+from controller_qcar import (
+    EVENT_WAKE_SLACK_S,
+    STOP_CONDITIONS,
+    STOP_RULES,
+    STOP_SIGN_WAIT_TIME_S,
+    FleetController,
+    simulate,
+    simulate_fleet,
+)
+from rule_engine import FleetRuleEngine, RuleEngine
+
+CLASSES = [
+    "pedestrian", "stop_sign", "yield_sign", "Qcar", "red_light", "green_light", "yellow_light",
+    "car",
+]
+
+STOP_SIGN = {"class": "stop_sign", "width": 70, "height": 70, "x": 300, "y": 0}
+LEAD_QCAR = {"class": "Qcar", "width": 80, "height": 60, "x": 280, "y": 0}
+
+
+def stop_sign_stream(seconds, fps=30, t0=1000.0):
+    """A stop sign in view for one second of every minute."""
+    for i in range(int(seconds * fps)):
+        t = t0 + i / fps
+        detections = [STOP_SIGN] if 20 < (i / fps) % 60 < 21 else []
+        yield t, {"detections": detections, "v2x_statuses": []}
+
+
+def test_event_driven_stop_times_out_on_schedule():
+    decisions = simulate(stop_sign_stream(120))
+    assert [command for _, command in decisions] == ["STOP", "GO"] * 2
+    (t_stop, _), (t_go, _) = decisions[:2]
+    assert t_go - t_stop == pytest.approx(STOP_SIGN_WAIT_TIME_S + EVENT_WAKE_SLACK_S)
+
+
+def test_polling_stays_on_the_poll_grid():
+    t0, period = 1000.0, 0.05
+    decisions = simulate(stop_sign_stream(600, t0=t0), poll_period_s=period)
+    assert len(decisions) == 20
+    for t, _ in decisions:
+        # Exactly t0 + k * period: the grid does not drift over 12000 polls.
+        assert t == t0 + round((t - t0) / period) * period
+
+
+
+def lead_then_stop_sign(fps=30):
+    """A lead QCar for a second, then a stop sign, then nothing."""
+    for i in range(10 * fps):
+        t = i / fps
+        detections = [LEAD_QCAR] if t < 1.0 else [STOP_SIGN] if t < 1.5 else []
+        yield t, {"detections": detections, "v2x_statuses": []}
+
+
+def test_lead_lost_while_stopped_is_dropped():
+    decisions = simulate(lead_then_stop_sign(), adaptive_cruise=True)
+    assert [command for _, command in decisions][-2:] == ["STOP", "GO"]
+
+
+def test_fleet_lead_lost_while_stopped_is_dropped():
+    controller = FleetController([{}], adaptive_cruise=True, verbose=False)
+    for t, message in lead_then_stop_sign():
+        controller.step(t, [message])
+        deadline = controller.next_deadline()
+        assert deadline is None or deadline >= t
+
+
+def random_stream(rng, seconds, fps=30):
+    """Messages with zero to two random detections, at a jittery frame rate."""
+    t, seq = 0.0, 0
+    while t < seconds:
+        seq += 1
+        n = rng.integers(0, 3) if rng.random() < 0.4 else 0
+        detections = [
+            {
+                "class": CLASSES[j],
+                "x": float(rng.uniform(0, 640)),
+                "y": 0.0,
+                "width": float(rng.uniform(0, 200)),
+                "height": float(rng.uniform(0, 250)),
+            }
+            for j in rng.integers(0, len(CLASSES), n)
+        ]
+        yield t, {"detections": detections, "v2x_statuses": [], "seq": seq}
+        t += 1 / fps + rng.uniform(0, 0.003)
+
+
+def test_fleet_rule_engine_matches_one_engine_per_vehicle():
+    rng = np.random.default_rng(1)
+    n_vehicles = 5
+    fleet = FleetRuleEngine(STOP_CONDITIONS, STOP_RULES, n_vehicles)
+    singles = [RuleEngine(STOP_CONDITIONS, STOP_RULES) for _ in range(n_vehicles)]
+    t = 0.0
+    for _ in range(1000):
+        t += rng.uniform(0.01, 0.3)
+        v2x = rng.random(n_vehicles) < 0.05
+        fleet.set_conditions("V2X_Light", v2x, t)
+        vehicles, cls, widths, heights, xs = [], [], [], [], []
+        for vehicle, engine in enumerate(singles):
+            engine.set_condition("V2X_Light", bool(v2x[vehicle]), t)
+            n = rng.integers(0, 3)
+            names = [CLASSES[j] for j in rng.integers(0, len(CLASSES), n)]
+            width = rng.uniform(0, 200, n)
+            height = rng.uniform(0, 250, n)
+            x = rng.uniform(0, 640, n)
+            engine.step(t, engine.class_ids(names), width, height, x)
+            vehicles += [vehicle] * n
+            cls += fleet.class_ids(names).tolist()
+            widths += width.tolist()
+            heights += height.tolist()
+            xs += x.tolist()
+        fleet.step(t, vehicles, cls, widths, heights, xs)
+        expired = fleet.expire(t)
+        assert [engine.expire(t) for engine in singles] == expired.tolist()
+        assert [engine.state for engine in singles] == fleet.states.tolist()
+    assert fleet.next_deadline() == min(engine.next_deadline() for engine in singles)
+
+
+def test_fleet_controller_matches_single_controllers():
+    rng = np.random.default_rng(3)
+    n_vehicles = 3
+    streams = [list(random_stream(rng, 60.0)) for _ in range(n_vehicles)]
+    merged = sorted(
+        ((t, vehicle, message) for vehicle, stream in enumerate(streams) for t, message in stream),
+        key=lambda item: (item[0], item[1]),
+    )
+    fleet = simulate_fleet(iter(merged), n_vehicles)
+    # The fleet keeps polling until every timer has run out; poll as long on its own.
+    end_time = fleet[-1][0]
+    for vehicle, stream in enumerate(streams):
+        single = simulate(iter(stream), poll_period_s=0.05, end_time=end_time)
+        assert [(t, command) for t, v, command in fleet if v == vehicle] == single
@@ -0,0 +1,76 @@
+# cruise_control.AdaptiveCruiseControl with the controller's settings.
+import math
+
+import numpy as np
+import pytest
+
+from controller_qcar import ACC_CRUISE_SPEED, make_cruise_control
+from cruise_control import select_lead
+
+
+def feed(acc, widths, t0=0.0, fps=30):
+    t = t0
+    for k, width in enumerate(widths):
+        t = t0 + k / fps
+        acc.update(t, width)
+    return t
+
+
+def test_select_lead_takes_widest_centered_car():
+    cls = np.array([0, 0, 1, 0])
+    width = np.array([60.0, 90.0, 200.0, 120.0])
+    x = np.array([290.0, 275.0, 220.0, 500.0])  # the 120 px car is off to the side
+    assert select_lead(cls, width, x, 0, center_x=320, center_tolerance=150) == 1
+    assert select_lead(cls, width, x, 2, center_x=320, center_tolerance=150) is None
+
+
+def test_follows_lead_at_safe_gap():
+    acc = make_cruise_control()
+    t = feed(acc, [acc.safe_width] * 30)
+    assert acc.ttc() == math.inf
+    assert acc.target_speed(0.3) == pytest.approx(0.3)
+    assert acc.command(t, 0.3) == pytest.approx(0.3)
+
+
+def test_distant_lead_allows_cruise_speed():
+    acc = make_cruise_control()
+    feed(acc, [acc.safe_width / 2] * 30)
+    assert acc.range_m() == pytest.approx(2.0)
+    assert acc.target_speed(0.3) == ACC_CRUISE_SPEED
+
+
+def test_brakes_at_once_on_short_ttc():
+    acc = make_cruise_control()
+    t = feed(acc, [acc.safe_width] * 10)
+    assert acc.command(t, 0.4) is not None
+    # The box grows 90 px/s, still narrower than hard_brake_width. The stop is
+    # sent at once, not after command_period_s.
+    t = feed(acc, [acc.safe_width + 3 * k for k in range(1, 16)], t0=t + 1 / 30)
+    assert acc.width < acc.hard_brake_width
+    assert acc.ttc() < 1.5
+    assert acc.command(t, 0.4) == 0.0
+    assert acc.command(t + 0.01, 0.4) is None
+
+
+def test_hard_brake_on_very_close_lead():
+    acc = make_cruise_control()
+    feed(acc, [acc.hard_brake_width] * 5)
+    assert acc.target_speed(0.4) == 0.0
+
+
+def test_commands_are_rate_limited():
+    acc = make_cruise_control()
+    t = feed(acc, [acc.safe_width] * 5)
+    assert acc.command(t, 0.3) == pytest.approx(0.3)
+    assert acc.command(t + 0.1, 0.2) is None  # within command_period_s
+    assert acc.command(t + acc.command_period_s + 0.01, 0.2) == pytest.approx(0.2)
+
+
+def test_lost_lead_resumes_cruise_once():
+    acc = make_cruise_control()
+    t = feed(acc, [acc.safe_width] * 5)
+    acc.command(t, 0.2)
+    lost = acc.lost_deadline() + 0.01
+    assert acc.command(lost, 0.2) == ACC_CRUISE_SPEED
+    assert acc.command(lost + 1.0, 0.2) is None
+    assert acc.lost_deadline() is None
@@ -0,0 +1,56 @@
+# geofence.GeofenceIndex against a brute-force scan, and the controller's zones.
+import numpy as np
+import pytest
+
+from controller_qcar import (
+    MAP_OFFSET_X,
+    MAP_OFFSET_Y,
+    MAP_SCALER_X,
+    MAP_SCALER_Y,
+    StopGoController,
+    build_geofence_index,
+)
+from environment_config import STOP_SIGNS_CONFIG, TRAFFIC_LIGHTS_CONFIG, YIELD_SIGNS_CONFIG
+from geofence import GeofenceIndex, world_to_map
+
+
+def test_query_matches_brute_force():
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-10, 10, (200, 2))
+    radii = rng.uniform(0.1, 1.5, 200)
+    index = GeofenceIndex(centers, radii, ["zone"] * 200, range(200))
+    for x, y in rng.uniform(-12, 12, (2000, 2)):
+        inside = np.flatnonzero(np.hypot(centers[:, 0] - x, centers[:, 1] - y) <= radii)
+        assert sorted(index.query(x, y)) == inside.tolist()
+
+
+def test_rejects_inconsistent_zones():
+    with pytest.raises(ValueError):
+        GeofenceIndex([[0, 0], [1, 1]], 1.0, ["light"], [1, 2])
+    with pytest.raises(ValueError):
+        GeofenceIndex([[0, 0]], 2.0, ["light"], [1], cell_size=1.0)
+
+
+def test_controller_zones_follow_the_scene_config():
+    index = build_geofence_index()
+    configs = TRAFFIC_LIGHTS_CONFIG + STOP_SIGNS_CONFIG + YIELD_SIGNS_CONFIG
+    assert len(index) == len(configs)
+    scale, offset = (MAP_SCALER_X, MAP_SCALER_Y), (MAP_OFFSET_X, MAP_OFFSET_Y)
+    for config in configs:
+        x, y = world_to_map(config["location"], scale, offset)
+        assert config["id"] in [index.ids[zone] for zone in index.query(x, y)]
+    # Light zones carry the light's position in perception's V2X status list.
+    lights = [zone for zone in range(len(index)) if index.kinds[zone] == "light"]
+    assert [index.payloads[zone] for zone in lights] == list(range(len(TRAFFIC_LIGHTS_CONFIG)))
+
+
+def test_v2x_red_light_stops_only_inside_its_zone():
+    scale, offset = (MAP_SCALER_X, MAP_SCALER_Y), (MAP_OFFSET_X, MAP_OFFSET_Y)
+    x, y = world_to_map(TRAFFIC_LIGHTS_CONFIG[0]["location"], scale, offset)
+    controller = StopGoController({"x": x + 10.0, "y": y}, verbose=False)
+    message = {"detections": [], "v2x_statuses": ["RED", "GREEN"]}
+    assert controller.step(1.0, message) == []
+    assert controller.rules.reasons() == []
+    controller.shared_pose = {"x": x, "y": y}
+    assert len(controller.step(1.1)) == 1
+    assert controller.rules.reasons() == ["V2X_Light"]
@@ -0,0 +1,59 @@
+# object_tracker.MultiObjectTracker on synthetic detections.
+import numpy as np
+import pytest
+
+from object_tracker import TRACKER_CAPACITY, MultiObjectTracker
+
+
+def test_objects_of_one_class_keep_their_own_tracks():
+    tracker = MultiObjectTracker()
+    pedestrian = tracker.class_ids(["pedestrian", "pedestrian"])
+    ids = tracker.update(0.0, pedestrian, [100, 400], [200, 200], [40, 40], [120, 120])
+    assert len(set(ids)) == 2
+    # They come back in the other order, moved a little.
+    later = tracker.update(0.1, pedestrian, [405, 103], [200, 200], [40, 40], [120, 120])
+    assert later.tolist() == ids[::-1].tolist()
+    assert len(tracker) == 2
+
+
+def test_classes_never_share_a_track():
+    tracker = MultiObjectTracker()
+    first = tracker.update(0.0, tracker.class_ids(["pedestrian"]), [100], [200], [40], [120])
+    second = tracker.update(0.1, tracker.class_ids(["stop_sign"]), [100], [200], [40], [120])
+    assert first[0] != second[0]
+
+
+def test_velocity_estimate_flags_moving_objects():
+    tracker = MultiObjectTracker()
+    pedestrian, stop_sign = tracker.class_ids(["pedestrian", "stop_sign"])
+    for k in range(10):
+        t = k / 30
+        tracker.update(
+            t, [pedestrian, stop_sign], [100 + 90 * t, 500], [200, 150], [40, 50], [120, 50]
+        )
+    speeds = tracker.speeds()[tracker.active]
+    assert np.sort(speeds) == pytest.approx([0.0, 90.0], abs=5.0)
+    moving = tracker.moving(pedestrian, 25.0)
+    assert moving.sum() == 1
+    assert not tracker.moving(stop_sign, 25.0).any()
+
+
+def test_stale_tracks_expire():
+    tracker = MultiObjectTracker()
+    qcar = tracker.class_ids(["Qcar"])
+    tracker.update(0.0, qcar, [300], [200], [100], [80])
+    tracker.update(1.0, tracker.class_ids(["pedestrian"]), [100], [200], [40], [120])
+    assert tracker.next_expiry(1.5) == 1.5
+    assert tracker.expire(1.5, 1.5) == 0
+    assert tracker.expire(1.6, 1.5) == 1
+    assert len(tracker) == 1
+    assert tracker.next_expiry(1.5) == 2.5
+
+
+def test_grows_past_capacity():
+    tracker = MultiObjectTracker()
+    n = TRACKER_CAPACITY + 10
+    cls = tracker.class_ids(["pedestrian"] * n)
+    size = np.full(n, 10.0)
+    ids = tracker.update(0.0, cls, np.arange(n) * 100.0, np.zeros(n), size, size)
+    assert len(set(ids)) == n == len(tracker)
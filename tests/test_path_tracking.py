@@ -0,0 +1,99 @@
+# path_tracking: path tables, map matching and the Stanley steering law.
+import math
+
+import numpy as np
+import pytest
+
+from path_tracking import (
+    PathMatcher,
+    PathTable,
+    SteeringController,
+    _ReferenceSteeringController,
+    project_onto_segments,
+)
+
+
+def loop(radius=2.0, spacing=0.01):
+    t = np.linspace(0.0, 2 * np.pi, int(2 * np.pi * radius / spacing))
+    return np.vstack([radius * np.cos(t), radius * np.sin(t)])
+
+
+def out_and_back(length=4.0, lane_offset=0.3, spacing=0.05):
+    """Two parallel lanes driven in opposite directions."""
+    x = np.arange(0.0, length, spacing)
+    outbound = np.vstack([x, np.zeros_like(x)])
+    inbound = np.vstack([x[::-1], np.full_like(x, lane_offset)])
+    return np.hstack([outbound, inbound])
+
+
+def nearest_distance(path, p):
+    d, _ = project_onto_segments(
+        np.asarray(p, dtype=float), path.starts, path.directions, path.lengths
+    )
+    return float(d.min())
+
+
+def test_search_matches_brute_force():
+    rng = np.random.default_rng(0)
+    path = PathMatcher(loop(radius=3.0))
+    for p in rng.uniform(-5, 5, (500, 2)):
+        _, d = path.search(p)
+        assert d == pytest.approx(nearest_distance(path, p))
+
+
+def test_match_follows_the_window_and_relocates_after_a_jump():
+    path = PathMatcher(loop())
+    segment, d = path.match((2.0, 0.05), 0)
+    assert d < 0.01 and path.relocations == 0
+    # Across the loop: far outside the window around the last match.
+    segment, d = path.match((-2.0, 0.0), segment)
+    assert d < 0.01 and path.relocations == 1
+    assert abs(path.headings[segment] - (-np.pi / 2)) < 0.05
+
+
+def test_search_prefers_segments_facing_the_car():
+    path = PathMatcher(out_and_back())
+    p = (2.0, 0.14)  # a little closer to the outbound lane
+    segment, _ = path.search(p, heading=math.pi)
+    assert math.cos(path.headings[segment] - math.pi) > 0
+    segment, _ = path.search(p, heading=0.0)
+    assert math.cos(path.headings[segment]) > 0
+
+
+def test_map_matched_steering_picks_up_the_path_anywhere():
+    waypoints = loop()
+    controller = SteeringController(waypoints, map_matching=True)
+    # On the far side of the loop, on the path and facing along it.
+    delta = controller.update(np.array([-2.0, 0.0]), -np.pi / 2, 0.4)
+    assert controller.path.distance_to(controller.p_ref) < 1e-9
+    assert np.hypot(*(np.array(controller.p_ref) - (-2.0, 0.0))) < 0.01
+    assert abs(delta) < 0.05
+
+
+def test_path_table_steering_matches_reference():
+    waypoints = loop(radius=2.0)
+    index = np.arange(3000) % (waypoints.shape[1] - 1)
+    poses = waypoints[:, index].T + 0.02
+    headings = np.arctan2(waypoints[1, index], waypoints[0, index]) + np.pi / 2
+    table, reference = SteeringController(waypoints), _ReferenceSteeringController(waypoints)
+    for p, th in zip(poses, headings):
+        assert table.update(p, th, 0.4) == pytest.approx(float(reference.update(p, th, 0.4)))
+    assert table.wpi == reference.wpi
+
+
+def test_path_table_geometry():
+    # A square with a repeated corner point (zero-length segment).
+    waypoints = np.array([[0, 1, 1, 1, 0, 0], [0, 0, 0, 1, 1, 0]], dtype=float)
+    table = PathTable(waypoints)
+    assert len(table) == 5
+    assert table.lengths.tolist() == [1.0, 0.0, 1.0, 1.0, 1.0]
+    assert table.arc_length.tolist() == [0.0, 1.0, 1.0, 2.0, 3.0]
+    # The zero-length segment keeps the direction of the one before it.
+    assert table.directions[1].tolist() == [1.0, 0.0]
+    assert table.distance_to((0.5, 0.5)) == pytest.approx(0.5)
+    assert table.distance_to((2.0, 0.5)) == pytest.approx(1.0)
+
+
+def test_curvature_of_a_circle():
+    table = PathTable(loop(radius=2.0))
+    assert np.median(table.curvature) == pytest.approx(0.5, rel=1e-3)
@@ -0,0 +1,57 @@
+# rate_scheduler.RateScheduler driven by a SimClock, as in the simulated control loop.
+import pytest
+
+from rate_scheduler import RateScheduler
+from sim_clock import SimClock
+
+
+def run(catch_up, work_s, n_ticks=20):
+    """Tick times of a 100 Hz loop whose work takes work_s(k) seconds on tick k."""
+    clock = SimClock()
+    scheduler = RateScheduler(
+        100, catch_up=catch_up, spin_s=0.0, clock=clock.now, sleep=clock.sleep
+    )
+    ticks = []
+    for k in range(n_ticks):
+        scheduler.wait()
+        ticks.append(clock.now())
+        clock.sleep(work_s(k))
+        scheduler.done()
+    return scheduler, ticks
+
+
+def test_ticks_stay_on_the_grid():
+    scheduler, ticks = run("skip", lambda k: 0.002, n_ticks=1000)
+    # Deadlines are t_start + k * period, not accumulated sleeps.
+    assert ticks[-1] == pytest.approx(9.99, abs=1e-9)
+    assert scheduler.rate() == pytest.approx(100.0)
+    assert (scheduler.overruns, scheduler.skipped) == (0, 0)
+    assert scheduler.stats.histograms["jitter"].max == pytest.approx(0.0, abs=1e-9)
+
+
+def test_skip_drops_missed_ticks():
+    scheduler, ticks = run("skip", lambda k: 0.035 if k == 5 else 0.002)
+    assert scheduler.overruns == 1
+    assert scheduler.skipped == 2
+    # After the late tick the loop is back on the 10 ms grid.
+    assert ticks[7:] == pytest.approx([0.01 * k for k in range(9, 22)])
+
+
+def test_burst_runs_missed_ticks_back_to_back():
+    scheduler, ticks = run("burst", lambda k: 0.035 if k == 5 else 0.002)
+    assert scheduler.skipped == 0
+    assert ticks[6:10] == pytest.approx([0.085, 0.087, 0.089, 0.091])
+    assert ticks[10:] == pytest.approx([0.01 * k for k in range(10, 20)])
+
+
+def test_wait_returns_the_loop_dt():
+    clock = SimClock()
+    scheduler = RateScheduler(50, spin_s=0.0, clock=clock.now, sleep=clock.sleep)
+    assert scheduler.wait() == 0.0
+    scheduler.done()
+    assert scheduler.wait() == pytest.approx(0.02)
+
+
+def test_rejects_unknown_catch_up_policy():
+    with pytest.raises(ValueError):
+        RateScheduler(100, catch_up="drop")
@@ -0,0 +1,167 @@
+# rule_engine.RuleEngine on the controller's rule table.
+import random
+
+import pytest
+
+from controller_qcar import STOP_CONDITIONS, STOP_RULES
+from rule_engine import Condition, Rule, RuleEngine
+
+PERCEPTION_REASONS = [
+    "Perception_Light", "Pedestrian", "Stop_Sign", "Yield_Sign", "QCar_Too_Close",
+]
+
+
+class ElifChain:
+    """The controller's original if/elif decision chain, for one detection per frame."""
+
+    def __init__(self):
+        names = PERCEPTION_REASONS + ["QCar_Too_Close_Light", "V2X_Light"]
+        self.active = dict.fromkeys(names, False)
+        self.stop_sign_start = self.yield_sign_start = 0.0
+        self.last_pedestrian = self.last_qcar = self.last_light = 0.0
+
+    def others_clear(self, *allowed):
+        return not any(v for name, v in self.active.items() if name not in allowed)
+
+    def step(self, t, detection):
+        a = self.active
+        if detection is not None:
+            cls, width, height, x = detection
+            if cls == "Qcar":
+                self.last_qcar = t
+            if cls in ("red_light", "green_light") and width > 30 and height > 30:
+                self.last_light = t
+            if cls == "yellow_light":
+                self.last_light = t
+            if cls == "pedestrian":
+                self.last_pedestrian = t
+            in_zone = 100 < x < 450
+            if cls == "red_light" and width > 30 and height > 30 and self.others_clear():
+                a["Perception_Light"] = True
+            elif (
+                cls == "green_light" and width > 30 and height > 30
+                and a["Perception_Light"] and self.others_clear("Perception_Light")
+            ):
+                a["Perception_Light"] = False
+            elif cls == "Qcar" and height > 125:
+                a["QCar_Too_Close"] = True
+            elif (
+                cls == "Qcar" and a["QCar_Too_Close"] and height <= 125
+                and self.others_clear("QCar_Too_Close", "Stop_Sign")
+            ):
+                a["QCar_Too_Close"] = False
+            elif (
+                cls == "stop_sign" and width > 50 and t - self.stop_sign_start > 10
+                and self.others_clear()
+            ):
+                a["Stop_Sign"] = True
+                self.stop_sign_start = t
+            elif (
+                cls == "yield_sign" and width > 30 and t - self.yield_sign_start > 6
+                and self.others_clear()
+            ):
+                a["Yield_Sign"] = True
+                self.yield_sign_start = t
+            elif (
+                cls == "pedestrian" and (not in_zone or width < 40)
+                and a["Pedestrian"] and self.others_clear("Pedestrian")
+            ):
+                a["Pedestrian"] = False
+            elif cls == "pedestrian" and width > 40 and in_zone and self.others_clear():
+                a["Pedestrian"] = True
+        if a["Pedestrian"] and t - self.last_pedestrian > 2.5:
+            a["Pedestrian"] = False
+        if a["QCar_Too_Close"] and t - self.last_qcar > 1:
+            a["QCar_Too_Close"] = False
+        if a["Stop_Sign"] and t - self.stop_sign_start > 5:
+            a["Stop_Sign"] = False
+        if a["Yield_Sign"] and t - self.yield_sign_start > 3:
+            a["Yield_Sign"] = False
+        if a["Perception_Light"] and t - self.last_light > 3:
+            a["Perception_Light"] = False
+        return [name for name in PERCEPTION_REASONS if a[name]]
+
+
+def test_matches_elif_chain_for_single_detections():
+    rng = random.Random(1)
+    classes = ["red_light", "green_light", "yellow_light", "Qcar", "stop_sign", "yield_sign",
+               "pedestrian", "other"]
+    for _ in range(100):
+        reference = ElifChain()
+        engine = RuleEngine(STOP_CONDITIONS, STOP_RULES)
+        t = 100.0
+        for _ in range(300):
+            t += rng.choice([0.05, 0.05, 0.3, 1.2])
+            detection = None
+            if rng.random() < 0.7:
+                detection = (
+                    rng.choice(classes),
+                    rng.choice([20, 35, 41, 45, 55, 80]),
+                    rng.choice([20, 35, 100, 130]),
+                    rng.choice([50, 200, 300, 500]),
+                )
+                cls, width, height, x = detection
+                engine.step(t, [engine.class_id(cls)], [width], [height], [x])
+            engine.expire(t)
+            assert [n for n in engine.names if engine.is_set(n)] == reference.step(t, detection)
+
+
+def test_all_conditions_update_in_one_frame():
+    engine = RuleEngine(STOP_CONDITIONS, STOP_RULES)
+    cls = engine.class_ids(["red_light", "stop_sign", "other"])
+    fired = engine.step(10.0, cls, [40, 60, 500], [40, 60, 500], [300, 300, 300])
+    assert len(fired) == 2
+    assert engine.reasons() == ["Perception_Light", "Stop_Sign"]
+
+
+def test_first_declared_rule_wins_per_condition():
+    rules = [
+        Rule("Light", "clear", "green", requires_set=["Light"]),
+        Rule("Light", "set", "red", requires_clear=[]),
+    ]
+    engine = RuleEngine([Condition("Light")], rules)
+    engine.set_condition("Light", True, 0.0)
+    fired = engine.step(1.0, engine.class_ids(["red", "green"]), [1, 1], [1, 1], [0, 0])
+    assert fired.tolist() == [0]
+    assert not engine.is_set("Light")
+
+
+def test_timeouts_and_deadlines():
+    engine = RuleEngine(STOP_CONDITIONS, STOP_RULES)
+    assert engine.next_deadline() == float("inf")
+    engine.step(10.0, engine.class_ids(["stop_sign"]), [60], [60], [300])
+    assert engine.next_deadline() == pytest.approx(10.0 + 5.0)
+    assert engine.expire(15.0) == 0  # strict ">" timeout
+    assert engine.expire(15.01) == engine.bits["Stop_Sign"]
+    # The stop sign's cooldown keeps the same sign from stopping us again.
+    engine.step(16.0, engine.class_ids(["stop_sign"]), [60], [60], [300])
+    assert not engine.is_set("Stop_Sign")
+    engine.step(20.5, engine.class_ids(["stop_sign"]), [60], [60], [300])
+    assert engine.is_set("Stop_Sign")
+
+
+def test_seen_timeout_is_refreshed_by_detections():
+    engine = RuleEngine(STOP_CONDITIONS, STOP_RULES)
+    engine.step(0.0, engine.class_ids(["red_light"]), [40], [40], [300])
+    # No rule acts on a yellow light, but seeing one keeps the light stop alive.
+    engine.step(2.5, engine.class_ids(["yellow_light"]), [10], [10], [300])
+    assert engine.expire(4.0) == 0
+    assert engine.next_deadline() == pytest.approx(5.5)
+    assert engine.expire(5.6) == engine.bits["Perception_Light"]
+
+
+def test_empty_frame_and_unknown_classes():
+    engine = RuleEngine(STOP_CONDITIONS, STOP_RULES)
+    assert engine.class_id("bicycle") == -1
+    assert len(engine.step(0.0, [], [], [], [])) == 0
+    assert len(engine.step(0.0, engine.class_ids(["bicycle"]), [999], [999], [300])) == 0
+    assert engine.state == 0
+
+
+def test_rejects_bad_tables():
+    with pytest.raises(ValueError):
+        RuleEngine([Condition("A"), Condition("A")], [])
+    with pytest.raises(ValueError):
+        Rule("A", "toggle", "red")
+    with pytest.raises(ValueError):
+        Condition("A", 1.0, "end")
@@ -0,0 +1,180 @@
+# Seqlocked shared-memory channels, exercised in one process: a writer in the
+# middle of an update is simulated by bumping the lock words directly.
+import os
+
+import numpy as np
+import pytest
+
+import shm_transport
+from shm_transport import CRUISE_SPEED, CommandMailbox, FrameRing, PoseBuffer
+
+FRAME_SHAPE = (4, 6, 3)
+
+
+def unique_name(kind):
+    return f"test_{kind}_{os.getpid()}"
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing.create(unique_name("ring"), FRAME_SHAPE, n_slots=4)
+    yield ring
+    ring.close()
+
+
+@pytest.fixture
+def mailbox():
+    mailbox = CommandMailbox.create(unique_name("cmd"))
+    yield mailbox
+    mailbox.close()
+
+
+@pytest.fixture
+def poses():
+    poses = PoseBuffer.create(unique_name("pose"), n_vehicles=3)
+    yield poses
+    poses.close()
+
+
+def frame(value):
+    return np.full(FRAME_SHAPE, value, dtype=np.uint8)
+
+
+# --- FrameRing ---
+def test_ring_round_trip(ring):
+    seq = ring.write(frame(7), 1.5, ["RED", "GREEN", "BLUE"])
+    out = np.empty(FRAME_SHAPE, dtype=np.uint8)
+    assert ring.read(seq, out) == (1.5, ["RED", "GREEN", "UNKNOWN"])
+    assert (out == 7).all()
+    assert ring.view(seq + 1) is None  # not written yet: neither missed nor torn
+    assert (ring.missed, ring.torn) == (0, 0)
+
+
+def test_ring_counts_overwritten_frame_once_as_missed(ring):
+    for value in range(1, 6):
+        ring.write(frame(value), float(value))
+    # Frame 1 shares its slot with frame 5.
+    assert ring.view(1) is None
+    assert (ring.missed, ring.torn) == (1, 0)
+
+
+def test_ring_slot_being_written_is_missed_not_torn(ring):
+    for value in range(1, 5):
+        ring.write(frame(value), float(value))
+    ring.slot_locks[1] += 1  # writer started on frame 5 in frame 1's slot
+    assert ring.view(1) is None
+    assert (ring.missed, ring.torn) == (1, 0)
+
+
+def test_ring_counts_frame_rewritten_during_read_as_torn(ring, monkeypatch):
+    seq = ring.write(frame(1), 1.0)
+    decode_v2x = shm_transport.decode_v2x
+
+    def decode_while_writer_runs(codes):
+        ring.slot_locks[seq % ring.n_slots] += 1
+        return decode_v2x(codes)
+
+    monkeypatch.setattr(shm_transport, "decode_v2x", decode_while_writer_runs)
+    assert ring.view(seq) is None
+    assert (ring.missed, ring.torn) == (0, 1)
+
+
+def test_ring_view_invalidated_by_writer(ring):
+    seq = ring.write(frame(1), 1.0)
+    _, _, _, lock = ring.view(seq)
+    assert ring.is_intact(seq, lock)
+    ring.slot_locks[seq % ring.n_slots] += 2  # a complete rewrite of the slot
+    assert not ring.is_intact(seq, lock)
+
+
+def test_ring_lagging_reader_takes_the_newest_frame(ring):
+    for value in range(1, 11):
+        ring.write(frame(value), float(value))
+    assert ring.next_seq_for(0) == 10
+    assert ring.missed == 9
+    assert ring.next_seq_for(10) is None
+    # Two readers split the frames by parity, each taking its newest.
+    assert ring.next_seq_for(7, reader_index=0, n_readers=2) == 10
+    assert ring.next_seq_for(7, reader_index=1, n_readers=2) == 9
+
+
+def test_ring_slow_reader_gets_frames(ring):
+    # 30 fps capture and 60 ms inference: two frames are written per inference.
+    delivered = 0
+    last_seq = 0
+    ring.write(frame(0), 0.0)
+    for _ in range(45):
+        seq = ring.next_seq_for(last_seq)
+        last_seq = seq
+        _, _, _, lock = ring.view(seq)
+        ring.write(frame(1), 0.0)
+        ring.write(frame(2), 0.0)
+        if ring.is_intact(seq, lock):
+            delivered += 1
+    assert delivered == 45
+    assert ring.torn == 0
+
+
+# --- CommandMailbox ---
+def test_mailbox_round_trip(mailbox):
+    assert mailbox.read(0) is None
+    seq = mailbox.post(0.3, reasons=5, stamps={"seq": 42, "t_capture": 1.0})
+    record = mailbox.read(0)
+    assert (record.seq, record.speed, record.reasons, record.frame_seq) == (seq, 0.3, 5, 42)
+    assert record.stamps == {"t_capture": 1.0, "seq": 42}
+    assert mailbox.read(record.seq) is None
+
+
+def test_mailbox_counts_superseded_commands(mailbox):
+    mailbox.post(0.0)
+    first = mailbox.read(0)
+    for _ in range(3):
+        mailbox.post(CRUISE_SPEED)
+    record = mailbox.read(first.seq)
+    assert record.seq == 4 and np.isnan(record.speed)
+    assert mailbox.superseded == 2
+    assert mailbox.torn == 0
+
+
+def test_mailbox_retries_torn_reads(mailbox):
+    mailbox.post(0.2)
+    floats = mailbox.floats
+
+    class PostDuringRead:
+        def tolist(self):
+            mailbox.floats = floats
+            mailbox.post(0.1)
+            return floats.tolist()
+
+    mailbox.floats = PostDuringRead()
+    record = mailbox.read(0)
+    assert (record.seq, record.speed) == (2, 0.1)
+    assert mailbox.torn == 1
+
+
+def test_mailbox_unfinished_write_is_not_read(mailbox):
+    mailbox.post(0.2)
+    mailbox.lock[0] += 1  # writer stopped mid-record
+    assert mailbox.read(0) is None
+    mailbox.lock[0] += 1
+    assert mailbox.read(0).speed == 0.2
+
+
+# --- PoseBuffer ---
+def test_pose_round_trip(poses):
+    assert poses.read(1)["seq"] == 0
+    cov = np.diag([1.0, 2.0, 3.0])
+    assert poses.publish(1, 1.0, 2.0, 0.5, 0.4, cov=cov, t=12.5) == 1
+    pose = poses.view(1).read()
+    assert {k: pose[k] for k in ("x", "y", "th", "v", "t", "seq")} == {
+        "x": 1.0, "y": 2.0, "th": 0.5, "v": 0.4, "t": 12.5, "seq": 1,
+    }
+    assert pose["cov"] == cov.ravel().tolist()
+    assert poses.read(0)["seq"] == 0 and poses.read(2)["seq"] == 0
+
+
+def test_pose_unfinished_publish_is_not_read(poses):
+    poses.publish(0, 1.0, 2.0, 0.0, 0.0)
+    poses.locks[0, 0] += 1
+    assert poses.read(0) is None
+    assert poses.read(1) is not None  # other vehicles have their own locks
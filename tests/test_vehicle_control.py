@@ -0,0 +1,54 @@
+# Closed-loop checks of vehicle_control.controlLoop on the simulated plant.
+import math
+import os
+
+import numpy as np
+import pytest
+
+import vehicle_control
+from shm_transport import CommandMailbox, PoseBuffer
+
+CIRCLE_RADIUS_M = 2.0
+
+
+def circle_route(radius, spacing=0.01):
+    """Counter-clockwise closed circle about the origin, starting at (radius, 0)."""
+    t = np.linspace(0.0, 2 * np.pi, int(2 * np.pi * radius / spacing))
+    return np.vstack([radius * np.cos(t), radius * np.sin(t)])
+
+
+@pytest.fixture
+def shared_memory():
+    tag = f"vc_test_{os.getpid()}"
+    command_mailbox = CommandMailbox.create(f"{tag}_cmd")
+    pose_buffer = PoseBuffer.create(f"{tag}_pose")
+    yield command_mailbox, pose_buffer
+    command_mailbox.close()
+    pose_buffer.close()
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_simulated_lap_stays_on_path(monkeypatch, shared_memory, seed):
+    monkeypatch.setattr(vehicle_control, "simulatedPlant", True)
+    monkeypatch.setattr(vehicle_control, "simulatedLaps", 1)
+    monkeypatch.setattr(vehicle_control, "simulatedSeed", seed)
+    # What initialSetup() would set, without the roadmap or QLabs.
+    route = {
+        "waypointSequence": circle_route(CIRCLE_RADIUS_M),
+        "initialPose": np.array([CIRCLE_RADIUS_M, 0.0, np.pi / 2]),
+        "Car1": None,
+        "calibrate": False,
+    }
+    for name, value in route.items():
+        monkeypatch.setattr(vehicle_control, name, value, raising=False)
+    command_mailbox, pose_buffer = shared_memory
+
+    plant = vehicle_control.controlLoop(command_mailbox, pose_buffer)
+
+    assert plant.distance >= 2 * np.pi * CIRCLE_RADIUS_M
+    # The true rear axle stays on the circle; a drifting estimate would pull it off.
+    assert abs(math.hypot(plant.x, plant.y) - CIRCLE_RADIUS_M) < 0.05
+    # The published pose is the estimate at the simulated time, close to the truth.
+    pose = pose_buffer.read(0)
+    assert math.hypot(pose["x"] - plant.x, pose["y"] - plant.y) < 0.05
+    assert pose["t"] == pytest.approx(plant.t)
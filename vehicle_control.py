@@ -11,16 +11,15 @@ from threading import Thread
 # --- REMOVED QLabs modules ---
 
 # --- Existing Imports ---
-from perception_module import run_perception
-import perception_module
+# The QCar/QLabs (pal, hal, qvl) and perception (torch) modules are imported
+# where they are used, so the simulated plant runs without them.
 import controller_qcar as controller  # The brain
-
-from pal.products.qcar import QCar, QCarGPS, IS_PHYSICAL_QCAR
-from pal.utilities.math import wrap_to_pi
-from hal.content.qcar_functions import QCarEKF
-from custom_roadmap import CustomRoadMap
-from qvl.multi_agent import readRobots
-from qvl.real_time import QLabsRealTime
+from latency import LatencyStats, stamp
+from path_tracking import SteeringController
+from rate_scheduler import RateScheduler
+from sim_clock import SimClock
+from sim_plant import KinematicBicycle, SimQCar, SimQCarEKF, SimQCarGPS
+from shm_transport import CommandMailbox, PoseBuffer, command_mailbox_name, pose_buffer_name
 
 
 # endregion
@@ -34,6 +33,37 @@ K_p = 0.1
 K_i = 1
 enableSteeringControl = True
 K_stanley = 1
+# Skip all perception drawing (no YOLO / lane windows) on headless runs
+headlessPerception = False
+# Skip / ROI-only YOLO passes when the camera view has not changed
+adaptivePerception = False
+# Weight of the camera lane measurement in the steering command
+# (0 = map path only, 1 = lane only) and the oldest measurement still used
+laneCorrectionWeight = 0.0
+laneMaxAge = 0.2
+# Run camera capture and YOLO in separate processes joined by a
+# shared-memory frame ring instead of the in-process perception thread
+useSharedFrameRing = False
+inferenceProcesses = 1
+# Record camera frames, V2X and detections for offline replay (frame_log.py)
+perceptionRecordPath = None
+# Write the control loop's capture-to-actuator latency histograms here (JSON)
+latencyExportPath = None
+# Map-match the car to the nearest path segment every tick (windowed search,
+# whole-path search after GPS jumps) instead of only stepping one waypoint on
+mapMatching = False
+# controlLoop runs at controllerUpdateRate on a deadline scheduler; ticks
+# missed after an overrun are skipped ("skip") or run back to back ("burst").
+# Rate/jitter/compute statistics are printed every rateStatsPrintInterval s.
+controlLoopCatchUp = "skip"
+rateStatsPrintInterval = 10.0
+# Drive a simulated kinematic QCar (sim_plant.py) on simulated time instead
+# of the QCar/QLabs HIL ports, without perception, for simulatedLaps laps of
+# the route; runs as fast as the control code allows. simulatedSeed fixes the
+# sensor noise and GPS outages (None: different every run).
+simulatedPlant = False
+simulatedLaps = 1
+simulatedSeed = None
 nodeSequence =  [
     10,
     2,
@@ -77,19 +107,33 @@ nodeSequence =  [
 # --- REMOVED: V2X Helper Functions section ---
 
 # region : Initial Setup
-if enableSteeringControl:
-    roadmap = CustomRoadMap()
-    waypointSequence = roadmap.generate_path(nodeSequence)
-    initialPose = roadmap.get_node_pose(nodeSequence[0]).squeeze()
-else:
-    initialPose = [0, 0, 0]
-
-if not IS_PHYSICAL_QCAR:
-    robotsDir = readRobots()
-    Car1 = robotsDir["QC2_0"]
-    calibrate = False
-else:
-    calibrate = "y" in input("do you want to recalibrate?(y/n)")
+def initialSetup():
+    """Route, start pose and (on QLabs) the car's ports; run once before controlLoop."""
+    global waypointSequence, initialPose, Car1, calibrate
+    if enableSteeringControl:
+        from custom_roadmap import CustomRoadMap
+
+        roadmap = CustomRoadMap()
+        waypointSequence = roadmap.generate_path(nodeSequence)
+        initialPose = roadmap.get_node_pose(nodeSequence[0]).squeeze()
+    else:
+        initialPose = [0, 0, 0]
+
+    if simulatedPlant:
+        Car1 = None
+        calibrate = False
+        return
+    from pal.products.qcar import IS_PHYSICAL_QCAR
+
+    if not IS_PHYSICAL_QCAR:
+        from qvl.multi_agent import readRobots
+
+        robotsDir = readRobots()
+        Car1 = robotsDir["QC2_0"]
+        calibrate = False
+    else:
+        calibrate = "y" in input("do you want to recalibrate?(y/n)")
+
 
 calibrationPose = [0, 2, -np.pi / 2]
 
@@ -100,14 +144,17 @@ KILL_THREAD = False
 def sig_handler(*args):
     global KILL_THREAD
     KILL_THREAD = True
-    perception_module.KILL_THREAD = True
+    if not simulatedPlant:
+        import perception_module
+
+        perception_module.KILL_THREAD = True
 
 
 signal.signal(signal.SIGINT, sig_handler)
 # endregion
 
 
-# region : Controller Classes (SpeedController, SteeringController - no changes)
+# region : Controller Classes (SteeringController lives in path_tracking.py)
 class SpeedController:
     # ... (no changes) ...
     def __init__(self, kp=0, ki=0):
@@ -124,50 +171,10 @@ class SpeedController:
         )
 
 
-class SteeringController:
-    # ... (no changes) ...
-    def __init__(self, waypoints, k=1, cyclic=True):
-        self.maxSteeringAngle = np.pi / 6
-        self.wp = waypoints
-        self.N = len(waypoints[0, :])
-        self.wpi = 0
-        self.k = k
-        self.cyclic = cyclic
-        self.p_ref = (0, 0)
-        self.th_ref = 0
-
-    def update(self, p, th, speed):
-        wp_1 = self.wp[:, np.mod(self.wpi, self.N - 1)]
-        wp_2 = self.wp[:, np.mod(self.wpi + 1, self.N - 1)]
-        v = wp_2 - wp_1
-        v_mag = np.linalg.norm(v)
-        try:
-            v_uv = v / v_mag
-        except ZeroDivisionError:
-            return 0
-        tangent = np.arctan2(v_uv[1], v_uv[0])
-        s = np.dot(p - wp_1, v_uv)
-        if abs(s) >= v_mag:
-            if self.cyclic or self.wpi < self.N - 2:
-                self.wpi += 1
-        ep = wp_1 + v_uv * s
-        ct = ep - p
-        dir = wrap_to_pi(np.arctan2(ct[1], ct[0]) - tangent)
-        ect = np.linalg.norm(ct) * np.sign(dir)
-        psi = wrap_to_pi(tangent - th)
-        self.p_ref = ep
-        self.th_ref = tangent
-        return np.clip(
-            wrap_to_pi(psi + np.arctan2(self.k * ect, speed)),
-            -self.maxSteeringAngle,
-            self.maxSteeringAngle,
-        )
-
-
 # endregion
 
 
-def controlLoop(command_queue, shared_pose):
+def controlLoop(command_mailbox, pose_buffer, lane_queue=None):
     # region controlLoop setup
     global KILL_THREAD
     u = 0
@@ -180,31 +187,65 @@ def controlLoop(command_queue, shared_pose):
     # region Controller initialization
     speedController = SpeedController(kp=K_p, ki=K_i)
     if enableSteeringControl:
-        steeringController = SteeringController(waypoints=waypointSequence, k=K_stanley)
+        steeringController = SteeringController(
+            waypoints=waypointSequence, k=K_stanley, map_matching=mapMatching
+        )
     # endregion
 
     # region QCar interface setup
-    qcar = QCar(readMode=1, frequency=controllerUpdateRate, hilPort=Car1["hilPort"])
-    if enableSteeringControl or calibrate:
-        ekf = QCarEKF(x_0=initialPose)
-        gps = QCarGPS(
-            initialPose=calibrationPose,
-            calibrate=calibrate,
-            gpsPort=Car1["gpsPort"],
-            lidarIdealPort=Car1["lidarIdealPort"],
+    if simulatedPlant:
+        # Plant and loop share one simulated clock, advanced by the scheduler.
+        sim_clock = SimClock()
+        clock = sim_clock.now
+        rng = np.random.default_rng(simulatedSeed)
+        plant = KinematicBicycle(initialPose)
+        qcar = SimQCar(plant, clock, rng)
+        scheduler = RateScheduler(
+            controllerUpdateRate,
+            catch_up=controlLoopCatchUp,
+            spin_s=0.0,
+            clock=clock,
+            sleep=sim_clock.sleep,
         )
+    else:
+        from pal.products.qcar import QCar, QCarGPS
+        from hal.content.qcar_functions import QCarEKF
+
+        clock = time.monotonic
+        qcar = QCar(readMode=1, frequency=controllerUpdateRate, hilPort=Car1["hilPort"])
+        scheduler = RateScheduler(controllerUpdateRate, catch_up=controlLoopCatchUp)
+    if enableSteeringControl or calibrate:
+        if simulatedPlant:
+            # Estimate and GPS in the plant's frame (rear axle, map frame).
+            ekf = SimQCarEKF(x_0=initialPose)
+            gps = SimQCarGPS(plant, clock, rng)
+        else:
+            ekf = QCarEKF(x_0=initialPose)
+            gps = QCarGPS(
+                initialPose=calibrationPose,
+                calibrate=calibrate,
+                gpsPort=Car1["gpsPort"],
+                lidarIdealPort=Car1["lidarIdealPort"],
+            )
     else:
         gps = memoryview(b"")
     # endregion
     effective_v_ref = v_ref
+    lane = None
+    # Stamps of the command waiting to take effect at the next qcar.write()
+    latency = LatencyStats("control_loop")
+    pending_stamps = None
+    command_seq = 0
+    if simulatedPlant and enableSteeringControl:
+        simulated_distance = simulatedLaps * float(steeringController.path.lengths.sum())
+    t_wall_start = time.monotonic()
     with qcar, gps:
-        t0 = time.time()
+        last_rate_print = time.monotonic()
         t = 0
         while (t < tf + startDelay) and (not KILL_THREAD):
-            # region : Loop timing update
-            tp = t
-            t = time.time() - t0
-            dt = t - tp
+            # region : Loop timing update (fixed rate, see rate_scheduler.py)
+            dt = scheduler.wait()
+            t = scheduler.t_tick - scheduler.t_start
             # endregion
 
             # region : Read from sensors and update state estimates
@@ -214,8 +255,6 @@ def controlLoop(command_queue, shared_pose):
                     y_gps = np.array(
                         [gps.position[0], gps.position[1], gps.orientation[2]]
                     )
-                    shared_pose["x"] = gps.position[0]
-                    shared_pose["y"] = gps.position[1]
                     ekf.update(
                         [qcar.motorTach, delta],
                         dt,
@@ -230,30 +269,32 @@ def controlLoop(command_queue, shared_pose):
                         qcar.gyroscope[2],
                     )
 
-                # --- SHARE POSE ---
-                # shared_pose["x"] = ekf.x_hat[0, 0]
-                # shared_pose["y"] = ekf.x_hat[1, 0]
-                shared_pose["th"] = ekf.x_hat[2, 0]
-                shared_pose["v"] = qcar.motorTach
-                # --- END SHARE POSE ---
-
                 x = ekf.x_hat[0, 0]
                 y = ekf.x_hat[1, 0]
                 th = ekf.x_hat[2, 0]
+
+                # --- SHARE POSE (one seqlocked store, see shm_transport.PoseBuffer) ---
+                # The whole pose is the estimate at this tick, stamped on the
+                # loop's clock (simulated time with the simulated plant).
+                pose_buffer.publish(0, x, y, th, qcar.motorTach, cov=ekf.P, t=clock())
+                # --- END SHARE POSE ---
+
                 p = np.array([x, y]) + np.array([np.cos(th), np.sin(th)]) * 0.2
             v = qcar.motorTach
             # endregion
 
             # --- Check for commands from the controller "brain" ---
-            if not command_queue.empty():
-                command = command_queue.get()
-                if command == "STOP":
-                    effective_v_ref = 0.0
-                elif command.startswith("GO") and command != "GO":
-                    value_str = command[3:]
-                    effective_v_ref = float(value_str)
-                elif command == "GO":
-                    effective_v_ref = v_ref
+            # Latest command from the shared-memory mailbox (no syscall when unchanged).
+            command = command_mailbox.read(command_seq)
+            if command is not None:
+                command_seq = command.seq
+                pending_stamps = stamp(command.stamps, "t_dequeued")
+                # NaN target speed: resume the configured cruise speed.
+                effective_v_ref = v_ref if np.isnan(command.speed) else command.speed
+
+            # --- Latest lane geometry from perception ---
+            if lane_queue is not None and not lane_queue.empty():
+                lane = lane_queue.get()
             # endregion
 
             # region : Update controllers and write to car
@@ -264,23 +305,72 @@ def controlLoop(command_queue, shared_pose):
                 u = speedController.update(v, effective_v_ref, dt)
                 if enableSteeringControl:
                     delta = steeringController.update(p, th, v)
+                    if (
+                        laneCorrectionWeight > 0
+                        and lane is not None
+                        and lane.valid
+                        and time.monotonic() - lane.t_capture < laneMaxAge
+                    ):
+                        delta_lane = steeringController.update_from_lane(
+                            lane.offset_m, lane.heading_err_rad, v
+                        )
+                        delta = (
+                            1 - laneCorrectionWeight
+                        ) * delta + laneCorrectionWeight * delta_lane
                 else:
                     delta = 0
             qcar.write(u, delta)
+            if pending_stamps is not None:
+                latency.record_stamps(stamp(pending_stamps, "t_applied"))
+                pending_stamps = None
             # endregion
+            scheduler.done()
+            if time.monotonic() - last_rate_print > rateStatsPrintInterval:
+                scheduler.print("[Control]")
+                last_rate_print = time.monotonic()
+            if (
+                simulatedPlant
+                and enableSteeringControl
+                and plant.distance >= simulated_distance
+            ):
+                break
             continue
         qcar.read_write_std(throttle=0, steering=0)
+    if simulatedPlant:
+        print(
+            f"[Control] Simulated {t:.1f} s, {plant.distance:.1f} m driven, in "
+            f"{time.monotonic() - t_wall_start:.2f} s wall time"
+        )
+        if enableSteeringControl:
+            print(f"[Control] Simulated GPS: {gps.fixes} fixes, {gps.dropped} dropped")
+            front = np.array([plant.x, plant.y]) + 0.2 * np.array(
+                [np.cos(plant.th), np.sin(plant.th)]
+            )
+            print(
+                f"[Control] Final cross-track error "
+                f"{steeringController.path.distance_to(front) * 1000:.1f} mm"
+            )
+    latency.set_dropped(
+        {"command_superseded": command_mailbox.superseded, "command_torn": command_mailbox.torn}
+    )
+    scheduler.print("[Control]")
+    latency.print("[Control]")
+    if latencyExportPath is not None:
+        latency.export(latencyExportPath)
+    # The simulated plant holds where the car really ended up (for tests).
+    return plant if simulatedPlant else None
 
 
 if __name__ == "__main__":
+    initialSetup()
     try:
         # --- Setup multiprocessing queues and shared memory ---
         mp.set_start_method("spawn", force=True)
         perception_queue = mp.Queue(maxsize=1)
-        command_queue = mp.Queue(maxsize=1)
+        command_mailbox = CommandMailbox.create(command_mailbox_name(0))
+        lane_queue = mp.Queue(maxsize=1)
 
-        manager = mp.Manager()
-        shared_pose = manager.dict({"x": 0.0, "y": 0.0, "th": 0.0, "v": 0.0})
+        pose_buffer = PoseBuffer.create(pose_buffer_name(), n_vehicles=1)
 
         # --- REMOVED: QLabs Setup ---
         # --- REMOVED: V2X Shared State Setup ---
@@ -288,10 +378,45 @@ if __name__ == "__main__":
         # --- Start All Processes and Threads ---
 
         # 1. Perception Module (Eyes)
-        perception_proc = Thread(
-            target=run_perception, args=(perception_queue, 0, True)
-        )
-        perception_proc.start()
+        perception_stop = mp.Event()
+        perception_procs = []
+        if not simulatedPlant:
+            import perception_module
+        if simulatedPlant:
+            print("Simulated plant: no camera, perception is not started.")
+        elif useSharedFrameRing:
+            perception_procs.append(
+                mp.Process(
+                    target=perception_module.run_capture_process,
+                    args=(0, perception_stop),
+                )
+            )
+            for reader_index in range(inferenceProcesses):
+                perception_procs.append(
+                    mp.Process(
+                        target=perception_module.run_inference_process,
+                        args=(0, perception_queue, perception_stop),
+                        kwargs={
+                            "reader_index": reader_index,
+                            "n_readers": inferenceProcesses,
+                        },
+                    )
+                )
+        else:
+            perception_procs.append(
+                Thread(
+                    target=perception_module.run_perception,
+                    args=(perception_queue, 0, True),
+                    kwargs={
+                        "headless": headlessPerception,
+                        "adaptive": adaptivePerception,
+                        "lane_queue": lane_queue,
+                        "record_path": perceptionRecordPath,
+                    },
+                )
+            )
+        for perception_proc in perception_procs:
+            perception_proc.start()
 
         # --- REMOVED: V2X Status Thread ---
 
@@ -301,14 +426,16 @@ if __name__ == "__main__":
         #     target=controller.main,
         #     args=(
         #         perception_queue,
-        #         command_queue,
-        #         shared_pose,
+        #         command_mailbox_name(0),
+        #         pose_buffer.view(0),
         #     ),
         # )
         # controller_proc.start()
 
         # 4. Main Control Loop (Hands)
-        control_thread = Thread(target=controlLoop, args=(command_queue, shared_pose))
+        control_thread = Thread(
+            target=controlLoop, args=(command_mailbox, pose_buffer, lane_queue)
+        )
         control_thread.start()
 
         try:
@@ -322,16 +449,25 @@ if __name__ == "__main__":
 
         # if controller_proc.is_alive():
         #     controller_proc.terminate()
-        perception_proc.join()
+        perception_stop.set()
+        for perception_proc in perception_procs:
+            perception_proc.join()
         # --- REMOVED: statusThread.join() ---
         control_thread.join()
         # controller_proc.join()
+        command_mailbox.close()
+        pose_buffer.close()
         print("✅ All threads and processes joined.")
 
         # --- REMOVED: QLabs close logic ---
 
-        if not IS_PHYSICAL_QCAR:
-            # This is still useful to clean up the simulation environment
-            QLabsRealTime().terminate_all_real_time_models()
+        if not simulatedPlant:
+            from pal.products.qcar import IS_PHYSICAL_QCAR
+
+            if not IS_PHYSICAL_QCAR:
+                from qvl.real_time import QLabsRealTime
+
+                # This is still useful to clean up the simulation environment
+                QLabsRealTime().terminate_all_real_time_models()
 
     print("Experiment complete.")